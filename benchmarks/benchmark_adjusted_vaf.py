@@ -0,0 +1,157 @@
+import os
+import sys
+import json
+import time
+import argparse
+import warnings
+import numpy as np
+import pandas as pd
+
+"""
+Script that checks calculate_adjusted_vaf in filter_calls.py against the row-wise implementation it replaced, and times both.
+The vectorized version must give the same value, bit for bit, for every row: hand-written edge cases (values that are not numeric,
+NaN, a zero denominator, non-clonal and missing clonality), then a random table of --rows rows, 1M by default, drawn from the same
+kinds of values, with the numbers as text and as float columns. The script exits with an error if any row differs, or if the
+vectorized version warns about a value, which the row-wise implementation never did.
+"""
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+from filter_calls import calculate_adjusted_vaf, parse_float
+
+# Rows that take every path of the row-wise implementation
+EDGE_CASES = [
+    # clonal, numeric values
+    {"VAF": "0.25", "tcn": "2", "expected_alt_copies": "1", "clonality": "CLONAL"},
+    {"VAF": 0.5, "tcn": 4, "expected_alt_copies": 2, "clonality": "CLONAL"},
+    {"VAF": "1e-3", "tcn": "3", "expected_alt_copies": "1", "clonality": "CLONAL"},
+    {"VAF": "0", "tcn": "2", "expected_alt_copies": "1", "clonality": "CLONAL"},
+    # zero denominator: exp + (2 - tcn) * vaf == 0
+    {"VAF": "0.5", "tcn": "4", "expected_alt_copies": "1", "clonality": "CLONAL"},
+    {"VAF": "0", "tcn": "2", "expected_alt_copies": "0", "clonality": "CLONAL"},
+    # values that are not numeric or missing
+    {"VAF": "NA", "tcn": "2", "expected_alt_copies": "1", "clonality": "CLONAL"},
+    {"VAF": "", "tcn": "2", "expected_alt_copies": "1", "clonality": "CLONAL"},
+    {"VAF": None, "tcn": "2", "expected_alt_copies": "1", "clonality": "CLONAL"},
+    {"VAF": np.nan, "tcn": "2", "expected_alt_copies": "1", "clonality": "CLONAL"},
+    {"VAF": "0.3", "tcn": "NA", "expected_alt_copies": "1", "clonality": "CLONAL"},
+    {"VAF": "0.3", "tcn": "2", "expected_alt_copies": "", "clonality": "CLONAL"},
+    {"VAF": "0.3", "tcn": np.nan, "expected_alt_copies": np.nan, "clonality": "CLONAL"},
+    # NaN or inf VAF with no copy number difference: (2 - tcn) * vaf is 0 * NaN or 0 * inf
+    {"VAF": "nan", "tcn": "2", "expected_alt_copies": "1", "clonality": "CLONAL"},
+    {"VAF": "inf", "tcn": "2", "expected_alt_copies": "1", "clonality": "CLONAL"},
+    {"VAF": np.inf, "tcn": 2, "expected_alt_copies": 1, "clonality": "CLONAL"},
+    # not clonal
+    {"VAF": "0.3", "tcn": "2", "expected_alt_copies": "1", "clonality": "SUBCLONAL"},
+    {"VAF": "0.3", "tcn": "2", "expected_alt_copies": "1", "clonality": "INDETERMINATE"},
+    {"VAF": "0.3", "tcn": "2", "expected_alt_copies": "1", "clonality": "NA"},
+    {"VAF": "0.3", "tcn": "2", "expected_alt_copies": "1", "clonality": None},
+    {"VAF": "0.3", "tcn": "2", "expected_alt_copies": "1", "clonality": np.nan},
+]
+
+def calculate_adjusted_vaf_rowwise(row):
+    """ The row-wise implementation calculate_adjusted_vaf replaced, applied with DataFrame.apply(axis=1) """
+
+    try:
+        vaf = float(row['VAF'])
+    except (ValueError, TypeError):
+        return np.nan
+
+    if row.get('clonality') == 'CLONAL':
+        try:
+            t = float(row['tcn'])
+            exp = float(row['expected_alt_copies'])
+            ncn = 2
+            # adj_vaf = (n* vaf_value) / (exp + (n - t))
+            adj_vaf = ( vaf * ncn ) / (exp + (ncn - t) * vaf )
+            return adj_vaf
+        except (ValueError, TypeError, ZeroDivisionError):
+            return np.nan
+
+    else:
+        return np.nan
+
+def make_variant_table(n_rows, seed=1):
+    """
+    Make a table of n_rows variants with the columns calculate_adjusted_vaf reads, as strings like in the merged MAFs.
+    About a tenth of each column is missing or not numeric, and a fifth of the clonal rows have a zero denominator.
+    """
+
+    rng = np.random.default_rng(seed)
+    vaf = rng.integers(0, 1000, n_rows) / 1000
+    tcn = rng.integers(0, 8, n_rows)
+    exp = rng.integers(0, 4, n_rows).astype("float64")
+
+    # make the denominator zero: exp = (tcn - 2) * vaf
+    zero = rng.random(n_rows) < 0.2
+    exp[zero] = (tcn[zero] - 2) * vaf[zero]
+
+    variants_df = pd.DataFrame({
+        "VAF": vaf.astype(str),
+        "tcn": tcn.astype(str),
+        "expected_alt_copies": exp.astype(str),
+        "clonality": rng.choice(["CLONAL", "CLONAL", "CLONAL", "SUBCLONAL", "INDETERMINATE", "NA"], n_rows),
+    })
+    for col in ["VAF", "tcn", "expected_alt_copies"]:
+        variants_df.loc[rng.random(n_rows) < 0.05, col] = "NA"
+        variants_df.loc[rng.random(n_rows) < 0.05, col] = ""
+    return variants_df
+
+def count_differences(expected, actual):
+    """ Count the rows where two adjusted VAF columns differ, with NaN equal to NaN """
+    expected = expected.to_numpy(dtype="float64")
+    actual = actual.to_numpy(dtype="float64")
+    same = (expected == actual) | (np.isnan(expected) & np.isnan(actual))
+    return int((~same).sum())
+
+def compare(variants_df):
+    """ Run both implementations on a table. Returns the number of rows that differ and the seconds each implementation took. """
+
+    start = time.perf_counter()
+    expected = variants_df.apply(calculate_adjusted_vaf_rowwise, axis=1).astype("float64")
+    rowwise_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = calculate_adjusted_vaf(variants_df)
+    vectorized_seconds = time.perf_counter() - start
+
+    return count_differences(expected, actual), rowwise_seconds, vectorized_seconds
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the vectorized adjusted VAF against the row-wise implementation, and time both.")
+    parser.add_argument("--rows", type=int, default=1000000, help="Number of rows of the random table.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", required=False, help="JSON file to write the results to.")
+    args = parser.parse_args()
+
+    # a numpy warning, e.g. "invalid value encountered in multiply", fails the check
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", RuntimeWarning)
+        edge_differences, _, _ = compare(pd.DataFrame(EDGE_CASES))
+        variants_df = make_variant_table(args.rows, args.seed)
+        differences, rowwise_seconds, vectorized_seconds = compare(variants_df)
+
+        # the same table with float columns, as read_csv returns them from the merged MAFs and FACETS files
+        for col in ["VAF", "tcn", "expected_alt_copies"]:
+            variants_df[col] = variants_df[col].map(parse_float)
+        float_differences, float_rowwise_seconds, float_vectorized_seconds = compare(variants_df)
+
+    results = {
+        "rows": args.rows,
+        "edge_case_differences": edge_differences,
+        "differences": differences,
+        "float_differences": float_differences,
+        "seconds": {"rowwise": rowwise_seconds, "vectorized": vectorized_seconds, "rowwise_float": float_rowwise_seconds, "vectorized_float": float_vectorized_seconds},
+    }
+
+    print(f"[INFO] {edge_differences} of {len(EDGE_CASES)} edge cases differ from the row-wise implementation.")
+    print(f"[INFO] {differences} of {args.rows} random rows differ from the row-wise implementation, {float_differences} with float columns.")
+    print(f"[INFO] text columns: row-wise {rowwise_seconds:.2f}s, vectorized {vectorized_seconds:.2f}s")
+    print(f"[INFO] float columns: row-wise {float_rowwise_seconds:.2f}s, vectorized {float_vectorized_seconds:.2f}s")
+
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(results, out, indent=4)
+
+    if edge_differences or differences or float_differences:
+        print("[ERROR] The vectorized adjusted VAF differs from the row-wise implementation.")
+        sys.exit(1)
@@ -0,0 +1,233 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import subprocess
+import pandas as pd
+import pysam
+
+"""
+Script that benchmarks the genotyping engines on synthetic BAMs: pileup_genotyper.py and, if its binary is given with --gbcms,
+genotype_variants with GetBaseCountsMultiSample. It writes a reference, an all calls maf of SNVs, insertions and deletions, and
+a standard, duplex and simplex BAM per sample with read pairs of known alleles at every site, some of them duplicates or with
+overlapping mates. The counts of pileup_genotyper.py are checked against the known counts, and the two engines against each other.
+"""
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+import pileup_genotyper
+from generate_maf import CALL_COLUMNS
+from genotype_variants_input import BAM_COLS
+
+CHROMOSOME = "1"
+READ_LENGTH = 100
+SITE_SPACING = 1000
+
+def make_genotyping_data(output_dir, n_samples=4, n_sites=1000, depth=200, seed=1):
+    """
+    Write the synthetic reference, all calls maf, BAMs and genotyping input table to output_dir.
+    Returns the path of the table and the expected counts of each BAM, as a dictionary of bam -> list of count dictionaries per site.
+    """
+
+    rng = random.Random(seed)
+    output_dir = os.path.abspath(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+
+    reference = "".join(rng.choice("ACGT") for _ in range((n_sites + 2) * SITE_SPACING))
+    fasta_path = os.path.join(output_dir, "reference.fasta")
+    with open(fasta_path, "w") as fasta:
+        fasta.write(f">{CHROMOSOME}\n" + "\n".join(reference[i:i + 80] for i in range(0, len(reference), 80)) + "\n")
+    pysam.faidx(fasta_path)
+
+    sites = [make_site(rng, reference, (i + 1) * SITE_SPACING) for i in range(n_sites)]
+    maf_path = os.path.join(output_dir, "synthetic_all_small_calls.maf")
+    calls = pd.DataFrame([{**dict.fromkeys(CALL_COLUMNS, ""), **site["maf"]} for site in sites], columns=CALL_COLUMNS)
+    calls.to_csv(maf_path, sep="\t", index=False)
+
+    rows, expected = [], {}
+    for i in range(n_samples):
+        sample_id = f"C-SYN{i:03d}-L001-d"
+        row = {"patient_id": "NA", "sample_id": sample_id, "standard_bam": "", "duplex_bam": "", "simplex_bam": "", "maf": maf_path}
+        for col in BAM_COLS:
+            bam_path = os.path.join(output_dir, f"{sample_id}-{col}.bam")
+            expected[bam_path] = write_bam(rng, bam_path, reference, sites, depth)
+            row[col] = bam_path
+        rows.append(row)
+
+    table_path = os.path.join(output_dir, "synthetic_genotyping_input.tsv")
+    pd.DataFrame(rows).to_csv(table_path, sep="\t", index=False)
+    return table_path, fasta_path, expected
+
+def make_site(rng, reference, position):
+    """ Make a SNV, insertion or deletion at a 1-based position, with the maf fields of the site. """
+
+    kind = rng.choice(["SNV", "SNV", "INS", "DEL"])
+    if kind == "SNV":
+        ref = reference[position - 1]
+        alt = rng.choice([base for base in "ACGT" if base != ref])
+        start, end, ref_allele, alt_allele = position, position, ref, alt
+    elif kind == "INS":
+        alt = "".join(rng.choice("ACGT") for _ in range(rng.randint(1, 5)))
+        start, end, ref_allele, alt_allele = position, position + 1, "-", alt
+    else:
+        length = rng.randint(1, 5)
+        start, end, ref_allele, alt_allele = position, position + length - 1, reference[position - 1:position - 1 + length], "-"
+
+    maf = {"Hugo_Symbol": "SYN", "Chromosome": CHROMOSOME, "Start_Position": start, "End_Position": end,
+           "Reference_Allele": ref_allele, "Tumor_Seq_Allele1": ref_allele, "Tumor_Seq_Allele2": alt_allele,
+           "Tumor_Sample_Barcode": "SYNTHETIC", "Variant_Classification": "Missense_Mutation"}
+    return {"kind": kind, "position": position, "ref": ref_allele, "alt": alt_allele, "maf": maf, "vaf": rng.choice([0.0, 0.01, 0.05, 0.2, 0.5])}
+
+def write_bam(rng, bam_path, reference, sites, depth):
+    """ Write a sorted and indexed BAM with depth fragments at every site. Returns the expected counts of each site. """
+
+    header = {"HD": {"VN": "1.6", "SO": "unsorted"}, "SQ": [{"SN": CHROMOSOME, "LN": len(reference)}]}
+    unsorted_path = bam_path + ".unsorted.bam"
+    expected = []
+
+    with pysam.AlignmentFile(unsorted_path, "wb", header=header) as bam:
+        for site_index, site in enumerate(sites):
+            counts = dict.fromkeys(pileup_genotyper.COUNT_NAMES, 0)
+            for fragment_index in range(depth):
+                is_alt = rng.random() < site["vaf"]
+                is_duplicate = rng.random() < 0.1
+                overlapping_mates = rng.random() < 0.3
+                name = f"s{site_index}f{fragment_index}"
+
+                # the first read always covers the site, its mate only if the mates overlap
+                offset = rng.randint(10, READ_LENGTH - 20)
+                read_start = site["position"] - 1 - offset
+                mate_start = read_start + rng.randint(0, 5) if overlapping_mates else read_start + 400
+                reads = [make_read(name, read_start, reference, site, is_alt, True), make_read(name, mate_start, reference, site, is_alt and overlapping_mates, False)]
+                reads[0].next_reference_start, reads[1].next_reference_start = reads[1].reference_start, reads[0].reference_start
+
+                for read in reads:
+                    read.is_duplicate = is_duplicate
+                    bam.write(read)
+
+                if not is_duplicate:
+                    allele = "alt" if is_alt else "ref"
+                    n_reads = 2 if overlapping_mates else 1
+                    counts[f"{allele}_count"] += n_reads
+                    counts["total_count"] += n_reads
+                    counts[f"{allele}_count_fragment"] += 1
+                    counts["total_count_fragment"] += 1
+            expected.append(counts)
+
+    pysam.sort("-o", bam_path, unsorted_path)
+    pysam.index(bam_path)
+    os.remove(unsorted_path)
+    return expected
+
+def make_read(name, start, reference, site, is_alt, is_read1):
+    """ Make a read of READ_LENGTH bases from a 0-based start, carrying the alternate allele of the site if is_alt. """
+
+    read = pysam.AlignedSegment()
+    read.query_name = name
+    read.reference_id = 0
+    read.reference_start = start
+    read.mapping_quality = 60
+    read.is_paired = True
+    read.is_read1 = is_read1
+    read.is_read2 = not is_read1
+    read.next_reference_id = 0
+
+    # bases of the read before the site: up to the site for substitutions and deletions, up to and including the anchor base for insertions
+    site_offset = site["position"] - 1 - start + (1 if site["kind"] == "INS" else 0)
+    if not is_alt:
+        sequence, cigar = reference[start:start + READ_LENGTH], [(0, READ_LENGTH)]
+    elif site["kind"] == "SNV":
+        sequence = reference[start:start + site_offset] + site["alt"] + reference[start + site_offset + 1:start + READ_LENGTH]
+        cigar = [(0, READ_LENGTH)]
+    elif site["kind"] == "INS":
+        inserted = site["alt"]
+        after = READ_LENGTH - site_offset - len(inserted)
+        sequence = reference[start:start + site_offset] + inserted + reference[start + site_offset:start + site_offset + after]
+        cigar = [(0, site_offset), (1, len(inserted)), (0, after)]
+    else:
+        deleted = len(site["ref"])
+        after = READ_LENGTH - site_offset
+        sequence = reference[start:start + site_offset] + reference[start + site_offset + deleted:start + site_offset + deleted + after]
+        cigar = [(0, site_offset), (2, deleted), (0, after)]
+
+    read.query_sequence = sequence
+    read.cigartuples = cigar
+    read.query_qualities = pysam.qualitystring_to_array("I" * len(sequence))
+    return read
+
+def check_counts(table_path, expected, output_dir):
+    """ Compare the genotyped mafs of pileup_genotyper.py to the known counts. Returns the number of sites with a wrong count. """
+
+    table = pd.read_csv(table_path, sep="\t", dtype=str, keep_default_na=False)
+    n_wrong = 0
+    for row in table.itertuples(index=False):
+        for maf_suffix, count_suffix, bams in [("ORG-STD", "standard", [row.standard_bam]), ("SIMPLEX-DUPLEX", "simplex_duplex", [row.duplex_bam, row.simplex_bam])]:
+            genotyped = pd.read_csv(os.path.join(output_dir, f"{row.sample_id}-{maf_suffix}_genotyped.maf"), sep="\t")
+            genotyped = genotyped.sort_values("Start_Position").reset_index(drop=True)
+            for count_name in pileup_genotyper.COUNT_NAMES:
+                truth = sum(pd.Series([counts[count_name] for counts in expected[bam]]) for bam in bams)
+                n_wrong += int((genotyped[pileup_genotyper.get_count_column(count_name, count_suffix)] != truth).sum())
+    return n_wrong
+
+def run_gbcms(table_path, fasta_path, gbcms, threads, output_dir):
+    """ Genotype the table with genotype_variants and GetBaseCountsMultiSample in output_dir. Returns the wall time. """
+
+    os.makedirs(output_dir, exist_ok=True)
+    start = time.perf_counter()
+    subprocess.run(
+        ["genotype_variants", "small_variants", "multiple-samples", "-i", table_path, "-r", fasta_path, "--filter-duplicate", "1", "-g", gbcms, "-t", str(threads)],
+        cwd=output_dir, check=True, stdout=subprocess.DEVNULL
+    )
+    return time.perf_counter() - start
+
+def compare_engines(table_path, pileup_dir, gbcms_dir):
+    """ Count the sites where the alt and total counts of the two engines differ, for each genotyped maf and count column. """
+
+    table = pd.read_csv(table_path, sep="\t", dtype=str, keep_default_na=False)
+    differences = {}
+    for row in table.itertuples(index=False):
+        for maf_suffix, count_suffix in [("ORG-STD", "standard"), ("SIMPLEX-DUPLEX", "fragment_simplex_duplex")]:
+            name = f"{row.sample_id}-{maf_suffix}_genotyped.maf"
+            pileup = pd.read_csv(os.path.join(pileup_dir, name), sep="\t").sort_values("Start_Position").reset_index(drop=True)
+            gbcms = pd.read_csv(os.path.join(gbcms_dir, name), sep="\t").sort_values("Start_Position").reset_index(drop=True)
+            for count in ["alt", "total"]:
+                column = f"t_{count}_count_{count_suffix}"
+                differences[f"{name}:{column}"] = int((pileup[column] != gbcms[column]).sum())
+    return differences
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the genotyping engines on synthetic BAMs.")
+    parser.add_argument("--work_dir", required=True)
+    parser.add_argument("--samples", type=int, default=4)
+    parser.add_argument("--sites", type=int, default=1000)
+    parser.add_argument("--depth", type=int, default=200, help="Number of fragments at every site of every BAM.")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--gbcms", required=False, help="Path of the GetBaseCountsMultiSample binary, to also run genotype_variants.")
+    parser.add_argument("--output", required=False, help="JSON file to write the results to.")
+    args = parser.parse_args()
+
+    table_path, fasta_path, expected = make_genotyping_data(args.work_dir, args.samples, args.sites, args.depth, args.seed)
+    results = {"samples": args.samples, "sites": args.sites, "depth": args.depth, "workers": args.workers, "seconds": {}}
+
+    for workers in sorted({1, args.workers}):
+        pileup_dir = os.path.join(args.work_dir, f"pileup_{workers}")
+        start = time.perf_counter()
+        pileup_genotyper.genotype_input_table(table_path, workers=workers, output_dir=pileup_dir)
+        results["seconds"][f"pileup_genotyper_{workers}_workers"] = time.perf_counter() - start
+
+    results["wrong_counts"] = check_counts(table_path, expected, pileup_dir)
+
+    if args.gbcms:
+        gbcms_dir = os.path.join(args.work_dir, "gbcms")
+        results["seconds"][f"genotype_variants_{args.workers}_threads"] = run_gbcms(table_path, fasta_path, args.gbcms, args.workers, gbcms_dir)
+        results["engine_differences"] = compare_engines(table_path, pileup_dir, gbcms_dir)
+
+    for name, seconds in results["seconds"].items():
+        print(f"[INFO] {name:<35} {seconds:>8.2f}s")
+    print(f"[INFO] {results['wrong_counts']} counts of pileup_genotyper.py differ from the known counts.")
+
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(results, out, indent=4)
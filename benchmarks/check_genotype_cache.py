@@ -0,0 +1,150 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import pandas as pd
+
+"""
+Script that checks the genotype cache end to end, the way GENOTYPE_VARIANTS_INPUT and MERGE_GENOTYPED_MAFS use it, on a sample
+with empty BAM files and a small all calls maf. Genotyping is simulated by giving every site known counts.
+- A first run genotypes every site and fills the cache.
+- After the calls are re-annotated and a variant is added, only the new variant is genotyped. The merged maf has the cached
+  counts of the other variants with the new annotation.
+- Another genotyping engine, another reference or a changed BAM miss the cache.
+- Calls at the same site with another annotation, e.g. a research and a clinical call, give the same merged maf with and
+  without the cache.
+The script exits with an error if a check fails.
+"""
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+import genotype_cache
+from genotype_variants_input import plan_cached_genotypes, get_site_order
+from merge_genotyped_mafs import merge_genotyped_mafs
+
+SAMPLE_ID = "C-CACHE1-L001-d"
+COMBINED_ID = "C-CACHE1"
+MAF_SUFFIX = "-SIMPLEX-DUPLEX_genotyped.maf"
+COUNT_COLS = ["t_alt_count_fragment_simplex_duplex", "t_total_count_fragment_simplex_duplex"]
+
+def make_calls(sites):
+    """ All calls maf of the given (position, Hugo_Symbol) or (position, Hugo_Symbol, Variant_Classification) sites. """
+    return pd.DataFrame([
+        {"Hugo_Symbol": site[1], "Chromosome": "1", "Start_Position": str(site[0]), "End_Position": str(site[0]),
+         "Variant_Classification": site[2] if len(site) > 2 else "Missense_Mutation", "Reference_Allele": "C", "Tumor_Seq_Allele2": "T",
+         "Tumor_Sample_Barcode": "C-CACHE1-T001-d"}
+        for site in sites
+    ])
+
+def genotype(calls, rows):
+    """ Simulate genotyping the given rows of the calls: the alt count of a site is its position modulo 100. """
+    genotyped = calls.iloc[rows].copy() if rows is not None else calls.copy()
+    genotyped["Tumor_Sample_Barcode"] = SAMPLE_ID
+    genotyped[COUNT_COLS[0]] = (genotyped["Start_Position"].astype(int) % 100).astype(str)
+    genotyped[COUNT_COLS[1]] = "100"
+    return genotyped
+
+def run(work_dir, cache_dir, bam_paths, calls, genotyper_key):
+    """
+    Plan the cached genotypes of the sample, genotype the sites that are not cached and merge them with the cache.
+    Returns the number of sites that were genotyped and the merged genotyped maf.
+    """
+
+    run_dir = tempfile.mkdtemp(dir=work_dir)
+    os.chdir(run_dir)
+    all_calls_maf = os.path.join(run_dir, f"{COMBINED_ID}_all_small_calls.maf")
+    calls.to_csv(all_calls_maf, sep="\t", index=False)
+
+    bam_paths_df = pd.DataFrame([{"sample_id": SAMPLE_ID, "standard_bam": "NA", "duplex_bam": bam_paths[0], "simplex_bam": bam_paths[1]}])
+    sample_rows = plan_cached_genotypes(bam_paths_df, calls, all_calls_maf, COMBINED_ID, cache_dir, genotyper_key)
+    rows = sample_rows[SAMPLE_ID]
+
+    shard_dir = os.path.join(run_dir, "shard_1")
+    os.makedirs(shard_dir)
+    genotype(calls, rows).to_csv(os.path.join(shard_dir, f"{SAMPLE_ID}{MAF_SUFFIX}"), sep="\t", index=False)
+
+    output_dir = os.path.join(run_dir, "merged")
+    merge_genotyped_mafs([os.path.join(shard_dir, f"{SAMPLE_ID}{MAF_SUFFIX}")], output_dir, f"{COMBINED_ID}_genotype_cache_plan.tsv", cache_dir)
+    merged = pd.read_csv(os.path.join(output_dir, f"{SAMPLE_ID}{MAF_SUFFIX}"), sep="\t", dtype=str, keep_default_na=False)
+
+    return len(calls) if rows is None else len(rows), merged
+
+def check(failures, name, condition):
+    print(f"[INFO] {'ok    ' if condition else 'FAILED'} {name}")
+    if not condition:
+        failures.append(name)
+
+def check_genotype_cache(work_dir):
+    """ Run the checks in work_dir. Returns the names of the checks that failed. """
+
+    work_dir = os.path.abspath(work_dir)
+    cache_dir = os.path.join(work_dir, "genotype_cache")
+    os.makedirs(work_dir, exist_ok=True)
+
+    # empty BAMs with their index, the cache only looks at their path, size and mtime
+    bam_paths = []
+    for bam_type in ["duplex", "simplex"]:
+        bam_path = os.path.join(work_dir, f"{SAMPLE_ID}-{bam_type}.bam")
+        for path in [bam_path, bam_path + ".bai"]:
+            open(path, "w").close()
+        bam_paths.append(bam_path)
+
+    fasta_ref = os.path.join(work_dir, "reference.fasta")
+    with open(fasta_ref, "w") as fasta:
+        fasta.write(">1\nACGT\n")
+
+    failures = []
+    gbcms_key = genotype_cache.get_genotyper_key("gbcms", fasta_ref)
+
+    calls = make_calls([(1001, "GENE1"), (1002, "GENE2"), (1003, "GENE3")])
+    n_genotyped, merged = run(work_dir, cache_dir, bam_paths, calls, gbcms_key)
+    check(failures, "first run genotypes every site", n_genotyped == 3 and len(merged) == 3)
+
+    # re-annotate a variant and add a new one
+    calls = make_calls([(1001, "GENE1_RENAMED"), (1002, "GENE2"), (1003, "GENE3"), (1004, "GENE4")])
+    n_genotyped, merged = run(work_dir, cache_dir, bam_paths, calls, gbcms_key)
+    check(failures, "second run only genotypes the new site", n_genotyped == 1)
+    check(failures, "merged maf has every site", merged["Start_Position"].tolist() == ["1001", "1002", "1003", "1004"])
+    check(failures, "cached rows take the current annotation", merged["Hugo_Symbol"].tolist() == ["GENE1_RENAMED", "GENE2", "GENE3", "GENE4"])
+    check(failures, "cached rows keep their counts", merged[COUNT_COLS[0]].tolist() == ["1", "2", "3", "4"])
+
+    n_genotyped, _ = run(work_dir, cache_dir, bam_paths, calls, genotype_cache.get_genotyper_key("pysam", fasta_ref))
+    check(failures, "another engine misses the cache", n_genotyped == 4)
+
+    other_fasta = os.path.join(work_dir, "other_reference.fasta")
+    with open(other_fasta, "w") as fasta:
+        fasta.write(">1\nACGT\n")
+    n_genotyped, _ = run(work_dir, cache_dir, bam_paths, calls, genotype_cache.get_genotyper_key("gbcms", other_fasta))
+    check(failures, "another reference misses the cache", n_genotyped == 4)
+
+    # a re-processed BAM has a new mtime
+    bam_stat = os.stat(bam_paths[0])
+    os.utime(bam_paths[0], ns=(bam_stat.st_atime_ns, bam_stat.st_mtime_ns + 1000000000))
+    n_genotyped, _ = run(work_dir, cache_dir, bam_paths, calls, gbcms_key)
+    check(failures, "a changed BAM misses the cache", n_genotyped == 4)
+
+    # a research and a clinical call at the same site, annotated differently, are two rows of the uncached maf
+    calls = make_calls([(1001, "GENE1"), (1001, "GENE1", "Intron"), (1002, "GENE2"), (1002, "GENE2B")])
+    uncached = genotype(calls, None)
+    uncached = uncached.iloc[get_site_order(uncached)].reset_index(drop=True)
+    shared_cache_dir = os.path.join(work_dir, "shared_site_cache")
+    _, merged = run(work_dir, shared_cache_dir, bam_paths, calls, gbcms_key)
+    check(failures, "calls sharing a site match the uncached maf on the first run", merged.equals(uncached))
+    n_genotyped, merged = run(work_dir, shared_cache_dir, bam_paths, calls, gbcms_key)
+    check(failures, "calls sharing a site match the uncached maf from the cache", n_genotyped == 0 and merged.equals(uncached))
+
+    return failures
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the genotype cache hit and miss paths.")
+    parser.add_argument("--work_dir", required=False, help="Directory to run the checks in, a temporary directory if not given.")
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="genotype_cache_check_")
+    start = time.perf_counter()
+    failures = check_genotype_cache(work_dir)
+    print(f"[INFO] Checks ran in {time.perf_counter() - start:.2f}s in {work_dir}.")
+
+    if failures:
+        print(f"[ERROR] {len(failures)} genotype cache checks failed.")
+        sys.exit(1)
@@ -0,0 +1,100 @@
+import os
+import sys
+import glob
+import json
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+from contextlib import redirect_stdout
+
+"""
+Script that checks infer_samples.py --registry on a synthetic cohort from make_synthetic_cohort.py whose id mapping file lists a
+patient twice. infer_samples.py must keep the patient once, the registry must have every patient, the patient JSONs exported from
+the registry must be the same as the ones infer_samples.py wrote, and a registry that fails to write must not leave a partial file.
+The script exits with an error if a check fails.
+"""
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "..", "bin"))
+import infer_samples
+import sample_registry
+
+def check(failures, name, condition):
+    print(f"[INFO] {'ok    ' if condition else 'FAILED'} {name}")
+    if not condition:
+        failures.append(name)
+
+def check_sample_registry(work_dir, n_patients=20):
+    """ Run the checks in work_dir. Returns the names of the checks that failed. """
+
+    work_dir = os.path.abspath(work_dir)
+    cohort_dir = os.path.join(work_dir, "cohort")
+    subprocess.run([sys.executable, os.path.join(BENCHMARKS_DIR, "make_synthetic_cohort.py"), "--output_dir", cohort_dir, "--patients", str(n_patients)], check=True, stdout=subprocess.DEVNULL)
+    with open(os.path.join(cohort_dir, "cohort.json")) as cohort_file:
+        cohort = json.load(cohort_file)
+
+    # list the first patient twice
+    with open(cohort['id_mapping_file']) as id_file:
+        lines = id_file.read().splitlines()
+    id_mapping_file = os.path.join(work_dir, "id_mapping_duplicated.csv")
+    with open(id_mapping_file, "w") as id_file:
+        id_file.write("\n".join(lines + [lines[1]]) + "\n")
+
+    failures = []
+    infer_dir = os.path.join(work_dir, "infer_samples")
+    os.makedirs(infer_dir, exist_ok=True)
+    os.chdir(infer_dir)
+    registry = os.path.join(infer_dir, "sample_registry.sqlite")
+    try:
+        with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+            infer_samples.get_all_samples(
+                id_mapping_file, cohort['research_access_bam_dir_template'], cohort['clinical_access_key_file'], cohort['clinical_impact_key_file'],
+                None, None, cohort['clinical_access_sample_regex_pattern'], cohort['clinical_impact_sample_regex_pattern'], registry=registry
+            )
+        written = True
+    except sqlite3.Error as e:
+        print(f"[ERROR] {e}")
+        written = False
+    check(failures, "a patient listed twice is written to the registry", written)
+    if not written:
+        return failures
+
+    patient_jsons = sorted(glob.glob(os.path.join(infer_dir, "*_all_samples.json")))
+    registered = sample_registry.load_patients(registry)
+    check(failures, "the registry has every patient once", len(registered) == n_patients == len(patient_jsons))
+
+    export_dir = os.path.join(work_dir, "exported")
+    os.makedirs(export_dir, exist_ok=True)
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        sample_registry.export_patient_jsons(registry, export_dir)
+    same = True
+    for patient_json in patient_jsons:
+        exported = os.path.join(export_dir, os.path.basename(patient_json))
+        with open(patient_json) as written_file, open(exported) as exported_file:
+            same &= written_file.read() == exported_file.read()
+    check(failures, "exported patient JSONs match the written ones", same)
+
+    # writing the same patient twice fails, and the partial registry is removed
+    patient = (registered[next(iter(registered))], {})
+    failed_registry = os.path.join(work_dir, "failed", "sample_registry.sqlite")
+    os.makedirs(os.path.dirname(failed_registry), exist_ok=True)
+    try:
+        sample_registry.write_registry(failed_registry, [patient, patient])
+        raised = False
+    except sqlite3.IntegrityError:
+        raised = True
+    check(failures, "a failed registry leaves no files", raised and not os.listdir(os.path.dirname(failed_registry)))
+
+    return failures
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check the sample registry of infer_samples.py.")
+    parser.add_argument("--work_dir", required=False, help="Directory to run the checks in, a temporary directory if not given.")
+    parser.add_argument("--patients", type=int, default=20)
+    args = parser.parse_args()
+
+    failures = check_sample_registry(args.work_dir or tempfile.mkdtemp(prefix="sample_registry_check_"), args.patients)
+    if failures:
+        print(f"[ERROR] {len(failures)} sample registry checks failed.")
+        sys.exit(1)
@@ -0,0 +1,296 @@
+import os
+import json
+import random
+import argparse
+
+"""
+Script that fabricates a synthetic cohort with the layout and file formats the bin/ scripts expect, to benchmark them at any scale.
+Writes the id mapping csv, the clinical access and impact key files, research and clinical BAM directory trees with empty BAM/BAI stubs,
+research mafs and the clinical mutations file, a FACETS archive with fits and manifests, and genotyped mafs for every sample.
+The paths and templates of the cohort are written to cohort.json in the output directory, which run_benchmarks.py reads.
+
+Every patient has a pool of variant sites that its research and clinical calls, genotyped mafs and FACETS fits are drawn from,
+so the calls overlap between samples the way they do in real patients. The same seed always gives the same cohort.
+"""
+
+# Columns of the research and clinical mafs, with extra columns so the files are about as wide as real mafs
+MAF_COLUMNS = [
+    'Hugo_Symbol', 'Entrez_Gene_Id', 'Center', 'NCBI_Build', 'Chromosome', 'Start_Position', 'End_Position', 'Strand',
+    'Variant_Classification', 'Variant_Type', 'Reference_Allele', 'Tumor_Seq_Allele1', 'Tumor_Seq_Allele2',
+    'Tumor_Sample_Barcode', 'Matched_Norm_Sample_Barcode', 'Mutation_Status', 'Status', 'HGVSc', 'HGVSp', 'HGVSp_Short',
+    't_ref_count', 't_alt_count', 'n_ref_count', 'n_alt_count'
+] + [f'annotation_{i}' for i in range(20)]
+
+# Columns of the genotyped mafs, the variant columns and the read counts of both read types
+GENOTYPED_COLUMNS = [
+    'Hugo_Symbol', 'Chromosome', 'Start_Position', 'End_Position', 'Variant_Classification', 'Reference_Allele', 'Tumor_Seq_Allele2',
+    'Tumor_Sample_Barcode', 't_alt_count_fragment_simplex_duplex', 't_total_count_fragment_simplex_duplex',
+    't_alt_count_standard', 't_total_count_standard'
+]
+
+# Columns of the FACETS ccf.maf files
+CCF_COLUMNS = [
+    'Hugo_Symbol', 'Chromosome', 'Start_Position', 'End_Position', 'Variant_Classification', 'Reference_Allele', 'Tumor_Seq_Allele2',
+    'Tumor_Sample_Barcode', 'clonality', 'tcn', 'expected_alt_copies', 'ccf_expected_copies'
+]
+
+GENES = ['TP53', 'EGFR', 'KRAS', 'BRAF', 'PIK3CA', 'APC', 'PTEN', 'ARID1A', 'KMT2D', 'RP11-356O9.1', 'ATM', 'NOTCH1', 'SMAD4', 'CDKN2A']
+CLASSIFICATIONS = ['Missense_Mutation', 'Missense_Mutation', 'Nonsense_Mutation', 'Frame_Shift_Del', 'Silent', 'Intron', 'Splice_Site']
+CHROMOSOMES = [str(c) for c in range(1, 23)] + ['X']
+
+RESEARCH_BAM_SUFFIXES = {
+    'duplex': '_cl_aln_srt_MD_IR_FX_BR__aln_srt_IR_FX-duplex.bam',
+    'simplex': '_cl_aln_srt_MD_IR_FX_BR__aln_srt_IR_FX-simplex.bam',
+    'unfilter': '_cl_aln_srt_MD_IR_FX_BR__aln_srt_IR_FX.bam',
+}
+
+def make_cohort(output_dir, n_patients, seed=1, variants_per_patient=30, research_samples=3, clinical_mutation_rows=0):
+    """
+    Write a synthetic cohort of n_patients patients to output_dir and return the cohort description.
+    variants_per_patient: size of the variant site pool of each patient
+    research_samples: maximum number of research tumor samples of a patient
+    clinical_mutation_rows: extra rows of patients outside the cohort in the clinical mutations file, so it is as large as a real one
+    """
+
+    rng = random.Random(seed)
+    output_dir = os.path.abspath(output_dir)
+    cohort = get_cohort_paths(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+
+    patients = [make_patient(rng, i, variants_per_patient, research_samples) for i in range(1, n_patients + 1)]
+
+    write_id_mapping(patients, cohort['id_mapping_file'])
+    write_key_files(patients, cohort['clinical_access_key_file'], cohort['clinical_impact_key_file'])
+    write_bam_stubs(patients, output_dir)
+    write_research_mafs(rng, patients, cohort['research_mutations_maf_template'])
+    write_clinical_mutations(rng, patients, cohort['dmp_mutations_file'], clinical_mutation_rows)
+    write_facets_archive(rng, patients, cohort['facets_dir'])
+    write_genotyped_mafs(rng, patients, cohort['genotyped_dir'])
+
+    cohort['n_patients'] = n_patients
+    cohort['seed'] = seed
+    with open(os.path.join(output_dir, "cohort.json"), "w") as out:
+        json.dump(cohort, out, indent=4)
+
+    print(f"[INFO] Synthetic cohort of {n_patients} patients written to {output_dir}.")
+    return cohort
+
+def get_cohort_paths(output_dir):
+    """ Paths and templates of a synthetic cohort, laid out like the production directories in nextflow.config. """
+
+    research_bam_dir = f"{output_dir}/bams/research/{{cmo_patient_id}}/{{sample_id}}/current"
+    access_bam_dir = f"{output_dir}/bams/clinical_access/{{anon_id_fl}}/{{anon_id_sl}}"
+    impact_bam_dir = f"{output_dir}/bams/clinical_impact/{{anon_id_fl}}/{{anon_id_sl}}"
+
+    return {
+        'id_mapping_file': f"{output_dir}/id_mapping.csv",
+        'clinical_access_key_file': f"{output_dir}/clinical_access_key.txt",
+        'clinical_impact_key_file': f"{output_dir}/clinical_impact_key.txt",
+        'clinical_access_sample_regex_pattern': ".*-XS.*-standard.*",
+        'clinical_impact_sample_regex_pattern': ".*(-IM|-IH).*",
+        'research_access_bam_dir_template': research_bam_dir,
+        'research_mutations_maf_template': f"{output_dir}/small_variants/{{cmo_patient_id}}/{{sample_id}}/current/{{sample_id}}.maf",
+        'dmp_mutations_file': f"{output_dir}/data_mutations_extended.txt",
+        'facets_dir': f"{output_dir}/facets",
+        'genotyped_dir': f"{output_dir}/genotyped",
+        'bam_templates': {
+            'research_access_duplex_bam_template': f"{research_bam_dir}/{{sample_id}}{RESEARCH_BAM_SUFFIXES['duplex']}",
+            'research_access_simplex_bam_template': f"{research_bam_dir}/{{sample_id}}{RESEARCH_BAM_SUFFIXES['simplex']}",
+            'research_access_unfilter_bam_template': f"{research_bam_dir}/{{sample_id}}{RESEARCH_BAM_SUFFIXES['unfilter']}",
+            'clinical_access_duplex_bam_template': f"{access_bam_dir}/{{anon_id}}-duplex.bam",
+            'clinical_access_simplex_bam_template': f"{access_bam_dir}/{{anon_id}}-simplex.bam",
+            'clinical_access_unfilter_bam_template': f"{access_bam_dir}/{{anon_id}}-unfilter.bam",
+            'clinical_impact_standard_bam_template': f"{impact_bam_dir}/{{anon_id}}.bam",
+        },
+    }
+
+def make_patient(rng, index, variants_per_patient, research_samples):
+    """ Make the ids, samples and variant site pool of one patient. About 10% of patients only have a cmo id and 10% only a dmp id. """
+
+    kind = rng.random()
+    cmo_id = f"C-{index:06X}" if kind > 0.1 else ""
+    dmp_id = f"P-{index:07d}" if kind < 0.1 or kind > 0.2 else ""
+
+    research = []
+    if cmo_id:
+        research = [f"{cmo_id}-L{i:03d}-d" for i in range(1, rng.randint(1, research_samples) + 1)] + [f"{cmo_id}-N001-d"]
+
+    access, impact = [], []
+    if dmp_id:
+        access = [(f"{dmp_id}-T{i:02d}-XS1", make_anon_id(rng)) for i in range(1, rng.randint(0, 2) + 1)]
+        impact = [(f"{dmp_id}-T{i:02d}-IM6", make_anon_id(rng)) for i in range(1, rng.randint(1, 2) + 1)] + [(f"{dmp_id}-N01-IM6", make_anon_id(rng))]
+
+    sites = []
+    for _ in range(variants_per_patient):
+        position = rng.randint(1, 200000000)
+        ref = rng.choice("ACGT")
+        sites.append({
+            'Hugo_Symbol': rng.choice(GENES),
+            'Chromosome': rng.choice(CHROMOSOMES),
+            'Start_Position': position,
+            'End_Position': position,
+            'Variant_Classification': rng.choice(CLASSIFICATIONS),
+            'Reference_Allele': ref,
+            'Tumor_Seq_Allele2': rng.choice([base for base in "ACGT" if base != ref]),
+        })
+
+    combined_id = f"{cmo_id}_{dmp_id}" if cmo_id and dmp_id else cmo_id or dmp_id
+    return {'combined_id': combined_id, 'cmo_id': cmo_id, 'dmp_id': dmp_id, 'research': research, 'access': access, 'impact': impact, 'sites': sites}
+
+def make_anon_id(rng):
+    return "".join(rng.choice("ABCDEFGHJKLMNPQRSTUVWXYZ") for _ in range(2)) + "".join(rng.choice("0123456789ABCDEF") for _ in range(6))
+
+def write_id_mapping(patients, id_mapping_file):
+    with open(id_mapping_file, "w") as out:
+        out.write("cmo_patient_id,dmp_patient_id\n")
+        for patient in patients:
+            out.write(f"{patient['cmo_id']},{patient['dmp_id']}\n")
+
+def write_key_files(patients, access_key_file, impact_key_file):
+    """ Write the key files, sample id and anon id per line. Clinical access anon ids carry the -standard suffix. """
+
+    with open(access_key_file, "w") as access_out, open(impact_key_file, "w") as impact_out:
+        for patient in patients:
+            for sample_id, anon_id in patient['access']:
+                access_out.write(f"{sample_id},{anon_id}-standard,ACCESS\n")
+            for sample_id, anon_id in patient['impact']:
+                impact_out.write(f"{sample_id},{anon_id},IMPACT\n")
+
+def write_bam_stubs(patients, output_dir):
+    """ Create empty BAM and BAI files for every sample, in the research and clinical BAM directory layouts. """
+
+    for patient in patients:
+        for sample_id in patient['research']:
+            bam_dir = os.path.join(output_dir, "bams", "research", patient['cmo_id'], sample_id, "current")
+            touch_bams(bam_dir, [f"{sample_id}{suffix}" for suffix in RESEARCH_BAM_SUFFIXES.values()])
+        for _, anon_id in patient['access']:
+            bam_dir = os.path.join(output_dir, "bams", "clinical_access", anon_id[0], anon_id[1])
+            touch_bams(bam_dir, [f"{anon_id}-{bam_type}.bam" for bam_type in ["duplex", "simplex", "unfilter", "standard"]])
+        for _, anon_id in patient['impact']:
+            bam_dir = os.path.join(output_dir, "bams", "clinical_impact", anon_id[0], anon_id[1])
+            touch_bams(bam_dir, [f"{anon_id}.bam"])
+
+def touch_bams(bam_dir, bam_names):
+    os.makedirs(bam_dir, exist_ok=True)
+    for bam_name in bam_names:
+        for path in [os.path.join(bam_dir, bam_name), os.path.join(bam_dir, bam_name + ".bai")]:
+            open(path, "w").close()
+
+def make_maf_row(rng, site, sample_id, mutation_status="SOMATIC", status=""):
+    row = {col: "" for col in MAF_COLUMNS}
+    row.update(site)
+    row.update({
+        'Entrez_Gene_Id': "0", 'Center': "MSKCC", 'NCBI_Build': "GRCh37", 'Strand': "+", 'Variant_Type': "SNP",
+        'Tumor_Seq_Allele1': site['Reference_Allele'], 'Tumor_Sample_Barcode': sample_id, 'Mutation_Status': mutation_status,
+        'Status': status, 'HGVSc': "c.1A>T", 'HGVSp': "p.M1L", 'HGVSp_Short': "p.M1L",
+        't_ref_count': str(rng.randint(100, 2000)), 't_alt_count': str(rng.randint(0, 200)), 'n_ref_count': str(rng.randint(100, 2000)), 'n_alt_count': "0",
+    })
+    row.update({f'annotation_{i}': "synthetic" for i in range(20)})
+    return "\t".join(str(row[col]) for col in MAF_COLUMNS) + "\n"
+
+def write_research_mafs(rng, patients, research_maf_template):
+    """ Write a maf for every research tumor sample with about half of the patient's sites, some germline and some failing QC. """
+
+    for patient in patients:
+        for sample_id in patient['research']:
+            if sample_id.split("-")[2].startswith("N"):
+                continue
+            maf_path = research_maf_template.replace("{cmo_patient_id}", patient['cmo_id']).replace("{sample_id}", sample_id)
+            os.makedirs(os.path.dirname(maf_path), exist_ok=True)
+            with open(maf_path, "w") as out:
+                out.write("\t".join(MAF_COLUMNS) + "\n")
+                for site in rng.sample(patient['sites'], len(patient['sites']) // 2):
+                    mutation_status = "GERMLINE" if rng.random() < 0.05 else "SOMATIC"
+                    status = "LowQual" if rng.random() < 0.1 else ""
+                    out.write(make_maf_row(rng, site, sample_id, mutation_status, status))
+
+def write_clinical_mutations(rng, patients, dmp_mutations_file, extra_rows=0):
+    """ Write the clinical mutations file with the sequenced samples metadata line, the rows of the cohort and extra rows of other patients. """
+
+    with open(dmp_mutations_file, "w") as out:
+        clinical_samples = [sample_id for patient in patients for sample_id, _ in patient['impact'] + patient['access']]
+        out.write(f"#sequenced_samples: {' '.join(clinical_samples)}\n")
+        out.write("\t".join(MAF_COLUMNS) + "\n")
+        for patient in patients:
+            for sample_id, _ in patient['impact'] + patient['access']:
+                if "-N" in sample_id:
+                    continue
+                for site in rng.sample(patient['sites'], len(patient['sites']) // 2):
+                    out.write(make_maf_row(rng, site, sample_id, "GERMLINE" if rng.random() < 0.05 else "SOMATIC"))
+
+        # rows of patients outside the cohort, after every patient of the cohort like in the shared production file
+        for i in range(extra_rows):
+            site = {'Hugo_Symbol': rng.choice(GENES), 'Chromosome': rng.choice(CHROMOSOMES), 'Start_Position': i + 1, 'End_Position': i + 1,
+                    'Variant_Classification': rng.choice(CLASSIFICATIONS), 'Reference_Allele': "A", 'Tumor_Seq_Allele2': "T"}
+            out.write(make_maf_row(rng, site, f"P-9{i % 100000:06d}-T01-IM6"))
+
+def write_facets_archive(rng, patients, facets_dir):
+    """
+    Write a FACETS archive: one sample directory per impact tumor sample, with a default fit and up to three alternative fits,
+    each with a ccf.maf of the patient's sites, and a facets_review.manifest with comment lines for most sample directories.
+    """
+
+    for patient in patients:
+        normals = [sample_id for sample_id, _ in patient['impact'] if "-N" in sample_id]
+        for sample_id, _ in patient['impact']:
+            if "-N" in sample_id:
+                continue
+            sample_dir_name = f"{sample_id}_{normals[0]}"
+            sample_dir = os.path.join(facets_dir, patient['dmp_id'][:7], sample_dir_name)
+            fits = ["default"] + [f"alt_diplogR_{i}" for i in range(rng.randint(0, 3))]
+
+            manifest_rows = []
+            for fit in fits:
+                fit_dir = os.path.join(sample_dir, fit)
+                os.makedirs(fit_dir, exist_ok=True)
+                with open(os.path.join(fit_dir, f"{sample_dir_name}.ccf.maf"), "w") as out:
+                    out.write("\t".join(CCF_COLUMNS) + "\n")
+                    for site in patient['sites']:
+                        values = dict(site, Tumor_Sample_Barcode=sample_id, clonality=rng.choice(["CLONAL", "SUBCLONAL", "INDETERMINATE"]),
+                                      tcn=rng.randint(1, 5), expected_alt_copies=rng.randint(0, 2), ccf_expected_copies=round(rng.random(), 3))
+                        out.write("\t".join(str(values[col]) for col in CCF_COLUMNS) + "\n")
+                open(os.path.join(fit_dir, f"{sample_dir_name}.seg"), "w").close()
+                manifest_rows.append([fit_dir, fit, rng.choice(["TRUE", "FALSE"]), rng.choice(["reviewed_best_fit", "reviewed_acceptable_fit", "not_reviewed"]),
+                                      f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"])
+
+            if rng.random() < 0.9:
+                with open(os.path.join(sample_dir, "facets_review.manifest"), "w") as out:
+                    out.write("# facets review manifest\n# generated for benchmarking\n")
+                    out.write("path\tfit_name\tfacets_qc\treview_status\tdate_reviewed\n")
+                    for row in manifest_rows:
+                        out.write("\t".join(row) + "\n")
+
+def write_genotyped_mafs(rng, patients, genotyped_dir):
+    """
+    Write the genotyped mafs of every sample at every site of its patient, in {genotyped_dir}/{combined_id}/.
+    ACCESS samples get a -SIMPLEX-DUPLEX_genotyped.maf and every sample gets a -ORG-STD_genotyped.maf, like the genotyping output.
+    """
+
+    for patient in patients:
+        patient_dir = os.path.join(genotyped_dir, patient['combined_id'])
+        os.makedirs(patient_dir, exist_ok=True)
+        samples = [(sample_id, True) for sample_id in patient['research']] + [(sample_id, True) for sample_id, _ in patient['access']]
+        samples += [(sample_id, False) for sample_id, _ in patient['impact']]
+
+        for sample_id, is_access in samples:
+            suffixes = ["-SIMPLEX-DUPLEX_genotyped.maf", "-ORG-STD_genotyped.maf"] if is_access else ["-ORG-STD_genotyped.maf"]
+            for suffix in suffixes:
+                with open(os.path.join(patient_dir, f"{sample_id}{suffix}"), "w") as out:
+                    out.write("\t".join(GENOTYPED_COLUMNS) + "\n")
+                    for site in patient['sites']:
+                        total = rng.randint(0, 3000)
+                        values = dict(site, Tumor_Sample_Barcode=sample_id, t_alt_count_fragment_simplex_duplex=rng.randint(0, total // 10 + 1),
+                                      t_total_count_fragment_simplex_duplex=total, t_alt_count_standard=rng.randint(0, total // 10 + 1), t_total_count_standard=total)
+                        out.write("\t".join(str(values[col]) for col in GENOTYPED_COLUMNS) + "\n")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fabricate a synthetic cohort to benchmark the bin/ scripts.")
+    parser.add_argument("--output_dir", required=True)
+    parser.add_argument("--patients", type=int, default=100, help="Number of patients, e.g. 10 to 10000.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--variants_per_patient", type=int, default=30, help="Size of the variant site pool of each patient.")
+    parser.add_argument("--research_samples", type=int, default=3, help="Maximum number of research tumor samples of a patient.")
+    parser.add_argument("--clinical_mutation_rows", type=int, default=0, help="Extra rows of other patients in the clinical mutations file.")
+    args = parser.parse_args()
+
+    make_cohort(args.output_dir, args.patients, args.seed, args.variants_per_patient, args.research_samples, args.clinical_mutation_rows)
@@ -0,0 +1,210 @@
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import platform
+import subprocess
+from contextlib import redirect_stdout
+
+"""
+Script that benchmarks the main function of each pipeline stage in bin/ on a synthetic cohort from make_synthetic_cohort.py.
+The stages run in pipeline order, each over every patient of the cohort, and each stage reads the outputs of the stages before it
+from the work directory. Every stage runs in its own child process, so its wall time and its own peak RSS are measured separately.
+
+Results are written as JSON. Given the JSON of an earlier run with --baseline, the script exits with an error if a stage got slower
+or used more memory than the baseline allows, so regressions are caught before they reach production.
+"""
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin")
+
+STAGES = ["infer_samples", "generate_maf", "genotype_variants_input", "facets_fit", "filter_calls"]
+
+def run_benchmarks(cohort_dir, work_dir, stages=STAGES, repeats=1):
+    """ Run each stage repeats times and keep its fastest time and its largest peak RSS. """
+
+    with open(os.path.join(cohort_dir, "cohort.json")) as cohort_file:
+        cohort = json.load(cohort_file)
+
+    results = {
+        "n_patients": cohort['n_patients'],
+        "seed": cohort['seed'],
+        "python": platform.python_version(),
+        "stages": {},
+    }
+
+    for stage in stages:
+        runs = [run_stage_process(stage, cohort_dir, work_dir) for _ in range(repeats)]
+        results["stages"][stage] = {
+            "seconds": min(run["seconds"] for run in runs),
+            "peak_rss_mb": max(run["peak_rss_mb"] for run in runs),
+            "patients": runs[0]["patients"],
+        }
+        print(f"[INFO] {stage:<25} {results['stages'][stage]['seconds']:>8.2f}s {results['stages'][stage]['peak_rss_mb']:>8.1f} MB peak RSS")
+
+    results["startup_seconds"] = measure_startup(stages, max(repeats, 3))
+    for stage, seconds in results["startup_seconds"].items():
+        print(f"[INFO] {stage:<25} {seconds:>8.2f}s start-up")
+
+    return results
+
+def measure_startup(stages, repeats=3):
+    """
+    Time access-analysis <stage> --help in a new interpreter, i.e. the start-up and imports every pipeline task of the stage pays
+    before it does any work. The fastest of repeats runs is kept.
+    """
+
+    startup = {}
+    for stage in stages:
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, os.path.join(BIN_DIR, "access-analysis"), stage, "--help"], stdout=subprocess.DEVNULL, check=True)
+            times.append(time.perf_counter() - start)
+        startup[stage] = min(times)
+    return startup
+
+def run_stage_process(stage, cohort_dir, work_dir):
+    """ Run one stage in a child process and measure the peak RSS of that process alone with os.wait4. """
+
+    result_file = os.path.join(work_dir, f"{stage}_result.json")
+    os.makedirs(work_dir, exist_ok=True)
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--stage", stage, "--cohort_dir", cohort_dir, "--work_dir", work_dir, "--result_file", result_file])
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    if process.returncode != 0:
+        raise RuntimeError(f"Stage {stage} failed with exit code {process.returncode}.")
+
+    with open(result_file) as result:
+        stage_result = json.load(result)
+
+    # ru_maxrss is in kilobytes on Linux
+    stage_result["peak_rss_mb"] = rusage.ru_maxrss / 1024
+    return stage_result
+
+def run_stage(stage, cohort_dir, work_dir):
+    """ Run the main function of a stage over every patient of the cohort, in the stage's own directory of the work directory. """
+
+    with open(os.path.join(cohort_dir, "cohort.json")) as cohort_file:
+        cohort = json.load(cohort_file)
+
+    sys.path.insert(0, BIN_DIR)
+    work_dir = os.path.abspath(work_dir)
+    stage_dir = os.path.join(work_dir, stage)
+    os.makedirs(stage_dir, exist_ok=True)
+    os.chdir(stage_dir)
+
+    patient_jsons = sorted(glob.glob(os.path.join(work_dir, "infer_samples", "*_all_samples.json")))
+    stage_function = STAGE_FUNCTIONS[stage]
+
+    # the scripts report every file they write, which is not part of what is measured
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        start = time.perf_counter()
+        n_patients = stage_function(cohort, work_dir, patient_jsons)
+        seconds = time.perf_counter() - start
+
+    return {"seconds": seconds, "patients": n_patients}
+
+def run_infer_samples(cohort, work_dir, patient_jsons):
+    import infer_samples
+    infer_samples.get_all_samples(
+        cohort['id_mapping_file'], cohort['research_access_bam_dir_template'], cohort['clinical_access_key_file'], cohort['clinical_impact_key_file'],
+        None, None, cohort['clinical_access_sample_regex_pattern'], cohort['clinical_impact_sample_regex_pattern']
+    )
+    return cohort['n_patients']
+
+def run_generate_maf(cohort, work_dir, patient_jsons):
+    import generate_maf
+    for patient_json in patient_jsons:
+        generate_maf.get_all_calls(patient_json, cohort['research_mutations_maf_template'], cohort['dmp_mutations_file'], ["RP11-"], ["Silent", "Intron"])
+    return len(patient_jsons)
+
+def run_genotype_variants_input(cohort, work_dir, patient_jsons):
+    import genotype_variants_input
+    for patient_json in patient_jsons:
+        all_calls_maf = os.path.join(work_dir, "generate_maf", f"{get_combined_id(patient_json)}_all_small_calls.maf")
+        genotype_variants_input.build_input_table(patient_json, cohort['bam_templates'], all_calls_maf)
+    return len(patient_jsons)
+
+def run_facets_fit(cohort, work_dir, patient_jsons):
+    import facets_fit
+    for patient_json in patient_jsons:
+        facets_fit.get_facets_data(cohort['facets_dir'], patient_json, None)
+    return len(patient_jsons)
+
+def run_filter_calls(cohort, work_dir, patient_jsons):
+    import filter_calls
+    for patient_json in patient_jsons:
+        combined_id = get_combined_id(patient_json)
+        genotyped_mafs = sorted(glob.glob(os.path.join(cohort['genotyped_dir'], combined_id, "*_genotyped.maf")))
+        facets_file = os.path.join(work_dir, "facets_fit", f"{combined_id}_facets_fit.txt")
+        filter_calls.generate_variant_table(patient_json, genotyped_mafs, facets_file)
+    return len(patient_jsons)
+
+STAGE_FUNCTIONS = {
+    "infer_samples": run_infer_samples,
+    "generate_maf": run_generate_maf,
+    "genotype_variants_input": run_genotype_variants_input,
+    "facets_fit": run_facets_fit,
+    "filter_calls": run_filter_calls,
+}
+
+def get_combined_id(patient_json):
+    return os.path.basename(patient_json).removesuffix("_all_samples.json")
+
+def find_regressions(results, baseline, tolerance):
+    """ Compare the time and peak RSS of each stage to a baseline run. Returns a message for each value above the baseline by more than tolerance. """
+
+    regressions = []
+    if results["n_patients"] != baseline["n_patients"] or results["seed"] != baseline["seed"]:
+        print(f"[WARNING] The baseline was run on a different cohort ({baseline['n_patients']} patients, seed {baseline['seed']}).")
+
+    for stage, stage_result in results["stages"].items():
+        baseline_stage = baseline["stages"].get(stage)
+        if baseline_stage is None:
+            continue
+        for metric in ["seconds", "peak_rss_mb"]:
+            if stage_result[metric] > baseline_stage[metric] * (1 + tolerance):
+                regressions.append(f"{stage} {metric}: {stage_result[metric]:.2f} vs baseline {baseline_stage[metric]:.2f}")
+
+    for stage, seconds in results.get("startup_seconds", {}).items():
+        baseline_seconds = baseline.get("startup_seconds", {}).get(stage)
+        if baseline_seconds is not None and seconds > baseline_seconds * (1 + tolerance):
+            regressions.append(f"{stage} start-up seconds: {seconds:.2f} vs baseline {baseline_seconds:.2f}")
+
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on a synthetic cohort.")
+    parser.add_argument("--cohort_dir", required=True, help="Output directory of make_synthetic_cohort.py.")
+    parser.add_argument("--work_dir", required=True, help="Directory for the outputs of the stages.")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="Stages to run. Later stages need the outputs of the earlier ones in the work directory.")
+    parser.add_argument("--repeats", type=int, default=1, help="Number of runs of each stage, the fastest time is kept.")
+    parser.add_argument("--output", required=False, help="JSON file to write the results to.")
+    parser.add_argument("--baseline", required=False, help="Results JSON of an earlier run to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown or memory growth over the baseline, as a fraction.")
+    parser.add_argument("--stage", required=False, help=argparse.SUPPRESS)
+    parser.add_argument("--result_file", required=False, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # child process of one stage
+    if args.stage:
+        with open(args.result_file, "w") as out:
+            json.dump(run_stage(args.stage, args.cohort_dir, args.work_dir), out)
+        sys.exit(0)
+
+    results = run_benchmarks(args.cohort_dir, args.work_dir, args.stages, args.repeats)
+
+    if args.output:
+        with open(args.output, "w") as out:
+            json.dump(results, out, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"[ERROR] Regression in {regression}")
+        if regressions:
+            sys.exit(1)
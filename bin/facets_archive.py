@@ -0,0 +1,182 @@
+import os
+import json
+import fnmatch
+import sqlite3
+import argparse
+from pathlib import Path
+
+"""
+Helper script to find the ccf.maf files of the fits in the FACETS archive with os.scandir, and to keep an index of the archive.
+The archive is laid out as {facets_dir}/{first 7 characters of the dmp id}/{sample dir}/{fit dir}/*.ccf.maf.
+A sample directory is walked once, down to FIT_DIR_DEPTH levels, instead of being globbed recursively.
+
+The index is a SQLite file with the sample directories of every patient prefix directory and the ccf.maf files of every sample directory.
+It records the mtime of every directory it listed, so a refresh only lists the directories again that changed since the last refresh.
+"""
+
+# Pattern of the ccf.maf files of a fit
+CCF_MAF_PATTERN = "*[0-9].ccf.maf"
+
+# Fits are stored in directories directly under the sample directory
+FIT_DIR_DEPTH = 1
+
+def list_entries(dir_path):
+    """ List a directory with os.scandir. Returns (name, is directory) pairs in listing order, skipping hidden entries like glob does. """
+    try:
+        with os.scandir(dir_path) as entries:
+            return [(entry.name, is_dir_entry(entry)) for entry in entries if not entry.name.startswith(".")]
+    except OSError:
+        return []
+
+def is_dir_entry(entry):
+    try:
+        return entry.is_dir()
+    except OSError:
+        return False
+
+def scan_ccf_mafs(sample_dir, max_depth=FIT_DIR_DEPTH, dir_mtimes=None):
+    """
+    Find the ccf.maf files of a sample directory and of its fit directories, up to max_depth levels down.
+    The files are returned in the order of a recursive glob: the files of a directory first, then its subdirectories in listing order.
+    If a dir_mtimes dictionary is given, the mtime of every listed directory is added to it.
+    """
+    if dir_mtimes is not None:
+        dir_mtimes[sample_dir] = get_mtime(sample_dir)
+
+    ccf_mafs = []
+    subdirs = []
+    for name, is_dir in list_entries(sample_dir):
+        if is_dir:
+            subdirs.append(name)
+        elif fnmatch.fnmatch(name, CCF_MAF_PATTERN):
+            ccf_mafs.append(os.path.join(sample_dir, name))
+
+    if max_depth > 0:
+        for name in subdirs:
+            ccf_mafs += scan_ccf_mafs(os.path.join(sample_dir, name), max_depth - 1, dir_mtimes)
+
+    return ccf_mafs
+
+def get_mtime(path):
+    """ Return the mtime of a path in nanoseconds, or None if it can't be read. """
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def connect(index_path):
+    conn = sqlite3.connect(index_path, timeout=600)
+    conn.execute("CREATE TABLE IF NOT EXISTS index_state (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS prefix_dirs (prefix TEXT PRIMARY KEY, mtime_ns INTEGER)")
+    conn.execute("CREATE TABLE IF NOT EXISTS sample_dirs (prefix TEXT, name TEXT, dir_mtimes TEXT, PRIMARY KEY (prefix, name))")
+    conn.execute("CREATE TABLE IF NOT EXISTS ccf_mafs (prefix TEXT, name TEXT, position INTEGER, relative_path TEXT)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ccf_mafs_sample ON ccf_mafs (prefix, name)")
+    return conn
+
+def refresh_archive_index(index_path, facets_dir):
+    """
+    Create or refresh the index of the FACETS archive. Patient prefix directories are only listed again if their mtime changed,
+    and sample directories are only walked again if the mtime of the sample directory or of one of its fit directories changed.
+    """
+
+    facets_root = Path(facets_dir)
+    n_scanned, n_unchanged = 0, 0
+
+    with connect(index_path) as conn:
+        state = dict(conn.execute("SELECT key, value FROM index_state"))
+        if state and state != get_index_state(facets_dir):
+            print(f"[WARNING] {index_path} was built for a different archive or depth, rebuilding it.")
+            for table in ["index_state", "prefix_dirs", "sample_dirs", "ccf_mafs"]:
+                conn.execute(f"DELETE FROM {table}")
+        conn.executemany("INSERT OR REPLACE INTO index_state VALUES (?, ?)", get_index_state(facets_dir).items())
+
+        prefix_mtimes = dict(conn.execute("SELECT prefix, mtime_ns FROM prefix_dirs"))
+        current_prefixes = [name for name, is_dir in list_entries(facets_root) if is_dir]
+
+        for prefix in current_prefixes:
+            prefix_dir = facets_root / prefix
+            indexed_samples = dict(conn.execute("SELECT name, dir_mtimes FROM sample_dirs WHERE prefix = ?", (prefix,)))
+
+            # list the prefix directory again only if sample directories were added or removed since the last refresh
+            prefix_mtime = get_mtime(prefix_dir)
+            if prefix_mtimes.get(prefix) == prefix_mtime:
+                sample_names = list(indexed_samples)
+            else:
+                sample_names = [name for name, is_dir in list_entries(prefix_dir) if is_dir]
+                for removed in set(indexed_samples) - set(sample_names):
+                    delete_sample_dir(conn, prefix, removed)
+                conn.execute("INSERT OR REPLACE INTO prefix_dirs VALUES (?, ?)", (prefix, prefix_mtime))
+
+            for name in sample_names:
+                if name in indexed_samples and not dir_mtimes_changed(json.loads(indexed_samples[name])):
+                    n_unchanged += 1
+                    continue
+                index_sample_dir(conn, prefix, name, str(prefix_dir / name))
+                n_scanned += 1
+
+        # forget the prefix directories that were removed from the archive
+        for prefix in set(prefix_mtimes) - set(current_prefixes):
+            conn.execute("DELETE FROM prefix_dirs WHERE prefix = ?", (prefix,))
+            for name, in conn.execute("SELECT name FROM sample_dirs WHERE prefix = ?", (prefix,)).fetchall():
+                delete_sample_dir(conn, prefix, name)
+
+    print(f"[INFO] {index_path} refreshed: {n_scanned} sample directories walked, {n_unchanged} unchanged.")
+
+def get_index_state(facets_dir):
+    return {"facets_dir": os.path.realpath(facets_dir), "fit_dir_depth": str(FIT_DIR_DEPTH), "ccf_maf_pattern": CCF_MAF_PATTERN}
+
+def dir_mtimes_changed(dir_mtimes):
+    """ Check if any directory listed in a walk was modified or removed since. """
+    return any(get_mtime(dir_path) != mtime for dir_path, mtime in dir_mtimes.items())
+
+def index_sample_dir(conn, prefix, name, sample_dir):
+    """ Walk a sample directory and replace its ccf.maf files in the index. """
+
+    dir_mtimes = {}
+    ccf_mafs = scan_ccf_mafs(sample_dir, dir_mtimes=dir_mtimes)
+
+    delete_sample_dir(conn, prefix, name)
+    conn.execute("INSERT INTO sample_dirs VALUES (?, ?, ?)", (prefix, name, json.dumps(dir_mtimes)))
+    conn.executemany(
+        "INSERT INTO ccf_mafs VALUES (?, ?, ?, ?)",
+        ((prefix, name, position, os.path.relpath(ccf_maf, sample_dir)) for position, ccf_maf in enumerate(ccf_mafs))
+    )
+
+def delete_sample_dir(conn, prefix, name):
+    conn.execute("DELETE FROM sample_dirs WHERE prefix = ? AND name = ?", (prefix, name))
+    conn.execute("DELETE FROM ccf_mafs WHERE prefix = ? AND name = ?", (prefix, name))
+
+def query_archive_index(index_path, facets_dir, dmp_id):
+    """
+    Get the ccf.maf files of each sample directory of a patient from the index, the same as walking the archive.
+    Returns a dictionary of sample directory -> list of ccf.maf paths, or None if the index was built for a different archive.
+    """
+
+    with sqlite3.connect(index_path) as conn:
+        if dict(conn.execute("SELECT key, value FROM index_state")) != get_index_state(facets_dir):
+            print(f"[WARNING] {index_path} was not built for {facets_dir}, walking the archive instead.")
+            return None
+
+        prefix = dmp_id[:7]
+        rows = conn.execute(
+            "SELECT sample_dirs.name, relative_path FROM sample_dirs LEFT JOIN ccf_mafs USING (prefix, name) "
+            "WHERE prefix = ? AND substr(sample_dirs.name, 1, ?) = ? ORDER BY sample_dirs.name, position",
+            (prefix, len(dmp_id), dmp_id)
+        )
+
+        sample_ccf_mafs = {}
+        for name, relative_path in rows:
+            sample_dir = str(Path(facets_dir) / prefix / name)
+            ccf_mafs = sample_ccf_mafs.setdefault(sample_dir, [])
+            if relative_path is not None:
+                ccf_mafs.append(os.path.join(sample_dir, relative_path))
+
+    return dict(sorted(sample_ccf_mafs.items()))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create or refresh the index of the FACETS archive.")
+    parser.add_argument("--facets_dir", required=True)
+    parser.add_argument("--archive_index", required=True, help="SQLite index file, created if it doesn't exist.")
+    args = parser.parse_args()
+
+    refresh_archive_index(args.archive_index, args.facets_dir)
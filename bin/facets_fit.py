@@ -1,13 +1,32 @@
-import glob
 from pathlib import Path
 import pandas as pd
 import argparse
 import json
 import os
 import re
+import numpy as np
+import table_cache
+import perf
+from facets_archive import list_entries, scan_ccf_mafs, query_archive_index
 
-def get_facets_data(facets_dir, patient_json, best_fit):
+"""
+Script that finds the best FACETS fit of each IMPACT sample of a patient.
+The sample directories and the ccf.maf files of their fits are found with one os.scandir walk of each sample directory
+(see facets_archive.py), and the walk is reused to select the fit chosen from the facets_review.manifest.
+With --archive_index, the directories are looked up in the index built by facets_archive.py instead of walking the archive.
 
+In cohort mode (--patient_jsons), the fits of every patient are found in one process. Each manifest is read once, the best fit of
+every sample is selected for all manifests together by select_best_fits, and one {combined_id}_facets_fit.txt is written per patient,
+with facets_fit_patients.tsv mapping each patient JSON to its file.
+"""
+
+# Priority of the manifest rows a best fit is picked from, the first tier with any rows is used:
+# qc passed and reviewed as best fit, reviewed as best fit, qc passed, the default fit
+SELECTION_TIERS = ["qc_reviewed", "reviewed", "qc", "default"]
+
+def get_facets_data(facets_dir, patient_json, best_fit, archive_index=None):
+
+    perf.reset()
     patient_data = load_patient_data(patient_json)
     dmp_id = patient_data["dmp_id"]
     combined_id = patient_data["combined_id"]
@@ -16,15 +35,16 @@ def get_facets_data(facets_dir, patient_json, best_fit):
     best_facets_fits = pd.DataFrame(columns=facets_cols)
 
     if not dmp_id:
-        return write_to_txt(best_facets_fits, combined_id)
+        output_file = write_to_txt(best_facets_fits, combined_id)
+        perf.write_report(f"{combined_id}_facets_fit", "facets_fit")
+        return output_file
 
-    all_facets_sample_dirs = []
-    all_facets_sample_dirs = find_all_facets_sample_dirs(facets_dir, dmp_id)
+    sample_ccf_mafs = find_sample_ccf_mafs(facets_dir, dmp_id, archive_index)
 
     best_fits = []
 
-    for sample_dir in all_facets_sample_dirs:
-        facets_path, fit_name = find_best_facets_fit_file(sample_dir, dmp_id)
+    for sample_dir, ccf_mafs in sample_ccf_mafs.items():
+        facets_path, fit_name = find_best_facets_fit_file(sample_dir, dmp_id, ccf_mafs)
         if facets_path is not None and fit_name is not None:
             best_fits.append({
                 'facets_impact_sample': Path(sample_dir).name,
@@ -35,24 +55,143 @@ def get_facets_data(facets_dir, patient_json, best_fit):
     best_facets_fits = pd.DataFrame(best_fits, columns=facets_cols)
 
     write_to_txt(best_facets_fits, combined_id)
+    perf.write_report(f"{combined_id}_facets_fit", "facets_fit")
+
+def get_cohort_facets_data(facets_dir, patient_jsons, archive_index=None):
+    """ Find the best FACETS fits of every patient in a cohort and write one facets fit file per patient. """
+
+    facets_cols = ["facets_impact_sample", "facets_fit", "facets_path"]
+    patients = [(patient_json, load_patient_data(patient_json)) for patient_json in patient_jsons]
+
+    # the ccf.maf files of the sample directories of every patient
+    patient_ccf_mafs = [
+        find_sample_ccf_mafs(facets_dir, patient_data["dmp_id"], archive_index) if patient_data["dmp_id"] else {}
+        for _, patient_data in patients
+    ]
+
+    # only sample directories with several fits need their manifest
+    manifest_dirs = sorted({
+        sample_dir for sample_ccf_mafs in patient_ccf_mafs for sample_dir, ccf_mafs in sample_ccf_mafs.items()
+        if len(ccf_mafs) > 1 and os.path.exists(os.path.join(sample_dir, "facets_review.manifest"))
+    })
+    selected_fits = select_best_fits(read_cohort_manifests(manifest_dirs))
+
+    patient_files = []
+    for (patient_json, patient_data), sample_ccf_mafs in zip(patients, patient_ccf_mafs):
+        best_fits = []
+        for sample_dir, ccf_mafs in sample_ccf_mafs.items():
+            facets_path, fit_name = pick_fit_file(sample_dir, ccf_mafs, selected_fits.get(sample_dir))
+            if facets_path is not None and fit_name is not None:
+                best_fits.append({
+                    'facets_impact_sample': Path(sample_dir).name,
+                    'facets_fit': fit_name,
+                    'facets_path': facets_path
+                })
+
+        output_file = write_to_txt(pd.DataFrame(best_fits, columns=facets_cols), patient_data["combined_id"])
+        patient_files.append({"patient_json": os.path.basename(patient_json), "facets_fit": output_file})
+
+    pd.DataFrame(patient_files, columns=["patient_json", "facets_fit"]).to_csv("facets_fit_patients.tsv", sep="\t", index=False)
+    print(f"[INFO] FACETS fits written for {len(patient_files)} patients from {len(manifest_dirs)} manifests.")
+    perf.write_report("cohort_facets_fit", "facets_fit")
+
+@perf.timed
+def find_sample_ccf_mafs(facets_dir, dmp_id, archive_index=None):
+    """ Get the ccf.maf files of each sample directory of a patient, from the archive index or from one walk of each directory. """
+    sample_ccf_mafs = query_archive_index(archive_index, facets_dir, dmp_id) if archive_index else None
+    if sample_ccf_mafs is None:
+        sample_ccf_mafs = {sample_dir: scan_ccf_mafs(sample_dir) for sample_dir in find_all_facets_sample_dirs(facets_dir, dmp_id)}
+    return sample_ccf_mafs
+
+@perf.timed
+def read_cohort_manifests(sample_dirs):
+    """
+    Read the manifest of each sample directory once and keep the columns the best fit is selected on.
+    The qc flag and the date order are computed per manifest, so they match what find_best_facets_fit_file computes for the manifest alone.
+    """
+
+    manifest_cols = ["sample_dir", "fit_name", "qc", "reviewed", "date_rank"]
+    manifests = []
+    for sample_dir in sample_dirs:
+        manifest_df = read_manifest(Path(sample_dir) / "facets_review.manifest").reset_index(drop=True)
+
+        # position of each row when the manifest is sorted by review date, newest first
+        date_rank = np.empty(len(manifest_df), dtype=int)
+        date_rank[manifest_df.sort_values('date_reviewed', ascending=False, kind='stable').index.to_numpy()] = np.arange(len(manifest_df))
+
+        manifests.append(pd.DataFrame({
+            "sample_dir": sample_dir,
+            "fit_name": manifest_df['fit_name'].astype(str),
+            "qc": (manifest_df['facets_qc'] == True).to_numpy(dtype=bool),
+            "reviewed": (manifest_df['review_status'] == 'reviewed_best_fit').to_numpy(dtype=bool),
+            "date_rank": date_rank,
+        }))
+
+    return pd.concat(manifests, ignore_index=True) if manifests else pd.DataFrame(columns=manifest_cols)
+
+@perf.timed
+def select_best_fits(manifests):
+    """
+    Select the best fit of every sample directory from the combined manifests at once.
+    Each row gets the first SELECTION_TIERS tier it belongs to, and the newest reviewed row of the best tier of each sample is picked,
+    the same fallback chain find_best_facets_fit_file walks through for one manifest. Returns a dictionary of sample directory -> fit name.
+    """
 
+    if manifests.empty:
+        return {}
+
+    tiers = np.select(
+        [manifests['qc'] & manifests['reviewed'], manifests['reviewed'], manifests['qc'], manifests['fit_name'] == 'default'],
+        np.arange(len(SELECTION_TIERS)),
+        default=len(SELECTION_TIERS)
+    )
+    candidates = manifests.assign(tier=tiers)
+    candidates = candidates[candidates['tier'] < len(SELECTION_TIERS)]
+
+    best_rows = candidates.sort_values(['sample_dir', 'tier', 'date_rank'], kind='stable').drop_duplicates('sample_dir', keep='first')
+    return dict(zip(best_rows['sample_dir'], best_rows['fit_name']))
+
+def pick_fit_file(sample_dir, ccf_mafs, selected_fit):
+    """ Pick the ccf.maf file of a sample directory for the fit selected from its manifest, with the same fallbacks as find_best_facets_fit_file. """
+
+    if len(ccf_mafs) == 0:
+        return None, None
+
+    if not os.path.exists(os.path.join(sample_dir, "facets_review.manifest")):
+        print("MANIFEST MISSING")
+        return ccf_mafs[0], "unknown"
+
+    if len(ccf_mafs) == 1:
+        return ccf_mafs[0], Path(ccf_mafs[0]).parent.name
+
+    if selected_fit is None:
+        print(f"[ERROR] No fit in the manifest of {sample_dir} passed QC, was reviewed or is the default fit.")
+        return None, None
+
+    fit_dir = os.path.join(sample_dir, selected_fit)
+    fit_ccf_mafs = [ccf_maf for ccf_maf in ccf_mafs if os.path.dirname(ccf_maf) == fit_dir]
+    if not fit_ccf_mafs:
+        print(f"[ERROR] No ccf.maf file found for the selected fit {fit_dir}.")
+        return None, None
+
+    return fit_ccf_mafs[0], selected_fit
+
+@perf.timed
 def find_all_facets_sample_dirs(facets_dir, dmp_id):
     patient_path = Path(facets_dir) / dmp_id[:7]
-    dir_pattern = str(patient_path / f"{dmp_id}*")
-    
-    # Get all matching paths
-    dmp_matches = glob.glob(dir_pattern)
-    
-    # Return only directories
-    dirs = sorted([d for d in dmp_matches if os.path.isdir(d)])
+
+    # Get all directories named {dmp_id}* with one listing of the patient prefix directory
+    dirs = sorted(str(patient_path / name) for name, is_dir in list_entries(patient_path) if is_dir and name.startswith(dmp_id))
     return dirs
 
-def find_best_facets_fit_file(facets_dir, dmp_id):
+@perf.timed
+def find_best_facets_fit_file(facets_dir, dmp_id, facets_fits=None):
+    """ Pick the best fit of a sample directory. facets_fits are its ccf.maf files from scan_ccf_mafs, the directory is scanned if not given. """
 
-    facets_fits = []
     fit_name = "unknown"
 
-    facets_fits = glob.glob(os.path.join(facets_dir, "**", "*[0-9].ccf.maf"), recursive=True)
+    if facets_fits is None:
+        facets_fits = scan_ccf_mafs(facets_dir)
 
     if len(facets_fits) == 0:
         return None, None 
@@ -90,7 +229,9 @@ def find_best_facets_fit_file(facets_dir, dmp_id):
     base_path = best_fit['path']
     fit_name = best_fit['fit_name']
 
-    facets_fits = glob.glob(os.path.join(facets_dir, f'{fit_name}', "*[0-9].ccf.maf"), recursive=True)
+    # the ccf.maf of the chosen fit, from the files found in the first walk
+    fit_dir = os.path.join(facets_dir, f'{fit_name}')
+    facets_fits = [facets_path for facets_path in facets_fits if os.path.dirname(facets_path) == fit_dir]
 
     return facets_fits[0], fit_name
 
@@ -99,6 +240,7 @@ def load_patient_data(patient_json):
         patient_data = json.load(json_file)
         return patient_data
 
+@perf.timed
 def write_to_txt(facets_files, patient_id):
     output_file = f"{patient_id}_facets_fit.txt"
 
@@ -109,19 +251,27 @@ def write_to_txt(facets_files, patient_id):
     facets_files.to_csv(output_file, sep='\t', index=False)
     return output_file
 
+@perf.timed
 def read_manifest(manifest_path):
-    with open(manifest_path, "r") as f:
-        skip_rows = [i for i, line in enumerate(f) if line.startswith("#")]
-
     sep = "," if manifest_path.suffix == ".csv" else "\t"
-    return pd.read_csv(manifest_path, sep=sep, skiprows=skip_rows, low_memory=False, keep_default_na=False)
+    perf.count("manifests_read")
+    return table_cache.read_table(manifest_path, comment_prefix="#", sep=sep, low_memory=False, keep_default_na=False)
 
-if __name__ == "__main__":
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Find facets fit.")
     parser.add_argument("--facets_dir", required=True, help="Path to samples CSV file.")
-    parser.add_argument("--patient_json", required=True)
+    parser.add_argument("--patient_json", required=False)
+    parser.add_argument("--patient_jsons", required=False, nargs="+", help="Patient JSONs of a cohort, to find the fits of every patient in one process.")
     parser.add_argument("--best_fit", required=False)
-    args = parser.parse_args()
+    parser.add_argument("--archive_index", required=False, help="FACETS archive index from facets_archive.py. The archive is walked directly if not given.")
+    args = parser.parse_args(argv)
 
-    get_facets_data(args.facets_dir, args.patient_json, args.best_fit)
+    if args.patient_jsons:
+        get_cohort_facets_data(args.facets_dir, args.patient_jsons, args.archive_index)
+    elif args.patient_json:
+        get_facets_data(args.facets_dir, args.patient_json, args.best_fit, args.archive_index)
+    else:
+        parser.error("either --patient_json or --patient_jsons is required")
 
+if __name__ == "__main__":
+    main()
@@ -4,10 +4,20 @@ import pandas as pd
 import numpy as np
 import argparse
 import json
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+import table_cache
+import perf
 
-def generate_variant_table(patient_json, genotyped_mafs, facets_file):
+# Alt and total read count columns of the genotyped mafs for each read type
+READ_COUNT_COLS = {
+    "SIMPLEX-DUPLEX": ("t_alt_count_fragment_simplex_duplex", "t_total_count_fragment_simplex_duplex"),
+    "ORG-STD": ("t_alt_count_standard", "t_total_count_standard"),
+}
 
+def generate_variant_table(patient_json, genotyped_mafs, facets_file, chunksize=None):
+
+    perf.reset()
     patient_data = load_patient_data(patient_json)
     combined_id = patient_data['combined_id']
     cmo_id = patient_data['cmo_id']
@@ -20,37 +30,28 @@ def generate_variant_table(patient_json, genotyped_mafs, facets_file):
 
     output_cols = ['sample_id', 'patient_id', 'cmo_patient_id', 'dmp_patient_id'] + maf_cols + ['t_alt_count', 't_total_count', 'VAF', 'read_type', 'facets_impact_sample', 'facets_fit', 'clonality', 'tcn', 'expected_alt_copies', 'adjusted_VAF']
 
-    all_variants = []
-
-    patient_mafs = genotyped_mafs
-    facets_list = read_facets_file_list(facets_file)
+    facets_cols = ['facets_impact_sample', 'facets_fit', 'clonality', 'tcn', 'expected_alt_copies']
 
-    for maf in patient_mafs:
+    # Load and validate each FACETS fit of the patient once
+    facets_tables = []
+    for facets_path in read_facets_file_list(facets_file):
+        facets_data = parse_facets_file(facets_path, maf_cols)
+        if facets_data is not None and not facets_data.empty:
+            facets_tables.append(facets_data)
 
-        maf_data = get_reads_from_maf(maf, maf_cols)
+    # Read every genotyped maf into one table, keeping track of which maf each row came from
+    maf_tables = []
+    for maf in genotyped_mafs:
+        maf_data = get_reads_from_maf(maf, maf_cols, chunksize)
         if maf_data is None or maf_data.empty:
             continue
-        
-        if facets_list:
-            for facets_file in facets_list:
-                facets_data = parse_facets_file(facets_file, maf_cols)
-
-                if facets_data is None or facets_data.empty:
-                    for col in ['facets_impact_sample', 'facets_fit', 'clonality', 'tcn', 'expected_alt_copies']:
-                        maf_data[col] = "NA"
-                    all_variants.append(maf_data)
-                    continue
-
-                merged_data = maf_data.merge(facets_data, on=maf_cols, how='left', suffixes=('', '_facets'))
-                all_variants.append(merged_data)
-        else:
-            for col in ['facets_impact_sample', 'facets_fit', 'clonality', 'tcn', 'expected_alt_copies']:
-                maf_data[col] = "NA"
-            all_variants.append(maf_data)
-        
-    if all_variants:
-        all_variants_df = pd.concat(all_variants, ignore_index=True)
-        all_variants_df["adjusted_VAF"] = all_variants_df.apply(calculate_adjusted_vaf, axis=1)
+        maf_tables.append(maf_data.assign(maf_index=len(maf_tables)))
+
+    if maf_tables:
+        genotypes = set_variant_dtypes(pd.concat(maf_tables, ignore_index=True))
+        perf.count("rows_genotyped", len(genotypes))
+        all_variants_df = merge_facets_fits(genotypes, facets_tables, maf_cols, facets_cols)
+        all_variants_df["adjusted_VAF"] = calculate_adjusted_vaf(all_variants_df)
     else:
         all_variants_df = pd.DataFrame(columns=output_cols)
         all_variants_df["adjusted_VAF"] = pd.Series(dtype='float64')
@@ -62,21 +63,135 @@ def generate_variant_table(patient_json, genotyped_mafs, facets_file):
     ordered_columns_df = all_variants_df[output_cols]
 
     save_to_csv(ordered_columns_df, combined_id, "SNV")
+    perf.count("rows_written", len(ordered_columns_df))
+    perf.write_report(f"{combined_id}_filter_calls", "filter_calls")
+
+    return combined_id, ordered_columns_df
+
+def generate_cohort_variant_tables(cohort_manifest, workers=1, parquet_dir=None, chunksize=None):
+    """
+    Run generate_variant_table for every patient in a cohort manifest on a process pool.
+    Writes the per-patient SNV csv files and, if a parquet_dir is given, one Parquet dataset partitioned by patient_id.
+    """
+
+    patients = read_cohort_manifest(cohort_manifest)
+
+    if parquet_dir and not table_cache.PYARROW_AVAILABLE:
+        print("[WARNING] pyarrow is not installed, only the per-patient csv files will be written.")
+        parquet_dir = None
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(generate_patient_partition, patient["patient_json"], patient["genotyped_mafs"], patient["facets_file"], parquet_dir, chunksize)
+            for patient in patients
+        ]
+        for future in futures:
+            combined_id, n_variants = future.result()
+            print(f"[INFO] {combined_id}: {n_variants} variants.")
+
+def generate_patient_partition(patient_json, genotyped_mafs, facets_file, parquet_dir, chunksize):
+    """ Generate the variant table of one patient and write it to the patient's partition of the Parquet dataset. """
+
+    combined_id, variants_df = generate_variant_table(patient_json, genotyped_mafs, facets_file, chunksize)
+
+    if parquet_dir:
+        # Each patient writes its own partition directory, so workers never write to the same file.
+        # The patient_id column is stored in the partition path, as in a hive partitioned dataset.
+        partition_dir = os.path.join(parquet_dir, f"patient_id={combined_id}")
+        os.makedirs(partition_dir, exist_ok=True)
+        set_parquet_dtypes(variants_df.drop(columns=['patient_id'])).to_parquet(os.path.join(partition_dir, "part-0.parquet"), index=False)
+
+    return combined_id, len(variants_df)
+
+def set_parquet_dtypes(variants_df):
+    """ Give the columns of the variant table the same types for every patient, so the partitions form one dataset. """
+
+    typed_df = pd.DataFrame(index=variants_df.index)
+    for col in variants_df.columns:
+        if col in ['Start_Position', 'End_Position', 't_alt_count', 't_total_count']:
+            typed_df[col] = pd.to_numeric(variants_df[col], errors='coerce').astype('Int64')
+        elif col in ['VAF', 'tcn', 'expected_alt_copies', 'adjusted_VAF']:
+            typed_df[col] = pd.to_numeric(variants_df[col], errors='coerce').astype('float64')
+        else:
+            typed_df[col] = variants_df[col].astype('string')
+
+    return typed_df
+
+def read_cohort_manifest(cohort_manifest):
+    """ Read the tab delimited cohort manifest with columns patient_json, genotyped_mafs (comma separated) and facets_file. """
+
+    manifest = pd.read_csv(cohort_manifest, sep="\t", dtype=str, keep_default_na=False)
+    return [
+        {"patient_json": row.patient_json, "genotyped_mafs": [maf for maf in row.genotyped_mafs.split(",") if maf], "facets_file": row.facets_file}
+        for row in manifest.itertuples(index=False)
+    ]
+
+@perf.timed
+def merge_facets_fits(genotypes, facets_tables, maf_cols, facets_cols):
+    """
+    Annotate the genotype table with every FACETS fit in one merge on the variant key.
+    Each genotype row is paired with each fit, so a variant gets one row per fit, with empty FACETS columns if the fit does not have it.
+    """
+
+    if not facets_tables:
+        genotypes[facets_cols] = "NA"
+        return genotypes.drop(columns=['maf_index'])
+
+    # Tag the rows of each fit with the position of the fit, and keep only the variant key and the FACETS columns
+    facets_data = set_variant_dtypes(pd.concat([facets_table.assign(fit_index=i) for i, facets_table in enumerate(facets_tables)], ignore_index=True))
+    facets_data['variant_key'] = get_variant_key(facets_data, maf_cols)
+    facets_data = facets_data[['variant_key', 'fit_index'] + facets_cols]
+
+    # Pair the position of every genotype row with every fit, and look up the FACETS columns by variant key.
+    # Only the narrow key table goes through the merge, the genotype columns are gathered once at the end.
+    genotype_keys = pd.DataFrame({
+        'row': np.arange(len(genotypes)),
+        'maf_index': genotypes['maf_index'].to_numpy(),
+        'variant_key': get_variant_key(genotypes, maf_cols).to_numpy()
+    })
+    fit_index = pd.DataFrame({'fit_index': range(len(facets_tables))})
+    paired_keys = genotype_keys.merge(fit_index, how='cross').merge(facets_data, on=['variant_key', 'fit_index'], how='left')
+
+    # Order the rows by genotyped maf, then by fit
+    row_order = np.lexsort((paired_keys['fit_index'].to_numpy(), paired_keys['maf_index'].to_numpy()))
+
+    merged_data = genotypes.drop(columns=['maf_index']).take(paired_keys['row'].to_numpy()[row_order]).reset_index(drop=True)
+    for col in facets_cols:
+        merged_data[col] = paired_keys[col].take(row_order).reset_index(drop=True)
+
+    return merged_data
 
+@perf.timed
+def set_variant_dtypes(variants_df):
+    """ Store the repeated text columns as categoricals and the positions as int32 to reduce memory. """
+
+    for col in ['sample_id', 'Hugo_Symbol', 'Chromosome', 'Variant_Classification', 'Reference_Allele', 'Tumor_Seq_Allele2', 'read_type', 'facets_impact_sample', 'facets_fit', 'clonality']:
+        if col in variants_df.columns:
+            variants_df[col] = variants_df[col].astype('category')
+    for col in ['Start_Position', 'End_Position']:
+        variants_df[col] = variants_df[col].astype('int32')
+
+    return variants_df
+
+def get_variant_key(variants_df, maf_cols):
+    """ Hash the variant columns of each row into one int64 key. Categorical and string columns with the same values hash the same. """
+    return pd.Series(pd.util.hash_pandas_object(variants_df[maf_cols], index=False).to_numpy().view('int64'), index=variants_df.index)
+
+@perf.timed
 def parse_facets_file(facets_file, maf_cols):
     """Load a FACETS file, validate required columns, and return cleaned DataFrame or None"""
 
     required_cols = maf_cols + ['clonality', 'expected_alt_copies', 'tcn']
     
     try:
-        facets_data = pd.read_csv(facets_file, sep="\t")
+        facets_data = table_cache.read_table(facets_file)
     except Exception as e:
         print(f"[ERROR] Failed to read {facets_file}: {e}")
-        return None, None
+        return None
 
     if not set(required_cols).issubset(facets_data.columns):
         print(f"[WARN] Skipping {facets_file}, missing required columns.")
-        return None, None
+        return None
 
     facets_data["Chromosome"] = facets_data["Chromosome"].astype(str)
     facets_data["Start_Position"] = facets_data["Start_Position"].astype(int)
@@ -91,28 +206,47 @@ def parse_facets_file(facets_file, maf_cols):
 
     return facets_data_subset
 
-def get_reads_from_maf(maf, maf_cols):
-    maf_data = pd.read_csv(maf, sep='\t')
+@perf.timed
+def get_reads_from_maf(maf, maf_cols, chunksize=None):
+    """
+    Read the variant and read count columns of a genotyped maf and compute the VAF for its read type.
+    Returns None for read types that are not used. With a chunksize the maf is streamed in chunks of that many rows,
+    so only the selected columns of the whole file are held in memory.
+    """
 
     if "DUPLEX" in maf and "SIMPLEX" in maf and "ORG" not in maf:
         sample_name = os.path.basename(maf).replace("-SIMPLEX-DUPLEX_genotyped.maf", "")
-        # Compute VAF
-        maf_data['t_alt_count'] = maf_data["t_alt_count_fragment_simplex_duplex"]
-        maf_data['t_total_count'] = maf_data["t_total_count_fragment_simplex_duplex"]
-        maf_data['VAF'] = maf_data['t_alt_count'] / maf_data['t_total_count']
-        maf_data['read_type'] = "SIMPLEX-DUPLEX"
+        read_type = "SIMPLEX-DUPLEX"
 
     elif "ORG-STD" in maf:
         sample_name = os.path.basename(maf).replace("_genotyped.maf", "")
-        # Compute VAF
-        maf_data['t_alt_count'] = maf_data["t_alt_count_standard"]
-        maf_data['t_total_count'] = maf_data["t_total_count_standard"]
-        maf_data['VAF'] = maf_data['t_alt_count'] / maf_data['t_total_count']
-        maf_data['read_type'] = "ORG-STD"
+        read_type = "ORG-STD"
 
     else:
         return None
-    
+
+    # Only read the variant columns and the count columns of the read type
+    alt_col, total_col = READ_COUNT_COLS[read_type]
+    usecols = maf_cols + [alt_col, total_col]
+    dtypes = {col: str for col in maf_cols if col not in ['Start_Position', 'End_Position']}
+
+    if chunksize:
+        chunks = pd.read_csv(maf, sep='\t', usecols=usecols, dtype=dtypes, chunksize=chunksize)
+        maf_data = pd.concat([compute_vaf(chunk, maf_cols, alt_col, total_col, read_type, sample_name) for chunk in chunks], ignore_index=True)
+    else:
+        engine = "pyarrow" if table_cache.PYARROW_AVAILABLE else "c"
+        maf_data = compute_vaf(table_cache.read_table(maf, columns=usecols, dtype=dtypes, engine=engine), maf_cols, alt_col, total_col, read_type, sample_name)
+
+    return maf_data
+
+def compute_vaf(maf_data, maf_cols, alt_col, total_col, read_type, sample_name):
+    """ Compute the VAF from the read count columns of the read type and return the output columns. """
+
+    maf_data['t_alt_count'] = maf_data[alt_col]
+    maf_data['t_total_count'] = maf_data[total_col]
+    maf_data['VAF'] = maf_data['t_alt_count'] / maf_data['t_total_count']
+    maf_data['read_type'] = read_type
+
     maf_data["Chromosome"] = maf_data["Chromosome"].astype(str)
     maf_data["Start_Position"] = maf_data["Start_Position"].astype(int)
     maf_data["End_Position"] = maf_data["End_Position"].astype(int)
@@ -128,11 +262,13 @@ def load_patient_data(patient_json):
         patient_data = json.load(json_file)
     return patient_data
 
+@perf.timed
 def save_to_csv(df, patient_id, var_tag):
     output_file = f'{patient_id}_{var_tag}.csv'
     df.to_csv(output_file, index=False)
     print(f'{output_file} has been created.')
 
+@perf.timed
 def read_facets_file_list(txt_path):
     try:
         df = pd.read_csv(txt_path, sep="\t", usecols=["facets_path"])
@@ -143,37 +279,66 @@ def read_facets_file_list(txt_path):
         print(f"[ERROR] Failed to read facets file list: {e}")
         return []
 
-def calculate_adjusted_vaf(row): 
+@perf.timed
+def calculate_adjusted_vaf(variants_df):
     """
     Calculate adjusted VAF based on clonality, total copy number (tcn),
-    and expected alternate copies.
+    and expected alternate copies. Values that are not numeric, non-clonal
+    variants and a zero denominator give NaN.
+    """
+
+    ncn = 2
+    vaf = to_float(variants_df['VAF'])
+    t = to_float(variants_df['tcn'])
+    exp = to_float(variants_df['expected_alt_copies'])
+    clonal = (variants_df['clonality'] == 'CLONAL').to_numpy(dtype=bool)
+
+    # adj_vaf = (n* vaf_value) / (exp + (n - t) * vaf_value)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        denominator = exp + (ncn - t) * vaf
+        adj_vaf = ( vaf * ncn ) / denominator
+
+    return pd.Series(np.where(clonal & (denominator != 0), adj_vaf, np.nan), index=variants_df.index, dtype='float64')
+
+def to_float(values):
     """
+    Convert a column to float64 the same way float() converts each value, with NaN for values that are not numeric.
+    pd.to_numeric is not used for text, since it can round a long decimal string differently than float() does.
+    """
+
+    if pd.api.types.is_numeric_dtype(values.dtype):
+        return values.to_numpy(dtype='float64', na_value=np.nan)
 
+    # parse each distinct value once
+    codes, uniques = pd.factorize(values)
+    parsed = np.array([parse_float(value) for value in uniques] + [np.nan], dtype='float64')
+    return parsed[codes]
+
+def parse_float(value):
+    """ float(value), or NaN if the value is not numeric """
     try:
-        vaf = float(row['VAF'])
+        return float(value)
     except (ValueError, TypeError):
         return np.nan
 
-    if row.get('clonality') == 'CLONAL':
-        try:
-            t = float(row['tcn'])
-            exp = float(row['expected_alt_copies'])
-            ncn = 2
-            # adj_vaf = (n* vaf_value) / (exp + (n - t))
-            adj_vaf = ( vaf * ncn ) / (exp + (ncn - t) * vaf )
-            return adj_vaf
-        except (ValueError, TypeError, ZeroDivisionError):
-            return np.nan
-
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Filter calls.")
+    parser.add_argument("--patient_json", required=False, help="Path to samples CSV file.")
+    parser.add_argument("--genotyped_mafs", nargs="+", required=False)
+    parser.add_argument("--facets_file", required=False, help="Path to samples CSV file.")
+    parser.add_argument("--chunksize", type=int, required=False, help="Read the genotyped mafs in chunks of this many rows to bound memory.")
+    parser.add_argument("--cohort_manifest", required=False, help="Tab delimited file with columns patient_json, genotyped_mafs (comma separated) and facets_file, to process a whole cohort.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes used in cohort mode.")
+    parser.add_argument("--parquet_dir", required=False, help="Directory of the Parquet dataset, partitioned by patient_id, written in cohort mode.")
+
+    args = parser.parse_args(argv)
+
+    if args.cohort_manifest:
+        generate_cohort_variant_tables(args.cohort_manifest, args.workers, args.parquet_dir, args.chunksize)
+    elif args.patient_json and args.genotyped_mafs and args.facets_file:
+        generate_variant_table(args.patient_json, args.genotyped_mafs, args.facets_file, args.chunksize)
     else:
-        return np.nan
+        parser.error("either --cohort_manifest or --patient_json, --genotyped_mafs and --facets_file are required")
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Filter calls.")
-    parser.add_argument("--patient_json", required=True, help="Path to samples CSV file.")
-    parser.add_argument("--genotyped_mafs", nargs="+", required=True)
-    parser.add_argument("--facets_file", required=True, help="Path to samples CSV file.")
-
-    args = parser.parse_args()
-
-    generate_variant_table(args.patient_json, args.genotyped_mafs, args.facets_file)
\ No newline at end of file
+    main()
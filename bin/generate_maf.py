@@ -1,23 +1,48 @@
-import csv
+import io
 import pandas as pd
 import os
 import re
 import argparse
 import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import table_cache
+import perf
 
+# Columns of the research and clinical mafs that are needed to extract the calls
+MUTATION_COLUMNS = [
+    'Hugo_Symbol', 'Chromosome', 'Start_Position', 'End_Position', 'Reference_Allele', 'Tumor_Seq_Allele1', 'Tumor_Seq_Allele2',
+    'Tumor_Sample_Barcode', 'Mutation_Status', 'Status', 'Variant_Classification', 'HGVSp', 'HGVSp_Short'
+]
 
-def get_all_calls(patient_json, research_access_mutations_maf_template, dmp_mutations_file, exclude_genes, exclude_classifications):
+# Columns of the all calls maf, in output order
+CALL_COLUMNS = [
+    'Hugo_Symbol', 'Chromosome', 'Start_Position', 'End_Position', 'Reference_Allele', 'Tumor_Seq_Allele1', 'Tumor_Seq_Allele2',
+    'Tumor_Sample_Barcode', 'Matched_Norm_Sample_Barcode', 't_ref_count', 't_alt_count', 'n_ref_count', 'n_alt_count',
+    'Variant_Classification', 'HGVSp', 'HGVSp_Short'
+]
+
+# Columns that identify a variant when research and clinical calls are merged
+DEDUP_COLUMNS = ['Hugo_Symbol', 'Chromosome', 'Start_Position', 'End_Position', 'Variant_Classification', 'Reference_Allele', 'Tumor_Seq_Allele2']
+
+# Rows of the clinical maf parsed at a time when the whole file is read, so only the rows of the patient are kept in memory
+CLINICAL_CHUNK_ROWS = 200000
+
+
+def get_all_calls(patient_json, research_access_mutations_maf_template, dmp_mutations_file, exclude_genes, exclude_classifications, dmp_mutations_index=None, workers=1):
     """
     Load patient data, get all mutation calls (research and clinical), merge and filter them, then write results to a file.
     """
     
+    perf.reset()
+
     # Load in the patient JSON
     patient_data = load_patient_data(patient_json)
     combined_id = patient_data['combined_id']
 
     # Get the research and clinical calls from corresponding MAF files
-    research_calls = get_research_access_mutations(patient_data, research_access_mutations_maf_template)
-    clinical_calls = get_clinical_mutations(patient_data, dmp_mutations_file)
+    research_calls = get_research_access_mutations(patient_data, research_access_mutations_maf_template, workers)
+    clinical_calls = get_clinical_mutations(patient_data, dmp_mutations_file, dmp_mutations_index)
 
     # Merge and filter the calls based on the exclude gene and classification lists
     all_small_calls = merge_calls(research_calls, clinical_calls)
@@ -25,73 +50,148 @@ def get_all_calls(patient_json, research_access_mutations_maf_template, dmp_muta
 
     # Write the final filtered output to a maf file
     write_to_maf(all_small_calls_filtered, combined_id)
+    perf.write_report(f"{combined_id}_generate_maf", "generate_maf")
 
-def parse_mutation_file(mutations_file, assay_type, dmp_id):
+@perf.timed
+def parse_mutation_file(mutations_file, assay_type, dmp_id, row_ranges=None, prefetched=None):
     """
     Parse maf files and extract minimum MAF columns needed for genotyping.
     assay_type: "clinical" or "research" - determines filtering logic
     dmp_id: clinical patient ID used only for clinical assay filtering
+    row_ranges: optional byte ranges of the rows to read, from the mutations index. The whole file is read if not given.
+    prefetched: optional contents of a research maf file that were already read, see prefetch_files
+    Returns a table with the CALL_COLUMNS columns.
     """
-    
-    mutations = []
-    
-    # return an empty list if the maf file doesn't exist
+
+    # return an empty table if the maf file doesn't exist
     if not os.path.exists(mutations_file):
         print(f"File does not exist: {mutations_file}")
-        return mutations
-    
+        return pd.DataFrame(columns=CALL_COLUMNS)
+
+    # read the needed columns from the columnar cache if it is enabled and the whole file is needed
+    if row_ranges is None and table_cache.is_enabled():
+        comment_prefix = "#" if assay_type == "clinical" else None
+        maf_tables = [table_cache.read_table(mutations_file, columns=MUTATION_COLUMNS, comment_prefix=comment_prefix, dtype=str, keep_default_na=False)]
+    # for clinical mafs, exclude the metadata lines
+    elif assay_type == "clinical" and row_ranges is not None:
+        maf_tables = [read_mutation_columns(io.StringIO("".join(read_row_ranges(mutations_file, row_ranges))))]
+    elif assay_type == "clinical":
+        maf_tables = read_mutation_columns(mutations_file, skiprows=count_metadata_lines(mutations_file), chunksize=CLINICAL_CHUNK_ROWS)
+    elif prefetched is not None:
+        maf_tables = [read_mutation_columns(io.BytesIO(prefetched))]
+    else:
+        maf_tables = [read_mutation_columns(mutations_file)]
+
+    # select the rows of each table before the call columns are built, so a large clinical maf is filtered chunk by chunk
+    mutations = []
+    for maf_table in maf_tables:
+        perf.count(f"rows_{assay_type}_read", len(maf_table))
+        mutations.append(select_mutation_rows(maf_table, assay_type, dmp_id))
+    mutations = pd.concat(mutations, ignore_index=True) if mutations else pd.DataFrame(columns=MUTATION_COLUMNS)
+
+    return build_call_table(mutations, mutations_file)
+
+def read_mutation_columns(source, **read_kwargs):
+    """ Read only the MUTATION_COLUMNS of a maf, every column as a string. """
+    return pd.read_csv(source, sep="\t", usecols=lambda col: col in MUTATION_COLUMNS, dtype=str, keep_default_na=False, **read_kwargs)
+
+def count_metadata_lines(mutations_file):
+    """ Count the metadata lines of a clinical maf before its header line. """
+    n_lines = 0
     with open(mutations_file, 'r') as maf:
+        for line in maf:
+            if "sequenced_samples:" not in line:
+                break
+            n_lines += 1
+    return n_lines
+
+def select_mutation_rows(maf_table, assay_type, dmp_id):
+    """ Select the rows of a maf table that are called for genotyping. """
+
+    # exclude germline mutations from both assays
+    keep = maf_table['Mutation_Status'] != 'GERMLINE'
+
+    # for research, remove variants that did not pass QC
+    if assay_type == "research":
+        keep &= maf_table['Status'] == ""
+    # for clinical, only look at lines for the relevant dmp_id
+    if assay_type == "clinical":
+        keep &= maf_table['Tumor_Sample_Barcode'].str.contains(str(dmp_id), regex=False)
+
+    return maf_table[keep]
+
+def build_call_table(mutations, mutations_file):
+    """ Build the minimum MAF columns from the selected rows, with typed positions and empty normal and count columns. """
+
+    start_positions = pd.to_numeric(mutations['Start_Position'], errors='coerce')
+    end_positions = pd.to_numeric(mutations['End_Position'], errors='coerce')
+
+    # skip the rows whose positions are not integers
+    valid = start_positions.notna() & end_positions.notna()
+    if not valid.all():
+        print(f"Error parsing {(~valid).sum()} rows in {mutations_file}: non-integer positions")
+        mutations, start_positions, end_positions = mutations[valid], start_positions[valid], end_positions[valid]
+
+    calls = pd.DataFrame({
+        'Hugo_Symbol': mutations['Hugo_Symbol'],
+        'Chromosome': mutations['Chromosome'].astype(str),
+        'Start_Position': start_positions.astype('int64'),
+        'End_Position': end_positions.astype('int64'),
+        'Reference_Allele': mutations['Reference_Allele'],
+        'Tumor_Seq_Allele1': mutations['Tumor_Seq_Allele1'],
+        'Tumor_Seq_Allele2': mutations['Tumor_Seq_Allele2'],
+        'Tumor_Sample_Barcode': mutations['Tumor_Sample_Barcode'],
+        'Matched_Norm_Sample_Barcode': '',
+        't_ref_count': 0,
+        't_alt_count': 0,
+        'n_ref_count': 0,
+        'n_alt_count': 0,
+    }, columns=CALL_COLUMNS)
+
+    # the annotation columns are optional in the source mafs
+    for col in ['Variant_Classification', 'HGVSp', 'HGVSp_Short']:
+        calls[col] = mutations[col] if col in mutations.columns else ''
+
+    return calls.reset_index(drop=True)
+
+def read_row_ranges(mutations_file, row_ranges):
+    """ Yield the header line of a clinical maf followed by the lines in the given byte ranges. """
+
+    with open(mutations_file, 'rb') as maf:
+        # the header is the first line that is not a metadata line
+        for line in maf:
+            if b"sequenced_samples:" not in line:
+                yield line.decode()
+                break
+
+        for start, end in row_ranges:
+            maf.seek(start)
+            yield from maf.read(end - start).decode().splitlines(keepends=True)
+
+@perf.timed
+def load_row_ranges(mutations_index, mutations_file, dmp_id):
+    """
+    Get the byte ranges of the rows of a dmp id from the mutations index.
+    Returns None if the index was built from a different version of the mutations file, so the whole file is read instead.
+    """
+
+    source_stat = os.stat(mutations_file)
+    row_ranges = []
+
+    with open(mutations_index) as index:
+        source_state = dict(field.split("=", 1) for field in index.readline().lstrip("#").rstrip("\n").split("\t"))
+        if source_state != {"source_size": str(source_stat.st_size), "source_mtime_ns": str(source_stat.st_mtime_ns)}:
+            print(f"[WARNING] {mutations_index} does not match {mutations_file}, reading the whole file.")
+            return None
+
+        for line in index:
+            index_dmp_id, start, end = line.rstrip("\n").split("\t")
+            if index_dmp_id == dmp_id:
+                row_ranges.append((int(start), int(end)))
 
-        # for clinical mafs, exclude the metadata lines
-        if assay_type == "clinical":
-            maf_data = (line for line in maf if "sequenced_samples:" not in line)
-        else:
-            maf_data = maf
-
-        # go through each row in the maf
-        reader = csv.DictReader(maf_data, delimiter='\t')
-        for row in reader:
-
-            # exclude germline mutations from both assays
-            if row['Mutation_Status'] == 'GERMLINE':
-                continue
-
-            # for research, remove variants that did not pass QC 
-            if assay_type == "research" and not row['Status'] == "":
-                continue
-            # for clinical, only look at lines for the relevant dmp_id
-            if assay_type == "clinical" and str(dmp_id) not in row['Tumor_Sample_Barcode']:
-                continue 
-
-            # extract rows that match all criteria
-            try:
-                variant = {
-                    'Hugo_Symbol': row['Hugo_Symbol'],
-                    'Chromosome': row['Chromosome'],
-                    'Start_Position': int(row['Start_Position']),
-                    'End_Position': int(row['End_Position']),
-                    'Reference_Allele': row['Reference_Allele'],
-                    'Tumor_Seq_Allele1': row['Tumor_Seq_Allele1'],
-                    'Tumor_Seq_Allele2': row['Tumor_Seq_Allele2'],
-                    'Tumor_Sample_Barcode': row['Tumor_Sample_Barcode'],
-                    'Matched_Norm_Sample_Barcode': '',
-                    't_ref_count': 0,
-                    't_alt_count': 0,
-                    'n_ref_count': 0,
-                    'n_alt_count': 0,
-                    'Variant_Classification': row.get('Variant_Classification', ''),
-                    'HGVSp': row.get('HGVSp', ''),
-                    'HGVSp_Short': row.get('HGVSp_Short', ''),
-                }
-            
-                mutations.append(variant)
-
-            # throw an error if one of the rows is missing
-            except Exception as e:
-                print(f"Error parsing row in {maf}: {e}")
-
-    return mutations
+    return row_ranges
 
+@perf.timed
 def filter_calls(calls_df, exclude_genes, exclude_classifications):
     """
     Filter mutation df by excluding genes and variant classifications from exclude lists.
@@ -99,65 +199,110 @@ def filter_calls(calls_df, exclude_genes, exclude_classifications):
     exclude_classifications: list of exact variant classifications to exclude
     """
 
-    filtered_calls = calls_df.copy()
-
-    # Exclude rows where Hugo_Symbol contains any substring from exclude_genes
-    for gene in exclude_genes:
-        filtered_calls = filtered_calls[~filtered_calls['Hugo_Symbol'].str.contains(gene, na=False)]
+    # Exclude rows where Hugo_Symbol contains any substring from exclude_genes, matched in one pass
+    gene_pattern = compile_gene_pattern(exclude_genes)
+    excluded = calls_df['Hugo_Symbol'].str.contains(gene_pattern, na=False) if gene_pattern else False
 
     # Exclude rows where Variant_Classification exactly matches any exclude_classifications
-    filtered_calls = filtered_calls[~filtered_calls['Variant_Classification'].isin(exclude_classifications)]
+    excluded = excluded | calls_df['Variant_Classification'].isin(exclude_classifications)
 
-    return filtered_calls
-    
-def get_research_access_mutations(patient_data, research_access_mutations_maf_template):
+    return calls_df[~excluded]
+
+def compile_gene_pattern(exclude_genes):
+    """ Compile the gene substrings into one alternation regex. Gene names are matched literally, empty names are ignored. """
+    genes = [gene for gene in dict.fromkeys(exclude_genes) if gene]
+    return re.compile("|".join(re.escape(gene) for gene in genes)) if genes else None
+
+@perf.timed
+def get_research_access_mutations(patient_data, research_access_mutations_maf_template, workers=1):
     """
-    Find every research samples in the patient_data, and parse the maf file for each sample. Collects all the calls into research_mutations list.
+    Find every research samples in the patient_data, and parse the maf file for each sample. Collects all the calls into one table.
+    With more than one worker, the maf files are read ahead concurrently on a thread pool, and the calls are still combined in sample order.
     """
 
     cmo_id = patient_data['cmo_id']
-    research_mutations = []
 
     if not cmo_id:
-        return research_mutations
+        return pd.DataFrame(columns=CALL_COLUMNS)
+
+    # find each research sample in the patient_data
+    maf_paths = [
+        research_access_mutations_maf_template.replace("{cmo_patient_id}", cmo_id).replace("{sample_id}", sample_id)
+        for sample_id, sample_data in patient_data["samples"].items()
+        if sample_data['assay_type'] == "research_access" and sample_data['tumor_normal'] == "tumor"
+    ]
+
+    # read the files ahead on a thread pool, then parse them one at a time in sample order
+    # the cache is not read ahead, its tables are already parsed
+    if workers > 1 and len(maf_paths) > 1 and not table_cache.is_enabled():
+        research_mutations = [
+            parse_mutation_file(maf_path, "research", "", prefetched=maf_bytes) for maf_path, maf_bytes in prefetch_files(maf_paths, workers)
+        ]
     else:
-        # find each research sample in the patient_data
-        for sample_id, sample_data in patient_data["samples"].items():
-            if sample_data['assay_type'] == "research_access" and sample_data['tumor_normal'] == "tumor":
-                maf_path = research_access_mutations_maf_template.replace("{cmo_patient_id}", cmo_id).replace("{sample_id}", sample_id)
-                # add the variants from the maf file into the research_mutations list
-                research_mutations += parse_mutation_file(maf_path, "research", "")
-    
-    return research_mutations
+        research_mutations = [parse_mutation_file(maf_path, "research", "") for maf_path in maf_paths]
+
+    return concat_calls(research_mutations)
 
+def prefetch_files(paths, workers):
+    """
+    Read files on a thread pool, at most workers files ahead of the caller, and yield (path, contents) pairs in the order of paths.
+    The contents are None if a file can't be read, so the caller falls back to its own handling of the path.
+    """
 
-def get_clinical_mutations(patient_data, dmp_mutations_file):
-    """ Get clinical mutations from the given dmp file. """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for path in paths:
+            pending.append((path, executor.submit(read_file_bytes, path)))
+            if len(pending) >= workers:
+                path, future = pending.popleft()
+                yield path, future.result()
+        while pending:
+            path, future = pending.popleft()
+            yield path, future.result()
+
+def read_file_bytes(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+@perf.timed
+def get_clinical_mutations(patient_data, dmp_mutations_file, dmp_mutations_index=None):
+    """ Get clinical mutations from the given dmp file, reading only the patient's rows if a mutations index is given. """
     dmp_id = patient_data['dmp_id']
-    clinical_mutations = []
 
     if not dmp_id:
-        return clinical_mutations
+        return pd.DataFrame(columns=CALL_COLUMNS)
     else:
-         clinical_mutations = parse_mutation_file(dmp_mutations_file, "clinical", dmp_id)
+         row_ranges = load_row_ranges(dmp_mutations_index, dmp_mutations_file, dmp_id) if dmp_mutations_index else None
+         clinical_mutations = parse_mutation_file(dmp_mutations_file, "clinical", dmp_id, row_ranges)
 
     return clinical_mutations
 
 
+@perf.timed
 def merge_calls(research_calls, clinical_calls):
-    """ Combine research and clinical calls and remove duplicates. """
+    """ Combine research and clinical calls and remove duplicates, keyed on the factorized variant columns. """
 
-    research_calls_df = pd.DataFrame(research_calls)
-    clinical_calls_df = pd.DataFrame(clinical_calls)
+    all_small_calls = concat_calls([research_calls, clinical_calls])
+    all_small_calls = all_small_calls[~all_small_calls.duplicated(subset=DEDUP_COLUMNS, keep='first')]
 
-    all_small_calls = pd.concat([research_calls_df, clinical_calls_df], ignore_index=True)
-    all_small_calls = all_small_calls.drop_duplicates(subset=['Hugo_Symbol', 'Chromosome', 'Start_Position', 'End_Position', 'Variant_Classification', 'Reference_Allele', 'Tumor_Seq_Allele2'], keep='first')
-    
     return(all_small_calls)
 
+def concat_calls(call_tables):
+    """ Concatenate call tables, keeping the CALL_COLUMNS and their types when some of the tables are empty. """
+    call_tables = [calls for calls in call_tables if not calls.empty]
+    if not call_tables:
+        return pd.DataFrame(columns=CALL_COLUMNS)
+    return pd.concat(call_tables, ignore_index=True)
+
+@perf.timed
 def write_to_maf(calls_df, patient_id):
     """ Save call information to a tab delimited file """
 
+    perf.count("rows_written", len(calls_df))
     calls_df.to_csv(f"{patient_id}_all_small_calls.maf", index=False, sep = "\t")
     print(f'{patient_id}_all_small_calls.maf has been created.')
 
@@ -165,17 +310,21 @@ def load_patient_data(patient_json):
     with open(patient_json) as json_file:
         return json.load(json_file)
 
-if __name__ == "__main__":
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Generate all called mutations MAF.")
     parser.add_argument("--patient_json", required=True)
     parser.add_argument("--research_access_mutations_maf_template", required=True)
     parser.add_argument("--dmp_mutations_file", required=True)
     parser.add_argument("--exclude_genes")
     parser.add_argument("--exclude_classifications")
-    args = parser.parse_args()
+    parser.add_argument("--dmp_mutations_index", required=False, help="Byte offset index of the DMP mutations file from index_mutations.py.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of threads used to read the research maf files of the patient concurrently.")
+    args = parser.parse_args(argv)
 
     exclude_genes = args.exclude_genes.split(",")
     exclude_classifications = args.exclude_classifications.split(",")
 
-    get_all_calls(args.patient_json, args.research_access_mutations_maf_template, args.dmp_mutations_file, exclude_genes, exclude_classifications)
+    get_all_calls(args.patient_json, args.research_access_mutations_maf_template, args.dmp_mutations_file, exclude_genes, exclude_classifications, args.dmp_mutations_index, args.workers)
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import os
+import json
+import sqlite3
+import hashlib
+from contextlib import contextmanager
+import pandas as pd
+from generate_maf import DEDUP_COLUMNS
+
+"""
+Helper script with a cache of genotyped counts, so re-running a patient only genotypes new samples and newly called variants.
+Each set of BAMs of a sample (standard, duplex and simplex) is keyed by the real path, size and mtime of every BAM, together with
+the genotyping engine, its settings and the reference fasta, and the cache of a key is one SQLite file in the cache directory.
+A changed BAM, engine or reference gets a new key, so its counts are never reused.
+Rows are stored per variant and per genotyped maf of the sample, e.g. -ORG-STD_genotyped.maf or -SIMPLEX-DUPLEX_genotyped.maf,
+so calls at the same site with another annotation are all kept. Sites that were genotyped are recorded by their site key.
+The genotyped rows of a sample are rebuilt from the current all calls maf, one per call, with the read counts of its site
+from the cache (see refresh_call_columns).
+"""
+
+# Columns that identify a genotyped site
+SITE_COLS = ['Chromosome', 'Start_Position', 'End_Position', 'Reference_Allele', 'Tumor_Seq_Allele2']
+
+# Columns of the calls the genotyper writes itself, kept from the cached rows like the read counts
+GENOTYPER_COLS = ['Tumor_Sample_Barcode']
+
+# Version of the layout of the cache files, part of the key so files of an older layout are never read
+CACHE_VERSION = 2
+
+# Seconds to wait for another task that is writing to the same cache file
+SQLITE_TIMEOUT = 600
+
+# Settings each genotyping engine runs with, part of the cache key. They must match the GENOTYPE_VARIANTS module and the pileup_genotyper.py defaults
+GENOTYPER_SETTINGS = {
+    "gbcms": "filter_duplicate=1",
+    "pysam": "filter_duplicate=1,min_mapping_quality=20,min_base_quality=0",
+}
+
+def get_genotyper_key(engine, fasta_ref=None):
+    """ Describe how the counts are genotyped: the engine, its settings and the real path, size and mtime of the reference fasta. """
+
+    genotyper_key = f"{engine}:{GENOTYPER_SETTINGS.get(engine, '')}"
+    if fasta_ref:
+        try:
+            fasta_stat = os.stat(fasta_ref)
+            genotyper_key += f"\n{os.path.realpath(fasta_ref)}:{fasta_stat.st_size}:{fasta_stat.st_mtime_ns}"
+        except OSError:
+            genotyper_key += f"\n{fasta_ref}"
+    return genotyper_key
+
+def get_bam_key(bam_paths, genotyper_key=""):
+    """
+    Key a set of BAMs by the real path, size and mtime of each BAM and by the genotyper key, see get_genotyper_key.
+    Returns None if any of the BAMs is missing, those samples are not cached.
+    """
+
+    bam_paths = [bam_path for bam_path in bam_paths if not pd.isna(bam_path) and bam_path not in ("", "NA")]
+    if not bam_paths or "MISSING_PATH" in bam_paths:
+        return None
+
+    bam_states = []
+    for bam_path in bam_paths:
+        try:
+            bam_stat = os.stat(bam_path)
+        except OSError:
+            return None
+        bam_states.append(f"{os.path.realpath(bam_path)}:{bam_stat.st_size}:{bam_stat.st_mtime_ns}")
+
+    return hashlib.sha1("\n".join(bam_states + [genotyper_key, f"cache_version={CACHE_VERSION}"]).encode()).hexdigest()
+
+def get_site_keys(maf_data):
+    """ Get the site key of each row of a maf, e.g. 17:7577120:7577120:C:T. """
+    return maf_data[SITE_COLS].astype(str).agg(":".join, axis=1)
+
+def get_variant_keys(maf_data):
+    """ Get the variant key of each row of a maf, from the columns of generate_maf.DEDUP_COLUMNS it has, e.g. TP53:17:7577120:7577120:Missense_Mutation:C:T. """
+    return maf_data[[col for col in DEDUP_COLUMNS if col in maf_data.columns]].astype(str).agg(":".join, axis=1)
+
+def get_cache_path(cache_dir, bam_key):
+    return os.path.join(cache_dir, bam_key[:2], f"{bam_key}.sqlite")
+
+def connect(cache_dir, bam_key):
+    """ Open the cache file of a set of BAMs, creating it if needed. """
+
+    cache_path = get_cache_path(cache_dir, bam_key)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    conn = sqlite3.connect(cache_path, timeout=SQLITE_TIMEOUT)
+    conn.execute("CREATE TABLE IF NOT EXISTS sites (site_key TEXT PRIMARY KEY)")
+    conn.execute("CREATE TABLE IF NOT EXISTS genotypes (maf_suffix TEXT, site_key TEXT, variant_key TEXT, row TEXT, PRIMARY KEY (maf_suffix, site_key, variant_key))")
+    return conn
+
+@contextmanager
+def open_cache(cache_dir, bam_key):
+    """ Open the cache file of a set of BAMs for a transaction, committing on success, and close it afterwards. """
+    conn = connect(cache_dir, bam_key)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+def get_cached_sites(cache_dir, bam_key):
+    """ Get the site keys that were already genotyped for a set of BAMs. """
+
+    if not os.path.exists(get_cache_path(cache_dir, bam_key)):
+        return set()
+
+    try:
+        with open_cache(cache_dir, bam_key) as conn:
+            return {site_key for site_key, in conn.execute("SELECT site_key FROM sites")}
+    except sqlite3.Error as e:
+        print(f"[WARNING] Could not read genotype cache of {bam_key}, genotyping every site: {e}")
+        return set()
+
+def read_cached_genotypes(cache_dir, bam_key, site_keys):
+    """ Read the cached rows of the given sites. Returns a dictionary of genotyped maf suffix -> table of rows. """
+
+    rows = {}
+    with open_cache(cache_dir, bam_key) as conn:
+        conn.execute("CREATE TEMP TABLE wanted (site_key TEXT PRIMARY KEY)")
+        conn.executemany("INSERT OR IGNORE INTO wanted VALUES (?)", ((site_key,) for site_key in site_keys))
+        query = "SELECT maf_suffix, row FROM genotypes JOIN wanted USING (site_key)"
+        for maf_suffix, row in conn.execute(query):
+            rows.setdefault(maf_suffix, []).append(json.loads(row))
+
+    return {maf_suffix: pd.DataFrame(suffix_rows) for maf_suffix, suffix_rows in rows.items()}
+
+def write_genotypes(cache_dir, bam_key, genotyped_tables):
+    """
+    Store freshly genotyped rows. genotyped_tables is a dictionary of genotyped maf suffix -> table of rows with string values.
+    Only sites that have rows are marked as genotyped, so a site the genotyper skipped is tried again in the next run.
+    """
+
+    site_keys = set()
+    with open_cache(cache_dir, bam_key) as conn:
+        for maf_suffix, table in genotyped_tables.items():
+            if table.empty:
+                continue
+            table_site_keys = get_site_keys(table)
+            site_keys.update(table_site_keys)
+            conn.executemany(
+                "INSERT OR REPLACE INTO genotypes VALUES (?, ?, ?, ?)",
+                (
+                    (maf_suffix, site_key, variant_key, json.dumps(row))
+                    for site_key, variant_key, row in zip(table_site_keys, get_variant_keys(table), table.to_dict('records'))
+                )
+            )
+        conn.executemany("INSERT OR IGNORE INTO sites VALUES (?)", ((site_key,) for site_key in site_keys))
+
+    return len(site_keys)
+
+def refresh_call_columns(cached_rows, calls):
+    """
+    Build the genotyped rows of the current calls from cached rows: one row per call at a cached site, in the order of the calls,
+    like a freshly genotyped maf. The read count columns (t_*count*) and the GENOTYPER_COLS come from the cached rows of the
+    site, which are the same for every call at the site. The other columns, e.g. Hugo_Symbol or Variant_Classification, come from
+    the call, so calls at the same site with another annotation each keep their row, and rows cached before the calls were
+    re-annotated look the same as freshly genotyped rows.
+    """
+
+    if cached_rows.empty or calls.empty:
+        return cached_rows
+
+    site_rows = cached_rows.set_index(get_site_keys(cached_rows).to_numpy())
+    site_rows = site_rows[~site_rows.index.duplicated(keep='first')]
+    call_site_keys = get_site_keys(calls)
+    cached_calls = call_site_keys.isin(site_rows.index).to_numpy()
+
+    refreshed = site_rows.loc[call_site_keys[cached_calls].to_numpy()].reset_index(drop=True)
+    call_cols = [col for col in cached_rows.columns if col in calls.columns and not is_genotyper_column(col)]
+    refreshed[call_cols] = calls.loc[cached_calls, call_cols].to_numpy()
+    return refreshed
+
+def is_count_column(col):
+    """ Check if a column of a genotyped maf is a read count, e.g. t_alt_count or t_total_count_fragment_simplex_duplex. """
+    return col.startswith("t_") and "count" in col
+
+def is_genotyper_column(col):
+    """ Check if a column of a genotyped maf is written by the genotyper rather than taken from the calls. """
+    return is_count_column(col) or col in GENOTYPER_COLS
@@ -1,26 +1,55 @@
 import os
 import json
 import pandas as pd
+import numpy as np
 import argparse
 import subprocess
-from infer_bams import get_bams
+from infer_bams import compile_bam_template, get_template_fields, resolve_bam_paths
+import genotype_cache
+import perf
 
 """ 
 Script to create input metadata table required for genotype_variants. Gets all the relevant bams for a set of samples in the input patient JSON.
-The bam templates are passed into a helper function get_bams which replaces the template strings with the metadata from the JSON. 
+The bam templates are passed into the helper functions in infer_bams.py, which replace the template strings with the metadata from the JSON and validate the bams of all samples together. 
+
+In cohort mode (--cohort_manifest), the samples of every patient go into one table with a single row per unique set of BAMs,
+so BAMs shared between patients (e.g. pooled normals) are genotyped once against the union of the sites of their patients.
+The table is also split into one table per --rows_per_task rows, so each unique set of BAMs (or group of them) is genotyped in its own task.
+The mafs in the cohort tables are named by file name only, since each genotyping task stages the mafs it needs next to its table.
+The cohort_sample_patients.tsv mapping is used by split_genotyped_mafs.py to split the genotyped mafs back into patients.
+
+With --shards N, the all calls maf of a patient is split into N shards of contiguous genomic sites with about the same number of variants,
+and one genotyping input table is written per shard, so the shards can be genotyped on different nodes.
+merge_genotyped_mafs.py stitches the genotyped shards back together.
+
+With --genotype_cache_dir, samples whose BAMs were genotyped before are only genotyped at the sites missing from the cache
+(see genotype_cache.py), and merge_genotyped_mafs.py adds the cached counts back to the genotyped mafs.
 """
 
-def build_input_table(patient_json, templates, all_calls_maf):
+# Columns of the all calls mafs that identify a variant, the same columns generate_maf.py deduplicates on
+VARIANT_COLS = ['Hugo_Symbol', 'Chromosome', 'Start_Position', 'End_Position', 'Variant_Classification', 'Reference_Allele', 'Tumor_Seq_Allele2']
+
+BAM_COLS = ["standard_bam", "duplex_bam", "simplex_bam"]
+
+# Rank of the chromosomes in genomic order, other contigs are sorted after them
+CHROMOSOME_RANKS = {**{str(i): i for i in range(1, 23)}, "X": 23, "Y": 24, "M": 25, "MT": 25}
+
+def build_input_table(patient_json, templates, all_calls_maf, workers=8, shards=1, genotype_cache_dir=None, genotyping_engine="gbcms", fasta_ref=None):
     """
     Main function to build a genotyping input table. Loads patient JSON, extracts BAM paths for the samples, 
     combines with patient and MAF metadata, and writes to a TSV output.
+    With more than one shard, writes one table per shard of the all calls maf instead.
+    With a genotype cache directory, each sample is only genotyped at the sites that are not cached for its BAMs,
+    and the {combined_id}_genotype_cache_plan.tsv used by merge_genotyped_mafs.py to add the cached rows back is written.
+    The cached counts are only reused for the same genotyping engine and reference fasta.
     """
 
     required_cols = ['patient_id', 'sample_id', 'standard_bam', 'duplex_bam', 'simplex_bam', 'maf']
 
+    perf.reset()
     patient_data = load_patient_json(patient_json)
     combined_id = patient_data['combined_id']
-    bam_paths = extract_bam_paths(patient_data, templates)
+    bam_paths = extract_bam_paths(patient_data, templates, workers)
     
     bam_paths_df = pd.DataFrame(bam_paths)
     #bam_paths_df['patient_id'] = combined_id
@@ -28,12 +57,121 @@ def build_input_table(patient_json, templates, all_calls_maf):
 
     bam_paths_df = bam_paths_df.reindex(columns=required_cols, fill_value="NA")
 
-    write_genotyping_table(bam_paths_df, combined_id)
+    if shards <= 1 and not genotype_cache_dir:
+        write_genotyping_table(bam_paths_df, combined_id)
+        perf.write_report(f"{combined_id}_genotype_variants_input", "genotype_variants_input")
+        return
+
+    calls = pd.read_csv(all_calls_maf, sep="\t", dtype=str, keep_default_na=False)
+    perf.count("rows_calls", len(calls))
+    calls = calls.iloc[get_site_order(calls)].reset_index(drop=True)
+
+    # the rows of the calls each sample still needs to be genotyped at, all rows without a cache
+    sample_rows = {sample_id: None for sample_id in bam_paths_df['sample_id']}
+    if genotype_cache_dir:
+        genotyper_key = genotype_cache.get_genotyper_key(genotyping_engine, fasta_ref)
+        sample_rows = plan_cached_genotypes(bam_paths_df, calls, all_calls_maf, combined_id, genotype_cache_dir, genotyper_key)
+
+    shard_rows = np.array_split(np.arange(len(calls)), max(1, min(shards, len(calls))))
+    for i, rows in enumerate(shard_rows):
+        shard_id = f"shard{i + 1:03d}" if len(shard_rows) > 1 else None
+        shard_df = get_shard_table(bam_paths_df, calls, rows, sample_rows, combined_id, all_calls_maf, shard_id)
+        write_genotyping_table(shard_df, f"{combined_id}_{shard_id}" if shard_id else combined_id)
+
+    if len(shard_rows) > 1:
+        print(f"[INFO] {len(calls)} variants split into {len(shard_rows)} shards.")
+
+    perf.write_report(f"{combined_id}_genotype_variants_input", "genotype_variants_input")
+
+@perf.timed
+def get_shard_table(bam_paths_df, calls, rows, sample_rows, combined_id, all_calls_maf, shard_id=None):
+    """
+    Build the genotyping table of one shard, the rows of the calls in genomic order given by rows. Without shards, the shard is the all calls maf.
+    Samples that need every site of the shard share the shard maf, samples that need only some sites get their own maf,
+    and samples that need none of the sites are left out.
+    """
+
+    if shard_id:
+        prefix = f"{combined_id}_{shard_id}"
+        shard_maf = os.path.realpath(f"{prefix}_all_small_calls.maf")
+        calls.iloc[rows].to_csv(shard_maf, sep="\t", index=False)
+    else:
+        prefix = combined_id
+        shard_maf = os.path.realpath(all_calls_maf)
 
-def extract_bam_paths(patient_data, templates):
+    shard_entries = []
+    for entry in bam_paths_df.to_dict('records'):
+        needed_rows = sample_rows[entry['sample_id']]
+        if needed_rows is None:
+            entry['maf'] = shard_maf
+        else:
+            sample_shard_rows = rows[np.isin(rows, needed_rows)]
+            if len(sample_shard_rows) == 0:
+                continue
+            elif len(sample_shard_rows) == len(rows):
+                entry['maf'] = shard_maf
+            else:
+                entry['maf'] = os.path.realpath(f"{prefix}_{entry['sample_id']}_uncached_calls.maf")
+                calls.iloc[sample_shard_rows].to_csv(entry['maf'], sep="\t", index=False)
+        shard_entries.append(entry)
+
+    return pd.DataFrame(shard_entries, columns=bam_paths_df.columns)
+
+@perf.timed
+def plan_cached_genotypes(bam_paths_df, calls, all_calls_maf, combined_id, genotype_cache_dir, genotyper_key=""):
+    """
+    Look up the cached sites of the BAMs of each sample and write the {combined_id}_genotype_cache_plan.tsv.
+    Returns a dictionary of sample id -> rows of the calls that still need to be genotyped, or None for samples that are not cached.
+    """
+
+    site_keys = genotype_cache.get_site_keys(calls) if not calls.empty else pd.Series(dtype=str)
+
+    sample_rows = {}
+    plan = []
+    for entry in bam_paths_df.to_dict('records'):
+        # samples with a missing BAM are not cached and are genotyped at every site, their bam key is left empty
+        bam_key = genotype_cache.get_bam_key([entry[col] for col in BAM_COLS], genotyper_key)
+        if bam_key is None:
+            sample_rows[entry['sample_id']] = None
+            cached = np.zeros(len(calls), dtype=bool)
+        else:
+            cached = site_keys.isin(genotype_cache.get_cached_sites(genotype_cache_dir, bam_key)).to_numpy()
+            sample_rows[entry['sample_id']] = np.flatnonzero(~cached)
+        plan.append({"sample_id": entry['sample_id'], "bam_key": bam_key or "", "all_calls_maf": os.path.realpath(all_calls_maf), "cached_sites": int(cached.sum()), "new_sites": int((~cached).sum())})
+
+    plan_df = pd.DataFrame(plan, columns=["sample_id", "bam_key", "all_calls_maf", "cached_sites", "new_sites"])
+    plan_df.to_csv(f"{combined_id}_genotype_cache_plan.tsv", sep="\t", index=False)
+    print(f"[INFO] {plan_df['cached_sites'].sum()} sample sites cached, {plan_df['new_sites'].sum()} to genotype.")
+
+    return sample_rows
+
+def get_site_order(maf_data):
+    """ Positions of the rows of a maf sorted by chromosome and position. The sort is stable, so rows at the same site keep their order. """
+    chromosomes = maf_data['Chromosome'].astype(str).str.replace("^chr", "", regex=True)
+    ranks = chromosomes.map(CHROMOSOME_RANKS).fillna(len(CHROMOSOME_RANKS)).to_numpy()
+    starts = pd.to_numeric(maf_data['Start_Position'], errors='coerce').fillna(-1).to_numpy()
+    ends = pd.to_numeric(maf_data['End_Position'], errors='coerce').fillna(-1).to_numpy()
+    # lexsort sorts by the last key first
+    return np.lexsort((ends, starts, chromosomes.to_numpy(), ranks))
+
+@perf.timed
+def extract_bam_paths(patient_data, templates, workers=8):
     """
     Builds a list of BAM paths for each sample in the patient. Fills out the fields depending on the assay_type and whether sample is tumor or normal.
+    The BAM paths of all samples are validated together on a pool of worker threads.
     """
+    # compile each template once for all samples
+    bam_templates = {name: compile_bam_template(template) for name, template in templates.items()}
+    bam_paths = fill_bam_paths(patient_data, bam_templates)
+
+    # validate the bam paths of all samples at once, then replace each path with its real path or MISSING_PATH
+    resolve_entry_paths(bam_paths, workers)
+    
+    # return the list of bam_paths, where each row is a sample and the columns are the different bam types
+    return bam_paths
+
+def fill_bam_paths(patient_data, bam_templates):
+    """ Fill the compiled bam templates for each sample in the patient, without validating the paths. """
     bam_paths = []
 
     # go through each sample
@@ -43,47 +181,157 @@ def extract_bam_paths(patient_data, templates):
         entry = {"sample_id": sample_id}
         assay = sample_data["assay_type"]
         tumor_normal = sample_data["tumor_normal"]
+        template_fields = get_template_fields(sample_data)
 
         # Research ACCESS: duplex bam and simplex bam from templates
         if assay == "research_access":
             if tumor_normal == "tumor":
-                entry["duplex_bam"] = get_bams(sample_data, templates["research_access_duplex_bam_template"])
-                entry["simplex_bam"] = get_bams(sample_data, templates["research_access_simplex_bam_template"])
+                entry["duplex_bam"] = bam_templates["research_access_duplex_bam_template"].fill(template_fields)
+                entry["simplex_bam"] = bam_templates["research_access_simplex_bam_template"].fill(template_fields)
             elif tumor_normal == "normal":
-                entry["standard_bam"] = get_bams(sample_data, templates["research_access_unfilter_bam_template"])
+                entry["standard_bam"] = bam_templates["research_access_unfilter_bam_template"].fill(template_fields)
         # Clinical ACCESS duplex bam and simplex bam, or standard bam from templates
         elif assay == "clinical_access":
             if tumor_normal == "tumor":
-                entry["duplex_bam"] = get_bams(sample_data, templates["clinical_access_duplex_bam_template"])
-                entry["simplex_bam"] = get_bams(sample_data, templates["clinical_access_simplex_bam_template"])
+                entry["duplex_bam"] = bam_templates["clinical_access_duplex_bam_template"].fill(template_fields)
+                entry["simplex_bam"] = bam_templates["clinical_access_simplex_bam_template"].fill(template_fields)
             elif tumor_normal == "normal":
-                entry["standard_bam"] = get_bams(sample_data, templates["clinical_access_unfilter_bam_template"])
+                entry["standard_bam"] = bam_templates["clinical_access_unfilter_bam_template"].fill(template_fields)
         # Clinical IMPACT, standard bam from template
         elif assay == "clinical_impact":
-            entry["standard_bam"] = get_bams(sample_data, templates["clinical_impact_standard_bam_template"])
+            entry["standard_bam"] = bam_templates["clinical_impact_standard_bam_template"].fill(template_fields)
 
         # add all the bam paths for one sample to the bam_paths list
         bam_paths.append(entry)
-    
-    # return the list of bam_paths, where each row is a sample and the columns are the different bam types
+
     return bam_paths
 
+@perf.timed
+def resolve_entry_paths(bam_paths, workers=8):
+    """ Validate the bam paths of all entries together and replace each path with its real path or MISSING_PATH. """
+    resolved_paths = resolve_bam_paths([entry[col] for entry in bam_paths for col in BAM_COLS if col in entry], workers)
+    for entry in bam_paths:
+        for col in BAM_COLS:
+            if col in entry:
+                entry[col] = resolved_paths[entry[col]]
+
+def build_cohort_input_table(cohort_manifest, templates, workers=8, target_sites_dir="cohort_target_sites", rows_per_task=1, tasks_dir="genotyping_tasks"):
+    """
+    Build one genotyping input table for every patient in a cohort manifest, with one row per unique set of real BAM paths.
+    Samples that are shared between patients are genotyped against the union of the variants of those patients,
+    written to target_sites_dir. Writes cohort_genotyping_input.tsv, the same table split into tables of rows_per_task rows
+    in tasks_dir, and the cohort_sample_patients.tsv mapping. The mafs and patient JSONs are named by file name only.
+    """
+
+    required_cols = ['patient_id', 'sample_id', 'standard_bam', 'duplex_bam', 'simplex_bam', 'maf']
+
+    bam_templates = {name: compile_bam_template(template) for name, template in templates.items()}
+
+    # fill the bam paths of every patient first, so the paths of the whole cohort are validated in one batch
+    patient_entries = []
+    for patient in read_cohort_manifest(cohort_manifest):
+        patient_data = load_patient_json(patient["patient_json"])
+        entries = fill_bam_paths(patient_data, bam_templates)
+        patient_entries.append((patient, patient_data['combined_id'], entries))
+
+    resolve_entry_paths([entry for _, _, entries in patient_entries for entry in entries], workers)
+
+    # group the samples by their real bam paths, keeping the mafs of every patient the bams belong to
+    genotyping_rows = {}
+    sample_patients = []
+    for patient, combined_id, entries in patient_entries:
+        all_calls_maf = os.path.realpath(patient["all_calls_maf"])
+        for entry in entries:
+            bam_key = get_bam_key(entry)
+            if bam_key not in genotyping_rows:
+                genotyping_rows[bam_key] = {"entry": entry, "mafs": []}
+            row = genotyping_rows[bam_key]
+            if all_calls_maf not in row["mafs"]:
+                row["mafs"].append(all_calls_maf)
+
+            sample_patients.append({
+                "patient_json": os.path.basename(patient["patient_json"]),
+                "combined_id": combined_id,
+                "sample_id": entry["sample_id"],
+                "genotyped_sample_id": row["entry"]["sample_id"],
+                "all_calls_maf": os.path.basename(all_calls_maf),
+            })
+
+    # bams of a single patient keep that patient's maf, shared bams get a maf with the union of the sites
+    genotyping_input = []
+    for row in genotyping_rows.values():
+        entry = dict(row["entry"])
+        if len(row["mafs"]) == 1:
+            entry["maf"] = os.path.basename(row["mafs"][0])
+        else:
+            entry["maf"] = os.path.basename(write_union_maf(row["mafs"], entry["sample_id"], target_sites_dir))
+        genotyping_input.append(entry)
+
+    genotyping_input_df = pd.DataFrame(genotyping_input).reindex(columns=required_cols, fill_value="NA")
+    write_genotyping_table(genotyping_input_df, "cohort")
+    n_tasks = write_task_tables(genotyping_input_df, rows_per_task, tasks_dir)
+
+    sample_patients_df = pd.DataFrame(sample_patients, columns=["patient_json", "combined_id", "sample_id", "genotyped_sample_id", "all_calls_maf"])
+    sample_patients_df.to_csv("cohort_sample_patients.tsv", sep="\t", index=False)
+
+    print(f"[INFO] {len(sample_patients_df)} samples of {len(patient_entries)} patients share {len(genotyping_input_df)} genotyping rows, in {n_tasks} tasks.")
+    perf.write_report("cohort_genotype_variants_input", "genotype_variants_input")
+
+def write_task_tables(genotyping_input_df, rows_per_task, tasks_dir):
+    """ Split the cohort genotyping table into tables of rows_per_task rows, one per genotyping task. Returns the number of tables. """
+
+    os.makedirs(tasks_dir, exist_ok=True)
+    rows_per_task = max(1, rows_per_task)
+    n_tasks = 0
+    for start in range(0, len(genotyping_input_df), rows_per_task):
+        n_tasks += 1
+        task_table = os.path.join(tasks_dir, f"cohort_task{n_tasks:05d}_genotyping_input.tsv")
+        genotyping_input_df.iloc[start:start + rows_per_task].to_csv(task_table, sep="\t", index=False)
+    return n_tasks
+
+def get_bam_key(entry):
+    """ Key a sample by its real bam paths. Samples without any existing bam are kept apart by their sample id. """
+    bam_key = tuple(entry.get(col, "") for col in BAM_COLS)
+    if all(path in ("", "MISSING_PATH") for path in bam_key):
+        return ("sample_id", entry["sample_id"])
+    return bam_key
+
+@perf.timed
+def write_union_maf(mafs, sample_id, target_sites_dir):
+    """ Combine the variants of several all calls mafs into one maf, keeping the first copy of each variant. """
+
+    os.makedirs(target_sites_dir, exist_ok=True)
+    union_maf = pd.concat([pd.read_csv(maf, sep="\t", dtype=str, keep_default_na=False) for maf in mafs], ignore_index=True)
+    union_maf = union_maf.drop_duplicates(subset=[col for col in VARIANT_COLS if col in union_maf.columns], keep='first')
+
+    output_path = os.path.realpath(os.path.join(target_sites_dir, f"{sample_id}_target_sites.maf"))
+    union_maf.to_csv(output_path, sep="\t", index=False)
+    return output_path
+
+def read_cohort_manifest(cohort_manifest):
+    """ Read the tab delimited cohort manifest with columns patient_json and all_calls_maf. """
+    manifest = pd.read_csv(cohort_manifest, sep="\t", dtype=str, keep_default_na=False)
+    return manifest[["patient_json", "all_calls_maf"]].to_dict('records')
+
 def load_patient_json(patient_json):
     """ Load the JSON file containing all metadata about the patient and their samples. """
     with open(patient_json) as json_file:
         return json.load(json_file)
 
+@perf.timed
 def write_genotyping_table(df, patient_id):
     """ Save the genotyping input dataframe (with BAM paths + metadata) as a tsv. """
     output_path = f"{patient_id}_genotyping_input.tsv"
+    perf.count("rows_written", len(df))
     df.to_csv(output_path, sep="\t", index=False)
     print(f"[INFO] Genotyping input saved to: {output_path}")
     return output_path
 
-if __name__ == "__main__":
+def main(argv=None):
     parser = argparse.ArgumentParser()
-    parser.add_argument("--patient_json", required=True)
-    parser.add_argument("--all_calls_maf", required=True)
+    parser.add_argument("--patient_json", required=False)
+    parser.add_argument("--all_calls_maf", required=False)
+    parser.add_argument("--cohort_manifest", required=False, help="Tab delimited file with the patient_json and all_calls_maf of every patient, to build one table for the cohort.")
 
     bam_keys = [
         "research_access_duplex_bam_template",
@@ -98,7 +346,14 @@ if __name__ == "__main__":
     for key in bam_keys:
         parser.add_argument(f"--{key}", required=True)
 
-    args = parser.parse_args()
+    parser.add_argument("--workers", type=int, default=8, help="Number of threads used to validate the BAM paths.")
+    parser.add_argument("--shards", type=int, default=1, help="Number of genomic shards to split the genotyping of a patient into.")
+    parser.add_argument("--genotype_cache_dir", required=False, help="Directory of the genotype cache. Every site is genotyped if not given.")
+    parser.add_argument("--genotyping_engine", default="gbcms", choices=sorted(genotype_cache.GENOTYPER_SETTINGS), help="Engine the table is genotyped with, part of the genotype cache key.")
+    parser.add_argument("--fasta_ref", required=False, help="Reference fasta the table is genotyped against, part of the genotype cache key.")
+    parser.add_argument("--rows_per_task", type=int, default=1, help="Number of rows, i.e. unique sets of BAMs, in each genotyping table of cohort mode.")
+
+    args = parser.parse_args(argv)
 
     templates = {
         "research_access_duplex_bam_template": args.research_access_duplex_bam_template,
@@ -110,4 +365,12 @@ if __name__ == "__main__":
         "clinical_impact_standard_bam_template": args.clinical_impact_standard_bam_template,
     }
 
-    genotyping_input = build_input_table(args.patient_json, templates, args.all_calls_maf)
\ No newline at end of file
+    if args.cohort_manifest:
+        build_cohort_input_table(args.cohort_manifest, templates, args.workers, rows_per_task=args.rows_per_task)
+    elif args.patient_json and args.all_calls_maf:
+        genotyping_input = build_input_table(args.patient_json, templates, args.all_calls_maf, args.workers, args.shards, args.genotype_cache_dir, args.genotyping_engine, args.fasta_ref)
+    else:
+        parser.error("either --cohort_manifest or both --patient_json and --all_calls_maf are required")
+
+if __name__ == "__main__":
+    main()
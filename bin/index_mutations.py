@@ -0,0 +1,71 @@
+import os
+import argparse
+
+"""
+Script that reads the clinical DMP mutations file once and writes a byte offset index of the rows of each patient.
+The index is a tab delimited file with one row per contiguous block of rows of a patient: dmp_id, start offset and end offset.
+generate_maf.py uses the index to read only the rows of its patient instead of streaming the whole file.
+"""
+
+# Size of the blocks the mutations file is read in
+READ_BUFFER_SIZE = 16 * 1024 * 1024
+
+def index_mutation_file(mutations_file, output_index):
+    """ Stream through the mutations file once and write the byte ranges of the rows of each dmp id to the index file. """
+
+    source_stat = os.stat(mutations_file)
+    ranges = []
+
+    with open(mutations_file, 'rb', buffering=READ_BUFFER_SIZE) as maf:
+        offset = 0
+        barcode_col = None
+        current_dmp_id, current_start = None, None
+
+        for line in maf:
+            line_start = offset
+            offset += len(line)
+
+            # skip the metadata lines, the same way generate_maf.py does
+            if b"sequenced_samples:" in line:
+                continue
+
+            # the first remaining line is the header, use it to find the tumor sample barcode column
+            if barcode_col is None:
+                barcode_col = line.rstrip(b"\r\n").split(b"\t").index(b"Tumor_Sample_Barcode")
+                continue
+
+            cols = line.split(b"\t", barcode_col + 1)
+            if len(cols) <= barcode_col:
+                continue
+
+            # the dmp id is the first two dash separated fields of the barcode, e.g. P-0012345-T01-IM6 belongs to P-0012345
+            dmp_id = b"-".join(cols[barcode_col].split(b"-")[:2]).decode()
+
+            # extend the current block if the row belongs to the same patient, otherwise start a new block
+            if dmp_id != current_dmp_id:
+                if current_dmp_id is not None:
+                    ranges.append((current_dmp_id, current_start, line_start))
+                current_dmp_id, current_start = dmp_id, line_start
+
+        if current_dmp_id is not None:
+            ranges.append((current_dmp_id, current_start, offset))
+
+    write_index(ranges, source_stat, output_index)
+
+def write_index(ranges, source_stat, output_index):
+    """ Save the byte ranges to a tab delimited file, with the size and mtime of the source file in the first line. """
+
+    with open(output_index, 'w') as index:
+        index.write(f"#source_size={source_stat.st_size}\tsource_mtime_ns={source_stat.st_mtime_ns}\n")
+        for dmp_id, start, end in ranges:
+            index.write(f"{dmp_id}\t{start}\t{end}\n")
+
+    print(f'{output_index} has been created with {len(ranges)} row blocks.')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index the rows of each patient in the DMP mutations file.")
+    parser.add_argument("--dmp_mutations_file", required=True)
+    parser.add_argument("--output_index", default="dmp_mutations.index")
+    args = parser.parse_args()
+
+    index_mutation_file(args.dmp_mutations_file, args.output_index)
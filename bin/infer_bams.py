@@ -1,22 +1,66 @@
 import sys
 from collections import defaultdict
 import json
-import pandas as pd
 import argparse
 import csv
 import re
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import perf
 
 """
 Script that constructs BAM paths by replacing placeholders in a given template template with values from the sample data.
 Supports both clinical and research paths.
 Expects "sample_id", "cmo_patient_id", "anon_id", "anon_id_fl" and "anon_id_sl" as the placeholders in the templates. 
+
+Templates are compiled once into BamTemplate objects and filled with the placeholder values of each sample.
+Directory listings are memoized, so checking the BAM and index files of sibling samples in the same directory costs one scandir.
+resolve_bam_paths validates a whole batch of BAM paths, listing their directories on a thread pool.
 """
 
 def get_bams(sample_data, template):
     """ Construct a BAM path from a given template and sample-specific metadata."""
 
+    bam_path = fill_bam_template(sample_data, template)
+
+    # only return the bam path if it is valid
+    return resolve_bam_path(bam_path)
+
+class BamTemplate:
+    """
+    A BAM path template compiled once into a format string, so filling it for a sample is a single format call.
+    """
+
+    placeholder_pattern = re.compile(r"\{(sample_id|cmo_patient_id|anon_id|anon_id_fl|anon_id_sl)\}")
+
+    def __init__(self, template):
+        self.template = template
+        self.format_string = self.compile(template)
+
+    @classmethod
+    def compile(cls, template):
+        """ Turn the template into a format string: placeholders become format fields and any other braces are escaped. """
+        tokens = cls.placeholder_pattern.split(template)
+        # split returns the literal text at even positions and the placeholder names at odd positions
+        return "".join(
+            token.replace("{", "{{").replace("}", "}}") if i % 2 == 0 else f"{{{token}}}"
+            for i, token in enumerate(tokens)
+        )
+
+    def fill(self, template_fields):
+        """ Build the BAM path from the placeholder values of a sample, see get_template_fields. """
+        return self.format_string.format_map(template_fields)
+
+@lru_cache(maxsize=None)
+def compile_bam_template(template):
+    """ Compile a BAM template once and reuse it for every later sample. """
+    return BamTemplate(template)
+
+def get_template_fields(sample_data):
+    """ Get the values of the template placeholders for a sample. Compute them once per sample and fill every template with them. """
+
     # for research access samples, pull the sample id and cmo patient id from the metadata
     if sample_data['assay_type'] == "research_access":
         sample_id = sample_data['sample_id']
@@ -29,38 +73,72 @@ def get_bams(sample_data, template):
         anon_id = sample_data['anon_id']
         fl, sl = anon_id[0], anon_id[1]
 
-    # replace placeholders with the metadata
-    bam_path = (
-        template
-        .replace("{sample_id}", sample_id)
-        .replace("{cmo_patient_id}", cmo_patient_id)
-        .replace("{anon_id}", anon_id)
-        .replace("{anon_id_fl}", fl)
-        .replace("{anon_id_sl}", sl)
-    )
+    return {"sample_id": sample_id, "cmo_patient_id": cmo_patient_id, "anon_id": anon_id, "anon_id_fl": fl, "anon_id_sl": sl}
 
-    # only return the bam path if it is valid
+def fill_bam_template(sample_data, template):
+    """ Replace the placeholders of a BAM template with the sample metadata. """
+    return compile_bam_template(template).fill(get_template_fields(sample_data))
+
+def resolve_bam_path(bam_path):
+    """ Return the real path of a BAM file if the BAM and its index exist, otherwise MISSING_PATH. """
     if validate_bam(bam_path):
         return(str(os.path.realpath(bam_path)))
     else:
         return "MISSING_PATH"
 
+@perf.timed
+def resolve_bam_paths(bam_paths, workers=8):
+    """
+    Validate and resolve a batch of BAM paths, e.g. all BAMs of a patient or of a cohort.
+    The directories of the BAMs are listed once each on a thread pool before the paths are checked.
+    Returns a dictionary of BAM path -> real path, or MISSING_PATH if the BAM or its index is missing.
+    """
+
+    unique_paths = list(dict.fromkeys(bam_paths))
+    bam_dirs = {os.path.dirname(bam_path) for bam_path in unique_paths}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # prefetch the directory listings, then resolve the paths (os.path.realpath still stats each path component)
+        list(executor.map(list_directory, bam_dirs))
+        resolved_paths = list(executor.map(resolve_bam_path, unique_paths))
+
+    return dict(zip(unique_paths, resolved_paths))
+
+@lru_cache(maxsize=None)
+def list_directory(dir_path):
+    """ List a directory once with os.scandir. Returns a dictionary of entry name -> DirEntry, empty if the directory can't be read. """
+    try:
+        with os.scandir(dir_path) as entries:
+            return {entry.name: entry for entry in entries}
+    except OSError:
+        return {}
+
+def is_listed_file(path):
+    """ Check if a path is an existing file (following symlinks) using the memoized listing of its directory. """
+    entry = list_directory(os.path.dirname(path)).get(os.path.basename(path))
+    if entry is None:
+        return False
+    try:
+        return entry.is_file()
+    except OSError:
+        return False
 
+@perf.timed
 def validate_bam(bam_path):
     """
     Check if a BAM file and its index file (.bai) exist at the expected location.
     Returns True if both are present, False otherwise. 
     """
 
-    # check if the real path of the bam path exists
-    if not os.path.isfile(os.path.realpath(bam_path)):
+    # check if the bam path exists, following symlinks
+    if not is_listed_file(bam_path):
         print(f"[ERROR] BAM file not found: {bam_path}.")
         return False
 
     # Check for .bam.bai or .bai index file in the same directory
     bai_path_1 = bam_path + ".bai"
     bai_path_2 = bam_path.replace(".bam", ".bai")
-    if os.path.isfile(bai_path_1) or os.path.isfile(bai_path_2):
+    if is_listed_file(bai_path_1) or is_listed_file(bai_path_2):
         return True
     else:
         print(f"[WARNING] BAM index file (.bai) not found for: {bam_path}")
@@ -1,12 +1,18 @@
 import sys
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import hashlib
 import json
-import pandas as pd
 import argparse
 import csv
 import re
 import logging
 import os
+import sqlite3
+import tempfile
+import perf
+import sample_registry
 
 """
 Script to read in the CMO/DMP sample IDs and retrieve all associated 
@@ -15,54 +21,141 @@ research access, clinical access, and clinical impact samples.
 Samples specified in the include and exclude files will be filtered as well.
 
 Output is one JSON file per patient, containing all samples relevant to the patient under a combined cmo/dmp id.
+Optionally the patients and samples of the whole cohort are also written to a SQLite registry (see sample_registry.py).
+Given the registry of a previous run, only the JSONs of the patients whose samples changed since that run are written.
 """
 
-def get_all_samples(id_mapping_file, research_access_bam_dir_template, clinical_access_key_file, clinical_impact_key_file, include_samples_file, exclude_samples_file, clinical_access_sample_regex_pattern, clinical_impact_sample_regex_pattern):
-    """ Main logic function to get all samples from the id mapping file, split them by patient, get the relevant samples, and save to JSON. """
+# Order of the samples in a patient JSON, by assay type and then by sample id, so a patient JSON only changes when its samples do
+ASSAY_TYPE_ORDER = ["research_access", "clinical_access", "clinical_impact"]
+
+def get_all_samples(id_mapping_file, research_access_bam_dir_template, clinical_access_key_file, clinical_impact_key_file, include_samples_file, exclude_samples_file, clinical_access_sample_regex_pattern, clinical_impact_sample_regex_pattern, key_index_cache_dir=None, workers=1, registry=None, previous_registry=None):
+    """
+    Main logic function to get all samples from the id mapping file, split them by patient, get the relevant samples, and save to JSON.
+    With a previous registry, the JSON of a patient is only saved if the patient is new or its samples changed.
+    """
+
+    perf.reset()
 
     # Extract the cmo ids, dmp ids, and combined ids from the input file.
     id_list = get_id_mapping(id_mapping_file)
 
-    # Go through each patient one by one
-    for patient_data in id_list:
-        
-        # Get all the ids of the patient
-        combined_id = patient_data["combined_id"]
-        cmo_id = patient_data["cmo_id"]
-        dmp_id = patient_data["dmp_id"]
-        sample_dict = { combined_id: patient_data }
-
-        # If the patient has a cmo id, find any samples that need to be included/excluded, then get all research samples
-        if cmo_id: 
-            cmo_include_list = get_include_list(include_samples_file, cmo_id)
-            cmo_exclude_list = get_exclude_list(exclude_samples_file, cmo_id)
-            find_research_samples(cmo_include_list, cmo_exclude_list, research_access_bam_dir_template, cmo_id, combined_id, sample_dict)
-        
-        # If the patient has a dmp id, find any samples that need to be included/excluded, then get all clinical samples
-        if dmp_id:
-            dmp_exclude_list = get_exclude_list(exclude_samples_file, dmp_id)
-            find_clinical_samples(clinical_impact_key_file, clinical_access_key_file, dmp_id, combined_id, dmp_exclude_list, sample_dict, clinical_access_sample_regex_pattern, clinical_impact_sample_regex_pattern)
- 
-        # Save the final dictionary to json
-        save_to_json(sample_dict, combined_id)
+    # Read each clinical key file once into a dmp_id -> [(sample_id, anon_id)] index, or load it from the on-disk cache
+    dmp_ids = [patient_data["dmp_id"] for patient_data in id_list if patient_data["dmp_id"]]
+    clinical_access_key_index = load_dmp_key_index(clinical_access_key_file, clinical_access_sample_regex_pattern, dmp_ids, key_index_cache_dir)
+    clinical_impact_key_index = load_dmp_key_index(clinical_impact_key_file, clinical_impact_sample_regex_pattern, dmp_ids, key_index_cache_dir)
+
+    # Read the include and exclude files once, grouped by patient id
+    include_lists = load_sample_lists(include_samples_file)
+    exclude_lists = load_sample_lists(exclude_samples_file)
+
+    # The patients of the previous run, to compare the samples found now against
+    previous_patients = sample_registry.load_patients(previous_registry) if previous_registry else None
+
+    get_patient_samples = partial(
+        find_patient_samples,
+        research_access_bam_dir_template=research_access_bam_dir_template,
+        clinical_access_key_index=clinical_access_key_index,
+        clinical_impact_key_index=clinical_impact_key_index,
+        include_lists=include_lists,
+        exclude_lists=exclude_lists,
+        previous_patients=previous_patients
+    )
+
+    # Go through the patients, fanning the filesystem discovery out over a thread pool when more than one worker is used
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            patients = list(executor.map(get_patient_samples, id_list))
+    else:
+        patients = [get_patient_samples(patient_data) for patient_data in id_list]
     
     if not id_list:
         print("No samples found in input file.")
 
+    if previous_patients is not None:
+        n_changed = sum(is_changed_patient(patient_data, previous_patients) for patient_data, _ in patients)
+        perf.count("patients_changed", n_changed)
+        print(f"[INFO] {n_changed} of {len(patients)} patients are new or changed since {previous_registry}.")
+
+    # The registry is written once for the cohort, after every patient is done
+    if registry:
+        sample_registry.write_registry(registry, patients)
+
+    perf.count("patients", len(id_list))
+    perf.write_report("infer_samples", "infer_samples")
+
+@perf.timed
+def find_patient_samples(patient_data, research_access_bam_dir_template, clinical_access_key_index, clinical_impact_key_index, include_lists, exclude_lists, previous_patients=None):
+    """
+    Get the research and clinical samples of one patient and save them to JSON, unless they are the same as in the previous patients.
+    Returns the patient data and the BAM directory and status of each research sample, for the sample registry.
+    """
+
+    # Get all the ids of the patient
+    combined_id = patient_data["combined_id"]
+    cmo_id = patient_data["cmo_id"]
+    dmp_id = patient_data["dmp_id"]
+    sample_dict = { combined_id: patient_data }
+    sample_states = {}
+
+    # If the patient has a cmo id, find any samples that need to be included/excluded, then get all research samples
+    if cmo_id: 
+        cmo_include_list = include_lists.get(cmo_id, [])
+        cmo_exclude_list = exclude_lists.get(cmo_id, [])
+        find_research_samples(cmo_include_list, cmo_exclude_list, research_access_bam_dir_template, cmo_id, combined_id, sample_dict, sample_states)
+    
+    # If the patient has a dmp id, find any samples that need to be excluded, then get all clinical samples
+    if dmp_id:
+        dmp_exclude_list = exclude_lists.get(dmp_id, [])
+        find_clinical_samples(clinical_impact_key_index, clinical_access_key_index, dmp_id, combined_id, dmp_exclude_list, sample_dict)
+
+    # Sort the samples, so the JSON is the same from one run to the next if the samples are
+    sample_dict[combined_id]["samples"] = sort_samples(sample_dict[combined_id]["samples"])
+
+    # Save the final dictionary to json, if the patient is new or changed since the previous run
+    if is_changed_patient(sample_dict[combined_id], previous_patients):
+        save_to_json(sample_dict, combined_id)
+    else:
+        print(f'{combined_id} unchanged, skipping {combined_id}_all_samples.json.')
+
+    return sample_dict[combined_id], sample_states
+
+def sort_samples(samples):
+    """ Order the samples of a patient by assay type and sample id, instead of the order of the bam directory listing and the key files """
+    return dict(sorted(samples.items(), key=lambda item: (ASSAY_TYPE_ORDER.index(item[1]["assay_type"]), item[0])))
+
+def is_changed_patient(patient_data, previous_patients):
+    """ Check if a patient is new or has different samples than in the previous patients. Every patient is changed without previous patients. """
+    if previous_patients is None:
+        return True
+    return previous_patients.get(patient_data["combined_id"]) != patient_data
 
-def find_research_samples(include_list, exclude_list, research_access_bam_dir_template, cmo_id, combined_id, sample_dict):
+
+@perf.timed
+def find_research_samples(include_list, exclude_list, research_access_bam_dir_template, cmo_id, combined_id, sample_dict, sample_states=None):
 
     # Get the root path of the access bam directory for the patient by removing the sample/current 
     research_access_bam_dir_root = research_access_bam_dir_template.split("/{sample_id}")[0].replace("{cmo_patient_id}", cmo_id)
 
     # Use the folders in the directory to get the research sample names
-    research_sample_names = [ sample_name for sample_name in os.listdir(research_access_bam_dir_root)
-        # Only keep the research samples that have a "current" folder and at least one existing bam file
-        if is_valid_research_sample(sample_name, research_access_bam_dir_root)]
+    research_sample_statuses = { sample_name: get_research_sample_status(sample_name, research_access_bam_dir_root)
+        for sample_name in sorted(os.listdir(research_access_bam_dir_root)) }
+    # Only keep the research samples that have a "current" folder and at least one existing bam file
+    research_sample_names = [ sample_name for sample_name, status in research_sample_statuses.items() if status == sample_registry.VALID_STATUS ]
 
     # include and exclude samples based on input lists
     filtered_research_samples = filter_research_samples(research_sample_names, include_list, exclude_list)
 
+    # Record where the bams of every research sample are and why a sample was left out, for the sample registry
+    if sample_states is not None:
+        for sample_id in research_sample_names:
+            if sample_id not in filtered_research_samples:
+                research_sample_statuses[sample_id] = "excluded"
+        for sample_id in filtered_research_samples:
+            research_sample_statuses[sample_id] = sample_registry.VALID_STATUS
+        for sample_id, status in research_sample_statuses.items():
+            bam_dir = os.path.join(research_access_bam_dir_root, sample_id, "current")
+            sample_states[sample_id] = { "bam_dir": bam_dir, "status": status }
+
     # add each sample to the sample dictionary
     for sample_id in filtered_research_samples:
         sample_dict[combined_id]["samples"][sample_id] = {
@@ -75,19 +168,23 @@ def find_research_samples(include_list, exclude_list, research_access_bam_dir_te
 
 def is_valid_research_sample(sample_name, research_access_bam_dir):
     """ Checks if an access research sample has a current directory with at least one bam file """
+    return get_research_sample_status(sample_name, research_access_bam_dir) == sample_registry.VALID_STATUS
+
+def get_research_sample_status(sample_name, research_access_bam_dir):
+    """ Get the status of an access research sample: valid, or why it is left out (missing_current_dir or no_bam) """
 
     # Check if current directory exists
     current_path = os.path.join(research_access_bam_dir, sample_name, "current")
     if not os.path.isdir(current_path):
         print(f'{sample_name} missing current directory.')
-        return False
+        return "missing_current_dir"
 
     # Check for bam file
     if not any(f.endswith(".bam") for f in os.listdir(current_path)):
         print(f'{sample_name} has no bam files in current directory.')
-        return False
+        return "no_bam"
 
-    return True
+    return sample_registry.VALID_STATUS
 
 def filter_research_samples(sample_list, include_list, exclude_list):
     """ Go through the list of research samples and adds from the include list and removes from the exclude list """
@@ -121,24 +218,121 @@ def infer_tumor_normal(sample_id):
     
     return sample_type
 
-def find_clinical_samples(clinical_impact_key_file, clinical_access_key_file, dmp_id, combined_id, exclude_list, sample_dict, clinical_access_sample_regex_pattern, clinical_impact_sample_regex_pattern):
+@perf.timed
+def find_clinical_samples(clinical_impact_key_index, clinical_access_key_index, dmp_id, combined_id, exclude_list, sample_dict):
     
-    # Search the impact key file for matching samples by dmp_id
-    clinical_access_samples = search_dmp_key_file(clinical_access_key_file, "clinical_access", clinical_access_sample_regex_pattern, combined_id, dmp_id, exclude_list, sample_dict)
-    clinical_impact_samples = search_dmp_key_file(clinical_impact_key_file, "clinical_impact", clinical_impact_sample_regex_pattern, combined_id, dmp_id, exclude_list, sample_dict)
-
-def search_dmp_key_file(dmp_key_path, assay_type, regex_pattern, combined_id, dmp_id, exclude_list, sample_dict):
-    # Go through each line in the key file and search for the dmp id and sample pattern
+    # Look up the matching samples by dmp_id in the access and impact key file indexes
+    search_dmp_key_index(clinical_access_key_index, "clinical_access", combined_id, dmp_id, exclude_list, sample_dict)
+    search_dmp_key_index(clinical_impact_key_index, "clinical_impact", combined_id, dmp_id, exclude_list, sample_dict)
+
+def search_dmp_key_index(key_index, assay_type, combined_id, dmp_id, exclude_list, sample_dict):
+    """ Add every sample of the dmp id found in the key file index to the sample dictionary """
+    for sample_id, anon_id in key_index.get(dmp_id, []):
+        # Skip the sample if it is in the exclude list, otherwise add the sample to the sample dictionary
+        if sample_id in exclude_list:
+            print(f"Excluded sample: {sample_id}.")
+            continue
+        sample_dict[combined_id]["samples"][sample_id] = { "sample_id": sample_id, "tumor_normal": infer_tumor_normal(sample_id), "assay_type": assay_type, "anon_id": anon_id }
+
+@perf.timed
+def build_dmp_key_index(dmp_key_path, regex_pattern):
+    """
+    Read a clinical key file once and index the samples matching the regex pattern by dmp id.
+    Returns a dictionary of dmp_id -> [(sample_id, anon_id)] in key file order.
+    """
+
+    # The dmp id is the first two dash separated fields of the sample id at the start of the line, e.g. P-0012345
+    key_line_pattern = re.compile(rf"(?P<dmp_id>[^-,]+-[^-,]+)-{regex_pattern}")
+    key_index = defaultdict(list)
+    n_lines = 0
+
+    # Go through each line in the key file and index the lines matching the sample pattern
     with open(dmp_key_path, 'r') as key_file:
-        for line in key_file:
-            if re.search(rf"{dmp_id}-{regex_pattern}", line):
-                # Get the sample name and anon id from the line in the key file
-                sample_id, anon_id, sample_type = parse_key_line(line)
-                # Skip the sample if it is in the exclude list, otherwise add the sample to the sample dictionary
-                if sample_id in exclude_list:
-                    print(f"Excluded sample: {sample_id}.")
-                    continue
-                sample_dict[combined_id]["samples"][sample_id] = { "sample_id": sample_id, "tumor_normal": sample_type, "assay_type": assay_type, "anon_id": anon_id }
+        for n_lines, line in enumerate(key_file, 1):
+            match = key_line_pattern.match(line)
+            if not match:
+                continue
+            # Get the sample name and anon id from the line in the key file
+            sample_id, anon_id, sample_type = parse_key_line(line)
+            key_index[match.group("dmp_id")].append((sample_id, anon_id))
+
+    perf.count("rows_key_file", n_lines)
+    return key_index
+
+
+@perf.timed
+def load_dmp_key_index(dmp_key_path, regex_pattern, dmp_ids, cache_dir=None):
+    """
+    Get the key file index for the given dmp ids. Without a cache directory the key file is read directly.
+    With a cache directory, the index is kept in a SQLite file that is only rebuilt when the key file changes.
+    """
+
+    if not cache_dir:
+        return build_dmp_key_index(dmp_key_path, regex_pattern)
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # The cache is keyed by the real path of the key file and the regex pattern, and is invalidated by size and mtime
+    real_key_path = os.path.realpath(dmp_key_path)
+    key_stat = os.stat(real_key_path)
+    cache_state = {
+        "source_path": real_key_path,
+        "source_size": str(key_stat.st_size),
+        "source_mtime_ns": str(key_stat.st_mtime_ns),
+        "regex_pattern": regex_pattern,
+    }
+    cache_name = hashlib.sha1(f"{real_key_path}:{regex_pattern}".encode()).hexdigest()[:16]
+    cache_path = os.path.join(cache_dir, f"{os.path.basename(real_key_path)}.{cache_name}.sqlite")
+
+    if read_key_index_cache_state(cache_path) != cache_state:
+        print(f"Building key file index cache {cache_path}.")
+        write_key_index_cache(cache_path, build_dmp_key_index(real_key_path, regex_pattern), cache_state)
+    else:
+        print(f"Using key file index cache {cache_path}.")
+
+    return query_key_index_cache(cache_path, dmp_ids)
+
+def read_key_index_cache_state(cache_path):
+    """ Return the source file state stored in a key index cache, or None if the cache is missing or unreadable """
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with sqlite3.connect(cache_path) as conn:
+            return dict(conn.execute("SELECT key, value FROM cache_state"))
+    except sqlite3.Error as e:
+        print(f"[WARNING] Could not read key index cache {cache_path}: {e}")
+        return None
+
+def write_key_index_cache(cache_path, key_index, cache_state):
+    """ Write the key file index to a SQLite file, indexed by dmp id. The file is replaced atomically so concurrent runs never see a partial cache. """
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix=".tmp")
+    os.close(fd)
+    try:
+        with sqlite3.connect(tmp_path) as conn:
+            conn.execute("CREATE TABLE cache_state (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute("CREATE TABLE samples (dmp_id TEXT, position INTEGER, sample_id TEXT, anon_id TEXT)")
+            conn.executemany("INSERT INTO cache_state VALUES (?, ?)", cache_state.items())
+            conn.executemany(
+                "INSERT INTO samples VALUES (?, ?, ?, ?)",
+                ((dmp_id, position, sample_id, anon_id) for dmp_id, samples in key_index.items() for position, (sample_id, anon_id) in enumerate(samples))
+            )
+            conn.execute("CREATE INDEX samples_dmp_id ON samples (dmp_id)")
+        conn.close()
+        os.replace(tmp_path, cache_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def query_key_index_cache(cache_path, dmp_ids):
+    """ Read the indexed samples of the given dmp ids from a key index cache, keeping key file order """
+    key_index = defaultdict(list)
+    with sqlite3.connect(cache_path) as conn:
+        for dmp_id in set(dmp_ids):
+            rows = conn.execute("SELECT sample_id, anon_id FROM samples WHERE dmp_id = ? ORDER BY position", (dmp_id,))
+            key_index[dmp_id] = [(sample_id, anon_id) for sample_id, anon_id in rows]
+    conn.close()
+    return key_index
 
 
 # Function to get the sample_id, sample_type, and anon_id from a line in an impact or access key file
@@ -158,9 +352,11 @@ def parse_key_line(line):
 
     return sample_id, anon_id, sample_type
 
+@perf.timed
 def get_id_mapping(id_mapping_file):
-    """ Read in the cmo and dmp ids, generate the combined patient id, and save each patient id in a list. """
+    """ Read in the cmo and dmp ids, generate the combined patient id, and save each patient id in a list. A patient listed twice is only kept once. """
     id_list = []
+    combined_ids = set()
 
     # Go through each row of the input id csv and extract the ids
     with open(id_mapping_file, newline='') as ids:
@@ -171,44 +367,40 @@ def get_id_mapping(id_mapping_file):
             # Create a combined cmo/dmp id
             combined_id = get_combined_patient_id(cmo_id, dmp_id)
             # Add an entry with all the patient data to the list if the row is not empty
-            if cmo_id or dmp_id:
-                id_list.append({ "combined_id": combined_id, "cmo_id": cmo_id, "dmp_id": dmp_id, "samples": {} })
+            if not (cmo_id or dmp_id):
+                continue
+            if combined_id in combined_ids:
+                print(f"[WARNING] {combined_id} is listed more than once in {id_mapping_file}, using the first row.")
+                continue
+            combined_ids.add(combined_id)
+            id_list.append({ "combined_id": combined_id, "cmo_id": cmo_id, "dmp_id": dmp_id, "samples": {} })
 
     return id_list
 
-def get_include_list(include_samples_file, patient_id):
-    """ Read in the include csv file and return samples to include that match the given patient id """
-    include_list = []
-    with open(include_samples_file, newline='') as include:
-        reader = csv.reader(include)
-        # Go through each sample
-        for row in reader:
-            # Skip empty lines
-            if not row or not row[0].strip():
-                continue
-            # Get the sample id
-            sample_id = row[0].strip()
-            # Check if the sample id belongs to the patient
-            if sample_id.startswith(f"{patient_id}-"):
-                include_list.append(sample_id)
+@perf.timed
+def load_sample_lists(samples_file):
+    """ Read in an include or exclude csv file once and group the sample ids by the patient id they belong to """
+    sample_lists = defaultdict(list)
 
-    return include_list
+    # The include and exclude files are optional
+    if not samples_file:
+        return sample_lists
 
-def get_exclude_list(exclude_samples_file, patient_id):
-    """ Read in the exclude csv file return samples to exclude that match the given patient id """
-    exclude_list = []
-    with open(exclude_samples_file, newline='') as exclude:
-        reader = csv.reader(exclude)
+    with open(samples_file, newline='') as samples:
+        reader = csv.reader(samples)
+        # Go through each sample
         for row in reader:
             # Skip empty lines
             if not row or not row[0].strip():
                 continue
             # Get the sample id
             sample_id = row[0].strip()
-            # Check if the sample id belongs to the patient
-            if sample_id.startswith(f"{patient_id}-"):
-                exclude_list.append(sample_id)
-    return exclude_list
+            # The patient id is the first two fields of the sample id, e.g. C-XXXXXX-L001-d belongs to C-XXXXXX
+            id_fields = sample_id.split("-")
+            if len(id_fields) > 2:
+                sample_lists["-".join(id_fields[:2])].append(sample_id)
+
+    return sample_lists
 
 def get_combined_patient_id(cmo_id, dmp_id):
     """ Create a combined patient id if both cmo and dmp id exist. Otherwise return whichever id exists """
@@ -221,6 +413,7 @@ def get_combined_patient_id(cmo_id, dmp_id):
     else:
         return ""
 
+@perf.timed
 def save_to_json(sample_dict, patient_id):
     """ Save dictionary with patient and sample information to a JSON file """
 
@@ -229,7 +422,7 @@ def save_to_json(sample_dict, patient_id):
 
     print(f'Saved {patient_id}_all_samples.json.')
 
-if __name__ == "__main__":
+def main(argv=None):
     parser = argparse.ArgumentParser(description="Generate BAM paths.")
     parser.add_argument("--id_mapping_file", required=True)
     parser.add_argument("--include_samples_file", required=False)
@@ -239,6 +432,13 @@ if __name__ == "__main__":
     parser.add_argument("--research_access_bam_dir_template", required=True)
     parser.add_argument("--clinical_access_sample_regex_pattern", required=True)
     parser.add_argument("--clinical_impact_sample_regex_pattern", required=True)
-    args = parser.parse_args()
+    parser.add_argument("--key_index_cache_dir", required=False, help="Directory for the cached key file indexes. Key files are read directly if not given.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of threads used to discover the samples of the patients in parallel.")
+    parser.add_argument("--registry", required=False, help="SQLite sample registry to write the patients and samples of the cohort to, besides the patient JSONs.")
+    parser.add_argument("--previous_registry", required=False, help="Sample registry of a previous run. Only the JSONs of the patients that are new or changed since that run are written.")
+    args = parser.parse_args(argv)
 
-    get_all_samples(args.id_mapping_file, args.research_access_bam_dir_template, args.clinical_access_key_file, args.clinical_impact_key_file, args.include_samples_file, args.exclude_samples_file, args.clinical_access_sample_regex_pattern, args.clinical_impact_sample_regex_pattern)
\ No newline at end of file
+    get_all_samples(args.id_mapping_file, args.research_access_bam_dir_template, args.clinical_access_key_file, args.clinical_impact_key_file, args.include_samples_file, args.exclude_samples_file, args.clinical_access_sample_regex_pattern, args.clinical_impact_sample_regex_pattern, args.key_index_cache_dir, args.workers, args.registry, args.previous_registry)
+
+if __name__ == "__main__":
+    main()
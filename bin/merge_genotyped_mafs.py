@@ -0,0 +1,83 @@
+import os
+import glob
+import argparse
+from collections import defaultdict
+import pandas as pd
+from genotype_variants_input import get_site_order
+from split_genotyped_mafs import assign_mafs_to_samples
+import genotype_cache
+
+"""
+Script that stitches the genotyped mafs of the shards of a patient back together (see genotype_variants_input.py --shards).
+Every shard writes the same set of genotyped maf names, one per sample and read type. The shards of each name are concatenated
+and sorted by chromosome and position, and the merged mafs are written under the same names for filter_calls.py.
+
+With a genotype cache plan (see genotype_variants_input.py --genotype_cache_dir), the freshly genotyped rows of each cached
+sample are stored in the cache, and the genotyped mafs of the sample are rebuilt from the cache for every site of the patient,
+with the counts from the cache and the other columns from the current all calls maf.
+"""
+
+def merge_genotyped_mafs(shard_mafs, output_dir=".", cache_plan=None, genotype_cache_dir=None):
+    """ Concatenate the shard mafs that share a file name and write one merged maf per name. """
+
+    mafs_by_name = defaultdict(list)
+    for maf in sorted(shard_mafs):
+        mafs_by_name[os.path.basename(maf)].append(maf)
+
+    merged_mafs = {
+        name: pd.concat([pd.read_csv(maf, sep="\t", dtype=str, keep_default_na=False) for maf in mafs], ignore_index=True)
+        for name, mafs in mafs_by_name.items()
+    }
+
+    if cache_plan:
+        add_cached_genotypes(merged_mafs, cache_plan, genotype_cache_dir)
+
+    os.makedirs(output_dir, exist_ok=True)
+    for name, merged in merged_mafs.items():
+        merged = merged.iloc[get_site_order(merged)]
+        merged.to_csv(os.path.join(output_dir, name), sep="\t", index=False)
+
+    print(f"[INFO] {len(shard_mafs)} shard mafs merged into {len(merged_mafs)} genotyped mafs.")
+
+def add_cached_genotypes(merged_mafs, cache_plan, genotype_cache_dir):
+    """
+    Store the fresh rows of each cached sample in the genotype cache, then replace its genotyped mafs with the cached rows
+    of every site of the patient. Samples with an empty bam key in the plan were genotyped at every site and are left as they are.
+    """
+
+    plan = pd.read_csv(cache_plan, sep="\t", dtype=str, keep_default_na=False)
+    maf_owners = assign_mafs_to_samples(plan['sample_id'], list(merged_mafs))
+
+    patient_sites = {}
+    for sample in plan.itertuples(index=False):
+        if not sample.bam_key:
+            continue
+
+        sample_mafs = {name[len(sample.sample_id):]: merged_mafs[name] for name, owner in maf_owners.items() if owner == sample.sample_id}
+        n_new = genotype_cache.write_genotypes(genotype_cache_dir, sample.bam_key, sample_mafs)
+
+        if sample.all_calls_maf not in patient_sites:
+            calls = pd.read_csv(sample.all_calls_maf, sep="\t", dtype=str, keep_default_na=False)
+            patient_sites[sample.all_calls_maf] = (calls, genotype_cache.get_site_keys(calls) if not calls.empty else [])
+        calls, site_keys = patient_sites[sample.all_calls_maf]
+
+        # the counts come from the cache, the annotation of the variants from the current calls
+        cached_mafs = genotype_cache.read_cached_genotypes(genotype_cache_dir, sample.bam_key, site_keys)
+        for maf_suffix, cached_rows in cached_mafs.items():
+            merged_mafs[f"{sample.sample_id}{maf_suffix}"] = genotype_cache.refresh_call_columns(cached_rows, calls)
+
+        print(f"[INFO] {sample.sample_id}: {n_new} sites genotyped, {sample.cached_sites} sites from the cache.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge the genotyped mafs of genotyping shards.")
+    parser.add_argument("--shard_dirs", required=False, nargs="*", default=[], help="Directories with the genotyped mafs of each shard.")
+    parser.add_argument("--output_dir", default=".")
+    parser.add_argument("--cache_plan", required=False, help="Genotype cache plan from genotype_variants_input.py.")
+    parser.add_argument("--genotype_cache_dir", required=False, help="Directory of the genotype cache, required with --cache_plan.")
+    args = parser.parse_args()
+
+    if args.cache_plan and not args.genotype_cache_dir:
+        parser.error("--genotype_cache_dir is required with --cache_plan")
+
+    shard_mafs = [maf for shard_dir in args.shard_dirs for maf in glob.glob(os.path.join(shard_dir, "*.maf"))]
+    merge_genotyped_mafs(shard_mafs, args.output_dir, args.cache_plan, args.genotype_cache_dir)
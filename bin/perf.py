@@ -0,0 +1,180 @@
+import os
+import sys
+import json
+import time
+import glob
+import argparse
+import resource
+import threading
+from functools import wraps
+from collections import defaultdict
+
+"""
+Helper script with optional performance instrumentation for the pipeline stages, enabled by setting the ACCESS_PERF environment variable.
+The stages wrap their main functions with @perf.timed and count the rows they process with perf.count. When enabled, the wall time
+and number of calls of every timed function are recorded, together with the bytes read, files opened, stat calls and directory listings
+of the process. perf.write_report writes them with the peak RSS to {name}_perf.json next to the outputs of the stage.
+Without ACCESS_PERF nothing is recorded and the timed functions are called directly.
+
+Run as a script, it aggregates the reports of a run into a MultiQC custom content table (pipeline_perf_mqc.json).
+"""
+
+PERF_ENV = "ACCESS_PERF"
+
+ENABLED = bool(os.environ.get(PERF_ENV))
+
+_lock = threading.Lock()
+_functions = defaultdict(lambda: {"calls": 0, "seconds": 0.0})
+_counters = defaultdict(int)
+_start = {}
+
+def is_enabled():
+    return ENABLED
+
+def timed(function):
+    """ Decorator that records the wall time and number of calls of a function, named after the function. """
+
+    name = function.__name__
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if not ENABLED:
+            return function(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            with _lock:
+                _functions[name]["calls"] += 1
+                _functions[name]["seconds"] += elapsed
+
+    return wrapper
+
+def count(counter, n=1):
+    """ Add n to a counter of the report, e.g. the rows parsed by a stage. """
+    if ENABLED:
+        with _lock:
+            _counters[counter] += n
+
+def reset():
+    """
+    Start a new report. The functions and counters recorded so far are dropped, and the bytes read and wall time of the report start
+    from here, so a process that handles several patients one after another can write one report per patient.
+    """
+    # read outside the lock, the open of /proc/self/io is counted by the audit hook
+    bytes_read = read_process_io().get("rchar", 0)
+    with _lock:
+        _functions.clear()
+        _counters.clear()
+        _start.update({"time": time.perf_counter(), "bytes_read": bytes_read})
+
+def write_report(name, stage):
+    """ Write the recorded metrics to {name}_perf.json. Does nothing unless instrumentation is enabled. Returns the report path. """
+
+    if not ENABLED:
+        return None
+
+    bytes_read = read_process_io().get("rchar", 0)
+    with _lock:
+        report = {
+            "name": name,
+            "stage": stage,
+            "wall_seconds": round(time.perf_counter() - _start["time"], 6),
+            # ru_maxrss is the peak of the whole process so far, in kilobytes on Linux
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "bytes_read": bytes_read - _start["bytes_read"],
+            "counters": dict(sorted(_counters.items())),
+            "functions": {
+                function: {"calls": stats["calls"], "seconds": round(stats["seconds"], 6)}
+                for function, stats in sorted(_functions.items(), key=lambda item: -item[1]["seconds"])
+            },
+        }
+
+    report_path = f"{name}_perf.json"
+    with open(report_path, "w") as out:
+        json.dump(report, out, indent=4)
+    return report_path
+
+def read_process_io():
+    """ Read the I/O counters of the process from /proc/self/io. rchar counts every byte read through a read call. Empty if not available. """
+    try:
+        with open("/proc/self/io") as io_file:
+            return {key: int(value) for key, value in (line.split(": ") for line in io_file)}
+    except (OSError, ValueError):
+        return {}
+
+def audit_hook(event, args):
+    """ Count the files opened and the directories listed, from the audit events of the interpreter. """
+    if not ENABLED:
+        return
+    if event == "open":
+        count("file_opens")
+    elif event in ("os.scandir", "os.listdir"):
+        count("dir_listings")
+
+def count_stats(stat_function):
+    """ Wrap os.stat or os.lstat to count the calls. os.path.exists, isdir, isfile and realpath all go through them. """
+
+    @wraps(stat_function)
+    def wrapper(*args, **kwargs):
+        count("stat_calls")
+        return stat_function(*args, **kwargs)
+
+    return wrapper
+
+def install():
+    """ Start recording for the whole process: count stat calls, file opens and directory listings from here on. """
+    os.stat = count_stats(os.stat)
+    os.lstat = count_stats(os.lstat)
+    sys.addaudithook(audit_hook)
+    reset()
+
+if ENABLED:
+    install()
+
+def summarize_reports(report_paths, output_path="pipeline_perf_mqc.json"):
+    """ Aggregate perf reports into a MultiQC custom content table with one row per report. """
+
+    data = {}
+    for report_path in sorted(report_paths):
+        with open(report_path) as report_file:
+            report = json.load(report_file)
+
+        slowest = next(iter(report["functions"].items()), ("", {"seconds": 0.0}))
+        counters = report["counters"]
+        data[report["name"]] = {
+            "stage": report["stage"],
+            "wall_seconds": report["wall_seconds"],
+            "peak_rss_mb": report["peak_rss_mb"],
+            "read_mb": round(report["bytes_read"] / 1024 ** 2, 2),
+            "stat_calls": counters.get("stat_calls", 0),
+            "file_opens": counters.get("file_opens", 0),
+            "dir_listings": counters.get("dir_listings", 0),
+            "rows": sum(value for counter, value in counters.items() if counter.startswith("rows_")),
+            "slowest_function": slowest[0],
+            "slowest_function_seconds": slowest[1]["seconds"],
+        }
+
+    custom_content = {
+        "id": "pipeline_perf",
+        "section_name": "Pipeline stage performance",
+        "description": "Wall time, peak memory, I/O and the slowest function of each stage run, from the perf reports of the bin/ scripts.",
+        "plot_type": "table",
+        "pconfig": {"id": "pipeline_perf_table", "title": "Pipeline stage performance"},
+        "data": data,
+    }
+
+    with open(output_path, "w") as out:
+        json.dump(custom_content, out, indent=4)
+
+    print(f"[INFO] {len(data)} perf reports summarized in {output_path}.")
+    return output_path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize the perf reports of a run for MultiQC.")
+    parser.add_argument("--perf_dir", required=True, help="Directory with the *_perf.json reports.")
+    parser.add_argument("--output", default="pipeline_perf_mqc.json")
+    args = parser.parse_args()
+
+    summarize_reports(glob.glob(os.path.join(args.perf_dir, "*_perf.json")), args.output)
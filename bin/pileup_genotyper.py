@@ -0,0 +1,260 @@
+import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from genotype_variants_input import BAM_COLS, get_site_order
+
+try:
+    import pysam
+    PYSAM_AVAILABLE = True
+except ImportError:
+    PYSAM_AVAILABLE = False
+
+"""
+Script that genotypes the variants of a genotyping input table from genotype_variants_input.py with pysam pileups, as an alternative
+to genotype_variants with GetBaseCountsMultiSample. For every site of the maf of a row, the reads and fragments of the row's BAMs
+supporting the reference allele and the alternate allele are counted, as well as all reads and fragments covering the site.
+
+The BAMs are genotyped on a pool of processes, one task per BAM and chunk of sites. A BAM shared by several rows with the same maf,
+e.g. a pooled normal in a cohort table, is genotyped once. The genotyped mafs are written with the names and count columns
+filter_calls.py reads:
+    {sample_id}-ORG-STD_genotyped.maf from the standard bam, with the _standard counts
+    {sample_id}-SIMPLEX-DUPLEX_genotyped.maf from the duplex and simplex bams, with the _simplex_duplex counts of both bams added up
+
+Reads that are unmapped, secondary, supplementary, failing QC or below the mapping quality are not counted. Duplicates are not
+counted unless --keep_duplicates is set. The reads of a fragment are counted as one fragment, which supports an allele if all of
+its reads covering the site do. A fragment whose reads disagree only counts towards the total.
+"""
+
+# Columns that identify a genotyped site
+SITE_COLS = ['Chromosome', 'Start_Position', 'End_Position', 'Reference_Allele', 'Tumor_Seq_Allele2']
+
+# Order of the counts of a site returned by count_site
+COUNT_NAMES = ["ref_count", "alt_count", "total_count", "ref_count_fragment", "alt_count_fragment", "total_count_fragment"]
+
+# Number of sites of a BAM counted in one task of the process pool
+CHUNK_SITES = 500
+
+# Read filters of the pipeline runs, also part of the genotype cache key (GENOTYPER_SETTINGS in genotype_cache.py)
+MIN_MAPPING_QUALITY = 20
+MIN_BASE_QUALITY = 0
+
+# Maximum number of reads piled up at a site, high enough for the depth of duplex and unfiltered ACCESS BAMs
+MAX_DEPTH = 1000000
+
+# BAMs opened by the current process, kept open across the chunks of sites the process counts
+_alignment_files = {}
+
+def genotype_input_table(genotyping_input, workers=1, chunk_sites=CHUNK_SITES, min_mapping_quality=MIN_MAPPING_QUALITY,
+                         min_base_quality=MIN_BASE_QUALITY, filter_duplicates=True, output_dir="."):
+    """ Main function to genotype every row of a genotyping input table and write the genotyped mafs of each sample. """
+
+    if not PYSAM_AVAILABLE:
+        raise ImportError("pysam is needed to genotype with pileup_genotyper.py")
+
+    table = pd.read_csv(genotyping_input, sep="\t", dtype=str, keep_default_na=False)
+    if table.empty:
+        print(f"[INFO] {genotyping_input} has no samples to genotype.")
+        return
+
+    # read the sites of each maf once, in genomic order
+    mafs = {}
+    for maf in table['maf'].unique():
+        maf_data = pd.read_csv(maf, sep="\t", dtype=str, keep_default_na=False)
+        mafs[maf] = maf_data.iloc[get_site_order(maf_data)].reset_index(drop=True)
+
+    # count every BAM once per maf, split into chunks of sites
+    bam_mafs = list(dict.fromkeys((bam, row.maf) for row in table.itertuples(index=False) for bam in get_row_bams(row).values()))
+    tasks = [
+        (bam, get_site_tuples(mafs[maf].iloc[start:start + chunk_sites]), min_mapping_quality, min_base_quality, filter_duplicates)
+        for bam, maf in bam_mafs
+        for start in range(0, len(mafs[maf]), chunk_sites)
+    ]
+    print(f"[INFO] Genotyping {len(bam_mafs)} BAMs at {sum(len(maf_data) for maf_data in mafs.values())} sites in {len(tasks)} tasks.")
+
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=close_alignment_files) as executor:
+            chunk_counts = list(executor.map(count_sites, *zip(*tasks), chunksize=1))
+    else:
+        chunk_counts = [count_sites(*task) for task in tasks]
+        close_alignment_files()
+
+    # stitch the chunks of each BAM back together, they are in task order
+    counts_by_bam_maf = {}
+    position = 0
+    for bam, maf in bam_mafs:
+        n_chunks = -(-len(mafs[maf]) // chunk_sites)
+        counts_by_bam_maf[(bam, maf)] = np.concatenate(chunk_counts[position:position + n_chunks]) if n_chunks else np.zeros((0, len(COUNT_NAMES)), dtype=np.int64)
+        position += n_chunks
+
+    os.makedirs(output_dir, exist_ok=True)
+    for row in table.itertuples(index=False):
+        write_genotyped_mafs(row, mafs[row.maf], counts_by_bam_maf, output_dir)
+
+def get_row_bams(row):
+    """ Get the BAMs of a row that can be genotyped. Missing BAMs are skipped with a warning. """
+
+    bams = {}
+    for col in BAM_COLS:
+        bam = getattr(row, col, "")
+        if bam in ("", "NA"):
+            continue
+        if bam == "MISSING_PATH" or not os.path.exists(bam):
+            print(f"[WARNING] {col} of {row.sample_id} is missing, it is not genotyped: {bam}")
+            continue
+        bams[col] = bam
+    return bams
+
+def get_site_tuples(maf_data):
+    """ Get the (chromosome, start, reference allele, alternate allele) of each site of a maf. """
+    return list(zip(maf_data['Chromosome'], maf_data['Start_Position'].astype(int), maf_data['Reference_Allele'], maf_data['Tumor_Seq_Allele2']))
+
+def count_sites(bam_path, sites, min_mapping_quality=MIN_MAPPING_QUALITY, min_base_quality=MIN_BASE_QUALITY, filter_duplicates=True):
+    """ Count the reads and fragments of a BAM at each site of a chunk. Returns an array with one row of COUNT_NAMES per site. """
+
+    bam = get_alignment_file(bam_path)
+    counts = np.zeros((len(sites), len(COUNT_NAMES)), dtype=np.int64)
+    for i, (chromosome, start, ref, alt) in enumerate(sites):
+        counts[i] = count_site(bam, chromosome, start, ref, alt, min_mapping_quality, min_base_quality, filter_duplicates)
+    return counts
+
+def get_alignment_file(bam_path):
+    if bam_path not in _alignment_files:
+        _alignment_files[bam_path] = pysam.AlignmentFile(bam_path, "rb")
+    return _alignment_files[bam_path]
+
+def close_alignment_files():
+    """ Close the BAMs opened by this process. Also run when a pool process starts, so it never reads a BAM handle shared with its parent. """
+    for alignment_file in _alignment_files.values():
+        alignment_file.close()
+    _alignment_files.clear()
+
+def count_site(bam, chromosome, start, ref, alt, min_mapping_quality=MIN_MAPPING_QUALITY, min_base_quality=MIN_BASE_QUALITY, filter_duplicates=True):
+    """
+    Count the reads and fragments supporting the reference and the alternate allele of a maf site, and all reads and fragments covering it.
+    Positions are 1-based as in the maf. Insertions (Reference_Allele "-") and deletions (Tumor_Seq_Allele2 "-") are piled up
+    at the base before the event, where pysam reports the indel of a read. Other sites are piled up at their first base.
+    """
+
+    ref = "" if ref == "-" else ref
+    alt = "" if alt == "-" else alt
+    # 0-based pileup position: maf insertions start at the base before the event, deletions and substitutions at their first base
+    if not ref:
+        position = start - 1
+    elif not alt:
+        position = start - 2
+    else:
+        position = start - 1
+
+    if position < 0 or chromosome not in bam.references:
+        return [0] * len(COUNT_NAMES)
+
+    read_counts = {"ref": 0, "alt": 0, "total": 0}
+    fragment_alleles = {}
+
+    pileup = bam.pileup(
+        chromosome, position, position + 1, truncate=True, stepper="nofilter", max_depth=MAX_DEPTH,
+        ignore_overlaps=False, ignore_orphans=False, min_base_quality=0
+    )
+    for column in pileup:
+        for pileup_read in column.pileups:
+            read = pileup_read.alignment
+            if read.is_unmapped or read.is_secondary or read.is_supplementary or read.is_qcfail or read.mapping_quality < min_mapping_quality:
+                continue
+            if filter_duplicates and read.is_duplicate:
+                continue
+
+            allele = get_read_allele(pileup_read, ref, alt, min_base_quality)
+            if allele is None:
+                continue
+
+            read_counts["total"] += 1
+            if allele in ("ref", "alt"):
+                read_counts[allele] += 1
+            fragment_alleles.setdefault(read.query_name, set()).add(allele)
+
+    fragment_counts = {"ref": 0, "alt": 0}
+    for alleles in fragment_alleles.values():
+        if len(alleles) == 1 and next(iter(alleles)) in fragment_counts:
+            fragment_counts[next(iter(alleles))] += 1
+
+    return [read_counts["ref"], read_counts["alt"], read_counts["total"], fragment_counts["ref"], fragment_counts["alt"], len(fragment_alleles)]
+
+def get_read_allele(pileup_read, ref, alt, min_base_quality=MIN_BASE_QUALITY):
+    """ Get the allele a read supports at a site: "ref", "alt" or "other". Returns None if the read doesn't cover the site with a base. """
+
+    if pileup_read.is_refskip or pileup_read.query_position is None:
+        return None
+
+    read = pileup_read.alignment
+    query_position = pileup_read.query_position
+    if read.query_qualities is not None and read.query_qualities[query_position] < min_base_quality:
+        return None
+
+    indel = pileup_read.indel
+    sequence = read.query_sequence
+
+    # insertion after the pileup base, the inserted bases follow it in the read
+    if not ref:
+        if indel == len(alt) and sequence[query_position + 1:query_position + 1 + indel] == alt:
+            return "alt"
+        return "ref" if indel == 0 else "other"
+
+    # deletion of the bases after the pileup base
+    if not alt:
+        if indel == -len(ref):
+            return "alt"
+        return "ref" if indel == 0 else "other"
+
+    # substitution of one or more bases starting at the pileup base, the read must not have an indel within them
+    read_bases = sequence[query_position:query_position + len(ref)]
+    if len(ref) > 1 and indel != 0:
+        return "other"
+    if len(ref) == len(alt):
+        if read_bases == alt:
+            return "alt"
+        return "ref" if read_bases == ref else "other"
+
+    # complex events replacing the reference bases with a different number of bases
+    if indel == len(alt) - len(ref) and sequence[query_position:query_position + len(alt)] == alt:
+        return "alt"
+    return "ref" if indel == 0 and read_bases == ref else "other"
+
+def write_genotyped_mafs(row, maf_data, counts_by_bam_maf, output_dir="."):
+    """ Write the genotyped mafs of a row of the genotyping input table, with its sample id as the Tumor_Sample_Barcode. """
+
+    bams = get_row_bams(row)
+    read_types = []
+    if "standard_bam" in bams:
+        read_types.append(("ORG-STD", "standard", [bams["standard_bam"]]))
+    if "duplex_bam" in bams or "simplex_bam" in bams:
+        read_types.append(("SIMPLEX-DUPLEX", "simplex_duplex", [bams[col] for col in ["duplex_bam", "simplex_bam"] if col in bams]))
+
+    for maf_suffix, count_suffix, read_type_bams in read_types:
+        counts = sum(counts_by_bam_maf[(bam, row.maf)] for bam in read_type_bams)
+        genotyped = maf_data.copy()
+        genotyped['Tumor_Sample_Barcode'] = row.sample_id
+        for i, count_name in enumerate(COUNT_NAMES):
+            genotyped[get_count_column(count_name, count_suffix)] = counts[:, i]
+
+        output_path = os.path.join(output_dir, f"{row.sample_id}-{maf_suffix}_genotyped.maf")
+        genotyped.to_csv(output_path, sep="\t", index=False)
+        print(f"[INFO] Genotyped maf saved to: {output_path}")
+
+def get_count_column(count_name, count_suffix):
+    """ Name of a count column, e.g. t_alt_count_standard or t_alt_count_fragment_simplex_duplex. """
+    return f"t_{count_name}_{count_suffix}"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Genotype the variants of a genotyping input table with pysam.")
+    parser.add_argument("--genotyping_input", required=True, help="Genotyping input table from genotype_variants_input.py.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes the BAMs and chunks of sites are counted on.")
+    parser.add_argument("--chunk_sites", type=int, default=CHUNK_SITES, help="Number of sites of a BAM counted in one task.")
+    parser.add_argument("--min_mapping_quality", type=int, default=MIN_MAPPING_QUALITY)
+    parser.add_argument("--min_base_quality", type=int, default=MIN_BASE_QUALITY)
+    parser.add_argument("--keep_duplicates", action="store_true", help="Count reads marked as duplicates.")
+    parser.add_argument("--output_dir", default=".")
+    args = parser.parse_args()
+
+    genotype_input_table(args.genotyping_input, args.workers, args.chunk_sites, args.min_mapping_quality, args.min_base_quality, not args.keep_duplicates, args.output_dir)
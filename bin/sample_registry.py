@@ -0,0 +1,133 @@
+import os
+import json
+import sqlite3
+import argparse
+import tempfile
+
+"""
+Helper script with a SQLite registry of the patients and samples of a cohort, written by infer_samples.py --registry.
+The registry has the same patients and samples as the {combined_id}_all_samples.json files, and also the research samples that were
+left out, with the reason, e.g. a sample directory without a current directory or a sample on the exclude list.
+Samples are indexed by sample id and by assay type, so a stage can query its slice of the cohort without reading every patient JSON.
+
+Run as a script, it exports the patient JSONs of a registry.
+"""
+
+# Status of the samples that are in the patient JSONs
+VALID_STATUS = "valid"
+
+def write_registry(registry_path, patients):
+    """
+    Write the registry of a cohort. patients is a list of (patient_data, sample_states) pairs, where patient_data is the dictionary
+    saved to the patient JSON, and sample_states is a dictionary of sample_id -> {"bam_dir", "status"} of the research samples,
+    including the ones that were left out. The file is replaced atomically so a reader never sees a partial registry.
+    """
+
+    registry_dir = os.path.dirname(os.path.abspath(registry_path))
+    fd, tmp_path = tempfile.mkstemp(dir=registry_dir, suffix=".tmp")
+    os.close(fd)
+    conn = None
+    try:
+        conn = sqlite3.connect(tmp_path)
+        with conn:
+            conn.execute("CREATE TABLE patients (combined_id TEXT PRIMARY KEY, cmo_id TEXT, dmp_id TEXT)")
+            conn.execute(
+                "CREATE TABLE samples (combined_id TEXT, position INTEGER, sample_id TEXT, tumor_normal TEXT, assay_type TEXT, anon_id TEXT, "
+                "bam_dir TEXT, status TEXT, PRIMARY KEY (combined_id, sample_id))"
+            )
+            conn.executemany(
+                "INSERT INTO patients VALUES (?, ?, ?)",
+                ((patient_data["combined_id"], patient_data["cmo_id"], patient_data["dmp_id"]) for patient_data, _ in patients)
+            )
+            conn.executemany("INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?, ?, ?)", get_sample_rows(patients))
+            conn.execute("CREATE INDEX samples_sample_id ON samples (sample_id)")
+            conn.execute("CREATE INDEX samples_assay_type ON samples (assay_type, status)")
+        conn.close()
+        conn = None
+        os.replace(tmp_path, registry_path)
+    finally:
+        # close the connection before removing a partial registry
+        if conn is not None:
+            conn.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    print(f"[INFO] Sample registry saved to: {registry_path}")
+
+def get_sample_rows(patients):
+    """ Get the rows of the samples table. The samples of a patient JSON keep their order, the samples that were left out come after them. """
+
+    for patient_data, sample_states in patients:
+        combined_id = patient_data["combined_id"]
+        samples = patient_data["samples"]
+
+        for position, sample in enumerate(samples.values()):
+            state = sample_states.get(sample["sample_id"], {})
+            yield (combined_id, position, sample["sample_id"], sample["tumor_normal"], sample["assay_type"], sample["anon_id"], state.get("bam_dir"), VALID_STATUS)
+
+        # the directory names of left out samples don't always follow the sample id format, so tumor_normal is not inferred for them
+        left_out = [(sample_id, state) for sample_id, state in sample_states.items() if sample_id not in samples]
+        for position, (sample_id, state) in enumerate(left_out, len(samples)):
+            yield (combined_id, position, sample_id, "NA", "research_access", "NA", state["bam_dir"], state["status"])
+
+def load_patient(registry_path, combined_id):
+    """ Get the patient data of a patient from the registry, the same as loading its patient JSON. Returns None if the patient is not registered. """
+    patients = load_patients(registry_path, [combined_id])
+    return patients.get(combined_id)
+
+def load_patients(registry_path, combined_ids=None):
+    """ Get the patient data of the given patients, or of every patient if none are given. Returns a dictionary of combined_id -> patient data. """
+
+    with sqlite3.connect(registry_path) as conn:
+        if combined_ids is None:
+            patient_rows = conn.execute("SELECT combined_id, cmo_id, dmp_id FROM patients ORDER BY combined_id").fetchall()
+        else:
+            patient_rows = [row for combined_id in combined_ids for row in conn.execute("SELECT combined_id, cmo_id, dmp_id FROM patients WHERE combined_id = ?", (combined_id,))]
+
+        patients = {}
+        for combined_id, cmo_id, dmp_id in patient_rows:
+            patient_data = {"combined_id": combined_id, "cmo_id": cmo_id, "dmp_id": dmp_id, "samples": {}}
+            sample_rows = conn.execute(
+                "SELECT sample_id, tumor_normal, assay_type, anon_id FROM samples WHERE combined_id = ? AND status = ? ORDER BY position",
+                (combined_id, VALID_STATUS)
+            )
+            for sample_id, tumor_normal, assay_type, anon_id in sample_rows:
+                patient_data["samples"][sample_id] = {"sample_id": sample_id, "tumor_normal": tumor_normal, "assay_type": assay_type, "anon_id": anon_id}
+            patients[combined_id] = patient_data
+    conn.close()
+
+    return patients
+
+def query_samples(registry_path, assay_type=None, status=VALID_STATUS):
+    """ Get the samples of every patient with the given assay type and status, using the index. Returns a list of dictionaries, one per sample. """
+
+    query = "SELECT combined_id, sample_id, tumor_normal, assay_type, anon_id, bam_dir, status FROM samples WHERE status = ?"
+    params = [status]
+    if assay_type:
+        query += " AND assay_type = ?"
+        params.append(assay_type)
+
+    with sqlite3.connect(registry_path) as conn:
+        conn.row_factory = sqlite3.Row
+        samples = [dict(row) for row in conn.execute(query + " ORDER BY combined_id, position", params)]
+    conn.close()
+
+    return samples
+
+def export_patient_jsons(registry_path, output_dir="."):
+    """ Write the {combined_id}_all_samples.json of every patient in the registry. """
+
+    patients = load_patients(registry_path)
+    for combined_id, patient_data in patients.items():
+        with open(os.path.join(output_dir, f"{combined_id}_all_samples.json"), "w") as out:
+            json.dump(patient_data, out, indent=4)
+
+    print(f"[INFO] {len(patients)} patient JSONs exported from {registry_path}.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the patient JSONs of a sample registry.")
+    parser.add_argument("--registry", required=True, help="SQLite sample registry from infer_samples.py --registry.")
+    parser.add_argument("--output_dir", default=".")
+    args = parser.parse_args()
+
+    export_patient_jsons(args.registry, args.output_dir)
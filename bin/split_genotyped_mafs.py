@@ -0,0 +1,78 @@
+import os
+import glob
+import argparse
+import pandas as pd
+
+"""
+Script that splits the genotyped mafs of a cohort genotyping run back into the patients the samples belong to.
+Uses the cohort_sample_patients.tsv mapping from genotype_variants_input.py --cohort_manifest. Each genotyped maf is read once,
+and every patient gets a copy with only the variants of its own all calls maf, named after the patient's sample id.
+The mafs of a patient are written to {output_dir}/{patient json name without .json}/, the layout filter_calls.py expects.
+The all calls mafs in the mapping are named by file name only and are read from the working directory, where the pipeline stages them.
+"""
+
+# Columns that identify a genotyped site
+SITE_COLS = ['Chromosome', 'Start_Position', 'End_Position', 'Reference_Allele', 'Tumor_Seq_Allele2']
+
+def split_genotyped_mafs(sample_patients_file, genotyped_mafs, output_dir="split"):
+    """ Write the rows of each genotyped maf that belong to each patient sharing the sample. """
+
+    sample_patients = pd.read_csv(sample_patients_file, sep="\t", dtype=str, keep_default_na=False)
+
+    # the variant sites of each patient, read once per all calls maf
+    patient_sites = {maf: get_sites(pd.read_csv(maf, sep="\t", dtype=str, keep_default_na=False)) for maf in sample_patients['all_calls_maf'].unique()}
+
+    # every patient gets an output directory, even if none of its samples were genotyped
+    for patient_json in sample_patients['patient_json'].unique():
+        os.makedirs(get_patient_dir(patient_json, output_dir), exist_ok=True)
+
+    maf_owners = assign_mafs_to_samples(sample_patients['genotyped_sample_id'].unique(), genotyped_mafs)
+
+    n_written = 0
+    for genotyped_sample_id, patients in sample_patients.groupby('genotyped_sample_id', sort=False):
+        for maf in [maf for maf, owner in maf_owners.items() if owner == genotyped_sample_id]:
+            maf_data = pd.read_csv(maf, sep="\t", dtype=str, keep_default_na=False)
+            maf_sites = get_sites(maf_data)
+            suffix = os.path.basename(maf)[len(genotyped_sample_id):]
+
+            for patient in patients.itertuples(index=False):
+                patient_rows = maf_data[maf_sites.isin(patient_sites[patient.all_calls_maf])]
+                output_path = os.path.join(get_patient_dir(patient.patient_json, output_dir), f"{patient.sample_id}{suffix}")
+                patient_rows.to_csv(output_path, sep="\t", index=False)
+                n_written += 1
+
+    print(f"[INFO] {n_written} genotyped mafs written for {sample_patients['patient_json'].nunique()} patients.")
+
+def find_sample_mafs(sample_id, genotyped_mafs):
+    """ Find the genotyped mafs of a sample, named {sample_id}-{read type}_genotyped.maf. """
+    sample_mafs = []
+    for maf in genotyped_mafs:
+        name = os.path.basename(maf)
+        if name.startswith(f"{sample_id}-") and name.endswith("_genotyped.maf"):
+            sample_mafs.append(maf)
+    return sample_mafs
+
+def assign_mafs_to_samples(sample_ids, genotyped_mafs):
+    """ Assign each genotyped maf to the longest sample id it starts with, so sample ids that are prefixes of other ids are not mixed up. """
+    owners = {}
+    for sample_id in sorted(sample_ids, key=len):
+        for maf in find_sample_mafs(sample_id, genotyped_mafs):
+            owners[maf] = sample_id
+    return owners
+
+def get_sites(maf_data):
+    """ Index the rows of a maf by their variant site. """
+    return pd.MultiIndex.from_frame(maf_data[SITE_COLS])
+
+def get_patient_dir(patient_json, output_dir):
+    """ Output directory of a patient, named after the patient JSON so the mafs can be joined back to it. """
+    return os.path.join(output_dir, os.path.basename(patient_json).removesuffix(".json"))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split cohort genotyped mafs into patients.")
+    parser.add_argument("--sample_patients", required=True, help="cohort_sample_patients.tsv from genotype_variants_input.py.")
+    parser.add_argument("--genotyped_mafs", required=True, help="Directory with the genotyped mafs of the cohort.")
+    parser.add_argument("--output_dir", default="split")
+    args = parser.parse_args()
+
+    split_genotyped_mafs(args.sample_patients, glob.glob(os.path.join(args.genotyped_mafs, "*_genotyped.maf")), args.output_dir)
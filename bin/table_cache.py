@@ -0,0 +1,109 @@
+import os
+import hashlib
+import tempfile
+import pandas as pd
+
+try:
+    import pyarrow
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+"""
+Helper script with an optional columnar cache for the tab delimited tables the pipeline reads (MAFs, FACETS fits and manifests).
+The cache is enabled by setting the ACCESS_TABLE_CACHE_DIR environment variable to a directory, and needs pyarrow.
+Each parsed table is stored as a Parquet file keyed by the real path, size and mtime of the source file and the read options,
+so the text of a source file is only parsed again after it changes. Without the cache the tables are read with pandas directly.
+"""
+
+CACHE_DIR_ENV = "ACCESS_TABLE_CACHE_DIR"
+
+def is_enabled():
+    """ Check if a cache directory is set and Parquet files can be written. """
+    return bool(os.environ.get(CACHE_DIR_ENV)) and PYARROW_AVAILABLE
+
+def read_table(source_path, columns=None, comment_prefix=None, sep="\t", **read_kwargs):
+    """
+    Read a delimited table, from the columnar cache if it is enabled.
+    columns: optional list of columns to keep, columns missing from the file are ignored
+    comment_prefix: optional prefix of the metadata lines before the header to skip, e.g. "#"
+    read_kwargs: passed on to pandas.read_csv
+    """
+
+    if not is_enabled():
+        return parse_table(source_path, columns, comment_prefix, sep, read_kwargs)
+
+    cache_path = get_cache_path(source_path, columns, comment_prefix, sep, read_kwargs)
+    if os.path.exists(cache_path):
+        return pd.read_parquet(cache_path)
+
+    table = parse_table(source_path, columns, comment_prefix, sep, read_kwargs)
+    write_cache(table, cache_path)
+    return table
+
+def parse_table(source_path, columns, comment_prefix, sep, read_kwargs):
+    """ Parse a delimited text table and type the Chromosome, Start_Position and End_Position columns. """
+
+    # the metadata lines are skipped by pandas, so the text of a large file is streamed instead of copied into memory
+    skiprows = count_comment_lines(source_path, comment_prefix) if comment_prefix else 0
+
+    table = pd.read_csv(source_path, sep=sep, usecols=get_usecols(source_path, columns, sep, skiprows), skiprows=skiprows, **read_kwargs)
+
+    if "Chromosome" in table.columns:
+        table["Chromosome"] = table["Chromosome"].astype(str)
+    for col in ["Start_Position", "End_Position"]:
+        if col in table.columns:
+            try:
+                table[col] = pd.to_numeric(table[col]).astype("int64")
+            except (ValueError, TypeError):
+                print(f"[WARNING] Non-integer {col} values in {source_path}.")
+
+    return table
+
+def count_comment_lines(source_path, comment_prefix):
+    """ Count the metadata lines starting with comment_prefix before the header line of a table. """
+    n_lines = 0
+    with open(source_path, "r") as f:
+        for line in f:
+            if not line.startswith(comment_prefix):
+                break
+            n_lines += 1
+    return n_lines
+
+def get_usecols(source_path, columns, sep="\t", skiprows=0):
+    """ Get the requested columns that exist in the header of a table, the line after the skipped lines, in file order. Returns None to read every column. """
+
+    if not columns:
+        return None
+
+    with open(source_path, "r") as f:
+        for _ in range(skiprows):
+            f.readline()
+        header = f.readline()
+
+    return [col for col in header.rstrip("\r\n").split(sep) if col in set(columns)]
+
+def get_cache_path(source_path, columns, comment_prefix, sep, read_kwargs):
+    """ Build the Parquet path of a source table from its real path, size, mtime and the read options. """
+
+    real_path = os.path.realpath(source_path)
+    source_stat = os.stat(real_path)
+    cache_key = repr((real_path, source_stat.st_size, source_stat.st_mtime_ns, columns, comment_prefix, sep, sorted(read_kwargs.items())))
+    cache_name = hashlib.sha1(cache_key.encode()).hexdigest()[:16]
+
+    return os.path.join(os.environ[CACHE_DIR_ENV], f"{os.path.basename(real_path)}.{cache_name}.parquet")
+
+def write_cache(table, cache_path):
+    """ Write a table to the cache. The file is replaced atomically so concurrent tasks never read a partial cache. """
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix=".tmp")
+    os.close(fd)
+    try:
+        table.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        print(f"[WARNING] Could not write table cache {cache_path}: {e}")
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
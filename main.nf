@@ -22,9 +22,18 @@ include { getGenomeAttribute      } from './subworkflows/local/utils_nfcore_acce
 include { INFER_SAMPLES         } from './modules/local/INFER_SAMPLES/main'
 include { GENOTYPE_VARIANTS_INPUT         } from './modules/local/GENOTYPE_VARIANTS_INPUT/main'
 include { GENOTYPE_VARIANTS         } from './modules/local/GENOTYPE_VARIANTS/main'
+include { GENOTYPE_VARIANTS_INPUT_COHORT         } from './modules/local/GENOTYPE_VARIANTS_INPUT_COHORT/main'
+include { GENOTYPE_VARIANTS_COHORT         } from './modules/local/GENOTYPE_VARIANTS_COHORT/main'
+include { SPLIT_GENOTYPED_MAFS         } from './modules/local/SPLIT_GENOTYPED_MAFS/main'
+include { MERGE_GENOTYPED_MAFS         } from './modules/local/MERGE_GENOTYPED_MAFS/main'
 include { GENERATE_MAF         } from './modules/local/GENERATE_MAF/main'
+include { INDEX_DMP_MUTATIONS         } from './modules/local/INDEX_DMP_MUTATIONS/main'
+include { INDEX_FACETS_ARCHIVE         } from './modules/local/INDEX_FACETS_ARCHIVE/main'
 include { FIND_FACETS_FIT         } from './modules/local/FIND_FACETS_FIT/main'
+include { FIND_FACETS_FIT_COHORT         } from './modules/local/FIND_FACETS_FIT_COHORT/main'
 include { FILTER_CALLS         } from './modules/local/FILTER_CALLS/main'
+include { FILTER_CALLS_COHORT         } from './modules/local/FILTER_CALLS_COHORT/main'
+include { PERF_SUMMARY         } from './modules/local/PERF_SUMMARY/main'
 
 /*
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -59,56 +68,235 @@ workflow MSK_ACCESS_DATA_ANALYSIS_NF {
     // WORKFLOW: Run pipeline
     //
 
+    // Index the rows of each patient in the clinical mutations file once, so GENERATE_MAF only reads its patient's rows
+    INDEX_DMP_MUTATIONS(
+        params.file_paths.clinical_impact.variant_file.mutations
+    )
+
     GENERATE_MAF(
         patient_json,
         params.file_paths.research_access.variant_file_template.mutations,
         params.file_paths.clinical_impact.variant_file.mutations,
         params.variant_filter_rules.exclude_genes,
-        params.variant_filter_rules.exclude_classifications
+        params.variant_filter_rules.exclude_classifications,
+        INDEX_DMP_MUTATIONS.out.mutations_index.first(),
+        params.generate_maf_workers
     )
 
+    // The perf reports of the stages, only written with params.perf_instrumentation
+    perf_reports = GENERATE_MAF.out.perf
 
-    GENOTYPE_VARIANTS_INPUT(
-        GENERATE_MAF.out.maf_results,
+    if (params.genotyping_cohort_mode) {
+        // Build one genotyping table for the cohort, so BAMs shared between patients are genotyped once.
+        // The patient JSONs and all calls mafs are staged into the task, and the manifest lists their staged paths
+        genotyping_manifest = GENERATE_MAF.out.maf_results
+                                .map { json, maf -> [ "patient_jsons/${json.getName()}", "all_calls_mafs/${maf.getName()}" ].join('\t') }
+                                .collectFile(name: 'genotyping_cohort_manifest.tsv', seed: "patient_json\tall_calls_maf\n", newLine: true, sort: true)
+        all_calls_mafs = GENERATE_MAF.out.maf_results.map { json, maf -> maf }
 
-        // Research ACCESS templates
-        params.file_paths.research_access.bam_file_template.duplex,
-        params.file_paths.research_access.bam_file_template.simplex,
-        params.file_paths.research_access.bam_file_template.unfilter,
+        GENOTYPE_VARIANTS_INPUT_COHORT(
+            genotyping_manifest,
+            GENERATE_MAF.out.maf_results.map { json, maf -> json }.collect(),
+            all_calls_mafs.collect(),
 
-        // Clinical ACCESS templates
-        params.file_paths.clinical_access.bam_file_template.duplex,
-        params.file_paths.clinical_access.bam_file_template.simplex,
-        params.file_paths.clinical_access.bam_file_template.unfilter,
+            // Research ACCESS templates
+            params.file_paths.research_access.bam_file_template.duplex,
+            params.file_paths.research_access.bam_file_template.simplex,
+            params.file_paths.research_access.bam_file_template.unfilter,
 
-        // Clinical IMPACT templates
-        params.file_paths.clinical_impact.bam_file_template.standard
-    )
+            // Clinical ACCESS templates
+            params.file_paths.clinical_access.bam_file_template.duplex,
+            params.file_paths.clinical_access.bam_file_template.simplex,
+            params.file_paths.clinical_access.bam_file_template.unfilter,
 
-    GENOTYPE_VARIANTS(
-        GENOTYPE_VARIANTS_INPUT.out.genotyping_input,
-        params.fasta_ref
-    )
+            // Clinical IMPACT templates
+            params.file_paths.clinical_impact.bam_file_template.standard,
 
-    FIND_FACETS_FIT(
-        params.base_dirs.clinical_impact.facets_dir,
-        patient_json
+            params.genotyping_cohort_rows_per_task
+        )
 
-    )
-                            
-    filter_calls_input = GENOTYPE_VARIANTS.out.genotyped_mafs.map { geno -> [ geno[0].getName(), geno ] }
-                            .join(FIND_FACETS_FIT.out.facets_fit.map { facets -> [ facets[0].getName(), facets ] }, by: 0)
-                            .map { id, geno, facets -> [geno[0], geno[1], facets[1]] }
+        // One GENOTYPE_VARIANTS_COHORT task per table of unique BAMs, with the all calls and target site mafs its rows name
+        maf_files = all_calls_mafs
+                        .mix(GENOTYPE_VARIANTS_INPUT_COHORT.out.target_sites.flatten())
+                        .map { maf -> [ maf.getName(), maf ] }
+        genotyping_tasks = GENOTYPE_VARIANTS_INPUT_COHORT.out.task_inputs
+                            .flatten()
+                            .flatMap { table -> table.splitCsv(header: true, sep: '\t').collect { row -> row.maf }.unique().collect { maf_name -> [ maf_name, table ] } }
+                            .combine(maf_files, by: 0)
+                            .map { maf_name, table, maf -> [ table.getName(), table, maf ] }
+                            .groupTuple()
+                            .map { name, tables, mafs -> [ tables[0], mafs ] }
 
-    FILTER_CALLS(
-        filter_calls_input
-    )
+        GENOTYPE_VARIANTS_COHORT(
+            genotyping_tasks,
+            params.fasta_ref,
+            params.genotyping_engine,
+            params.gbcms_path
+        )
+
+        // Split the genotyped mafs back into one directory per patient, named after the patient JSON
+        SPLIT_GENOTYPED_MAFS(
+            GENOTYPE_VARIANTS_INPUT_COHORT.out.sample_patients,
+            GENOTYPE_VARIANTS_COHORT.out.genotyped_mafs.flatten().collect(),
+            all_calls_mafs.collect()
+        )
+
+        perf_reports = perf_reports.mix(GENOTYPE_VARIANTS_INPUT_COHORT.out.perf)
+
+        genotyped_mafs = SPLIT_GENOTYPED_MAFS.out.genotyped_mafs
+                            .flatten()
+                            .map { dir -> [ dir.getName(), dir.listFiles().findAll { it.name.endsWith('_genotyped.maf') } ] }
+    } else {
+        GENOTYPE_VARIANTS_INPUT(
+            GENERATE_MAF.out.maf_results,
+
+            // Research ACCESS templates
+            params.file_paths.research_access.bam_file_template.duplex,
+            params.file_paths.research_access.bam_file_template.simplex,
+            params.file_paths.research_access.bam_file_template.unfilter,
+
+            // Clinical ACCESS templates
+            params.file_paths.clinical_access.bam_file_template.duplex,
+            params.file_paths.clinical_access.bam_file_template.simplex,
+            params.file_paths.clinical_access.bam_file_template.unfilter,
+
+            // Clinical IMPACT templates
+            params.file_paths.clinical_impact.bam_file_template.standard,
+
+            params.genotyping_shards,
+            params.genotype_cache_dir ?: "",
+            params.genotyping_engine,
+            params.fasta_ref
+        )
+
+        perf_reports = perf_reports.mix(GENOTYPE_VARIANTS_INPUT.out.perf)
+
+        // One GENOTYPE_VARIANTS task per genotyping input table, i.e. per shard of the patient
+        GENOTYPE_VARIANTS(
+            GENOTYPE_VARIANTS_INPUT.out.genotyping_input.transpose(),
+            params.fasta_ref,
+            params.genotyping_engine,
+            params.gbcms_path
+        )
+
+        if (params.genotyping_shards > 1 || params.genotype_cache_dir) {
+            // Group the shards of each patient as soon as all of them are genotyped, then merge them back into one set of mafs
+            shard_counts = GENOTYPE_VARIANTS_INPUT.out.genotyping_input.map { json, inputs -> [ json.getName(), [inputs].flatten().size() ] }
+
+            shard_mafs = GENOTYPE_VARIANTS.out.genotyped_mafs
+                            .map { json, mafs -> [ json.getName(), json, mafs ] }
+                            .combine(shard_counts, by: 0)
+                            .map { id, json, mafs, n_shards -> [ groupKey(id, n_shards), json, mafs ] }
+                            .groupTuple()
+                            .map { id, jsons, mafs -> [ jsons[0].getName(), jsons[0], mafs.flatten() ] }
+
+            // With the genotype cache, the cached counts are added back to the mafs while merging
+            if (params.genotype_cache_dir) {
+                merge_input = shard_mafs
+                                .join(GENOTYPE_VARIANTS_INPUT.out.cache_plan.map { json, plan -> [ json.getName(), plan ] }, by: 0)
+                                .map { id, json, mafs, plan -> [ json, mafs, plan ] }
+            } else {
+                merge_input = shard_mafs.map { id, json, mafs -> [ json, mafs, [] ] }
+            }
+
+            MERGE_GENOTYPED_MAFS(
+                merge_input,
+                params.genotype_cache_dir ?: ""
+            )
+
+            genotyped_mafs = MERGE_GENOTYPED_MAFS.out.genotyped_mafs.map { geno -> [ geno[0].getBaseName(), geno[1] ] }
+        } else {
+            genotyped_mafs = GENOTYPE_VARIANTS.out.genotyped_mafs.map { geno -> [ geno[0].getBaseName(), geno[1] ] }
+        }
+    }
+
+    // Refresh the FACETS archive index once before looking up the fits, if an index file is configured
+    if (params.facets_archive_index) {
+        INDEX_FACETS_ARCHIVE(
+            params.base_dirs.clinical_impact.facets_dir,
+            params.facets_archive_index
+        )
+        facets_archive_index = INDEX_FACETS_ARCHIVE.out.archive_index.first()
+    } else {
+        facets_archive_index = ""
+    }
+
+    if (params.find_facets_fit_cohort_mode) {
+        // Find the fits of every patient in one task, then match each fit file back to its patient JSON
+        FIND_FACETS_FIT_COHORT(
+            params.base_dirs.clinical_impact.facets_dir,
+            patient_json.collect(),
+            facets_archive_index
+        )
+        facets_fit_files = FIND_FACETS_FIT_COHORT.out.facets_fits
+                            .flatten()
+                            .map { fit -> [ fit.getName(), fit ] }
+        facets_fits = FIND_FACETS_FIT_COHORT.out.facets_fit_patients
+                            .splitCsv(header: true, sep: '\t')
+                            .map { row -> [ row.facets_fit, row.patient_json ] }
+                            .join(facets_fit_files, by: 0)
+                            .map { name, json_name, fit -> [ json_name, fit ] }
+                            .join(patient_json.map { json -> [ json.getName(), json ] }, by: 0)
+                            .map { json_name, fit, json -> [ json.getBaseName(), json, fit ] }
+
+        perf_reports = perf_reports.mix(FIND_FACETS_FIT_COHORT.out.perf)
+    } else {
+        FIND_FACETS_FIT(
+            params.base_dirs.clinical_impact.facets_dir,
+            patient_json,
+            facets_archive_index
+        )
+        facets_fits = FIND_FACETS_FIT.out.facets_fit.map { json, fit -> [ json.getBaseName(), json, fit ] }
+
+        perf_reports = perf_reports.mix(FIND_FACETS_FIT.out.perf)
+    }
+
+    filter_calls_input = genotyped_mafs
+                            .join(facets_fits, by: 0)
+                            .map { id, mafs, json, fit -> [json, mafs, fit] }
+
+    if (params.filter_calls_cohort_mode) {
+        // Process every patient in one task. The patient JSONs, genotyped MAFs and FACETS fit files are staged into the task,
+        // the n-th file of each list in directory n, and the manifest lists the staged paths of each patient
+        cohort_inputs = filter_calls_input
+                            .map { json, mafs, facets -> [ json, [mafs].flatten(), facets ] }
+                            .toSortedList { a, b -> a[0].getName() <=> b[0].getName() }
+
+        cohort_manifest = cohort_inputs
+                            .flatMap { patients ->
+                                def n_mafs = 0
+                                patients.withIndex().collect { patient, i ->
+                                    def json = patient[0]
+                                    def mafs = patient[1]
+                                    def facets = patient[2]
+                                    def staged_mafs = mafs.collect { maf -> n_mafs += 1; "genotyped_mafs/${n_mafs}/${maf.getName()}" }
+                                    [ "patient_jsons/${i + 1}/${json.getName()}", staged_mafs.join(','), "facets_files/${i + 1}/${facets.getName()}" ].join('\t')
+                                }
+                            }
+                            .collectFile(name: 'filter_calls_cohort_manifest.tsv', seed: "patient_json\tgenotyped_mafs\tfacets_file\n", newLine: true, sort: false)
+
+        FILTER_CALLS_COHORT(
+            cohort_manifest,
+            cohort_inputs.map { patients -> patients.collect { patient -> patient[0] } },
+            cohort_inputs.map { patients -> patients.collect { patient -> patient[1] }.flatten() },
+            cohort_inputs.map { patients -> patients.collect { patient -> patient[2] } }
+        )
+
+        perf_reports = perf_reports.mix(FILTER_CALLS_COHORT.out.perf)
+    } else {
+        FILTER_CALLS(
+            filter_calls_input
+        )
+
+        perf_reports = perf_reports.mix(FILTER_CALLS.out.perf)
+    }
 
     //ACCESSANALYSIS (
     //    samplesheet
     //)
     emit:
     multiqc_report = null // channel: /path/to/multiqc_report.html
+    perf_reports = perf_reports // channel: [ *_perf.json ]
 }
 /*
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
@@ -143,11 +331,25 @@ workflow {
         params.file_paths.clinical_impact.key_file,
         params.base_dirs.research_access.bam_dir_template,
         params.clinical_access_sample_regex_pattern,
-        params.clinical_impact_sample_regex_pattern
+        params.clinical_impact_sample_regex_pattern,
+        params.key_index_cache_dir ?: "${workflow.workDir}/key_index_cache",
+        params.infer_samples_workers,
+        // The registry of this run is the previous registry of the next one
+        params.sample_registry || params.previous_registry ? "sample_registry.sqlite" : "",
+        params.previous_registry ? file(params.previous_registry, checkIfExists: true) : []
     )
 
     json_files = INFER_SAMPLES.out.all_samples_json.flatten()
     json_files | MSK_ACCESS_DATA_ANALYSIS_NF
+
+    // Summarize the perf reports of all stages in one MultiQC custom content table
+    if (params.perf_instrumentation) {
+        PERF_SUMMARY(
+            INFER_SAMPLES.out.perf
+                .mix(MSK_ACCESS_DATA_ANALYSIS_NF.out.perf_reports)
+                .collect()
+        )
+    }
     //
     // SUBWORKFLOW: Run completion tasks
     //
@@ -158,7 +360,8 @@ workflow {
         params.outdir,
         params.monochrome_logs,
         params.hook_url,
-        MSK_ACCESS_DATA_ANALYSIS_NF.out.multiqc_report
+        MSK_ACCESS_DATA_ANALYSIS_NF.out.multiqc_report,
+        INFER_SAMPLES.out.registry
     )
 }
 
@@ -12,6 +12,7 @@ process FILTER_CALLS {
 
     output:
         tuple path(patient_json), path("*SNV.csv"), emit: snv_results
+        path("*_perf.json"), emit: perf, optional: true
 
 
     when:
@@ -20,7 +21,7 @@ process FILTER_CALLS {
     script:
 
     """
-    python3 ../../../bin/filter_calls.py \\
+    python3 ../../../bin/access-analysis filter_calls \\
         --patient_json $patient_json \\
         --genotyped_mafs $genotyping_output \\
         --facets_file $facets_fit \\
@@ -0,0 +1,34 @@
+process FILTER_CALLS_COHORT {
+    label 'process_medium'
+
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/multiqc:1.25.1--pyhdfd78af_0' :
+        'biocontainers/multiqc:1.25.1--pyhdfd78af_0' }"
+
+    input:
+    path cohort_manifest
+    path patient_jsons, stageAs: "patient_jsons/?/*"
+    path genotyped_mafs, stageAs: "genotyped_mafs/?/*"
+    path facets_files, stageAs: "facets_files/?/*"
+
+    publishDir "${params.outdir}/final_results/small_variants", mode: 'copy', pattern: '{*SNV.csv,small_variants.parquet}'
+
+    output:
+        path "*SNV.csv", emit: snv_results
+        path "small_variants.parquet", emit: snv_dataset, optional: true
+        path "*_perf.json", emit: perf, optional: true
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+
+    """
+    python3 ../../../bin/access-analysis filter_calls \\
+        --cohort_manifest $cohort_manifest \\
+        --workers ${task.cpus} \\
+        --parquet_dir small_variants.parquet \\
+ 
+    """
+
+}
@@ -9,21 +9,24 @@ process FIND_FACETS_FIT {
     input:
     val facets_dir
     path patient_json
+    val archive_index
 
     publishDir "${params.outdir}/intermediary/facets_fit", mode: 'copy', pattern: '*facets_fit.txt'
 
     output:
         tuple path(patient_json), path("*facets_fit.txt"), emit: facets_fit
+        path("*_perf.json"), emit: perf, optional: true
 
     when:
     task.ext.when == null || task.ext.when
 
     script:
-
+    def index_args = archive_index ? "--archive_index ${archive_index}" : ""
     """
-    python3 ../../../bin/facets_fit.py \\
+    python3 ../../../bin/access-analysis facets_fit \\
         --facets_dir $facets_dir \\
         --patient_json $patient_json \\
+        $index_args \\
     """
 
 
@@ -0,0 +1,34 @@
+process FIND_FACETS_FIT_COHORT {
+    tag "cohort"
+    label 'process_single'
+
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'ghcr.io/msk-access/genotype_variants:0.3.9':
+        'ghcr.io/msk-access/genotype_variants:0.3.9' }"
+
+    input:
+    val facets_dir
+    path patient_jsons
+    val archive_index
+
+    publishDir "${params.outdir}/intermediary/facets_fit", mode: 'copy', pattern: '*facets_fit.txt'
+
+    output:
+        path("*_facets_fit.txt"), emit: facets_fits
+        path("facets_fit_patients.tsv"), emit: facets_fit_patients
+        path("*_perf.json"), emit: perf, optional: true
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+    def index_args = archive_index ? "--archive_index ${archive_index}" : ""
+    """
+    python3 ../../../bin/access-analysis facets_fit \\
+        --facets_dir $facets_dir \\
+        --patient_jsons $patient_jsons \\
+        $index_args \\
+    """
+
+
+}
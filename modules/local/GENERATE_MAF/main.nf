@@ -11,11 +11,14 @@ process GENERATE_MAF {
     path dmp_mutations_file
     val exclude_genes
     val exclude_classifications
+    path dmp_mutations_index
+    val workers
 
     publishDir "${params.outdir}/intermediary/MAFs", mode: 'copy', pattern: '*_all_small_calls.maf'
 
     output:
         tuple path(patient_json), path("*_all_small_calls.maf"), emit: maf_results
+        path("*_perf.json"), emit: perf, optional: true
 
     when:
     task.ext.when == null || task.ext.when
@@ -23,12 +26,14 @@ process GENERATE_MAF {
     script:
 
     """
-    python3 ../../../bin/generate_maf.py \\
+    python3 ../../../bin/access-analysis generate_maf \\
         --patient_json $patient_json \\
         --research_access_mutations_maf_template $research_access_mutations_maf_template \\
         --dmp_mutations_file $dmp_mutations_file \\
         --exclude_genes $exclude_genes \\
         --exclude_classifications $exclude_classifications \\
+        --dmp_mutations_index $dmp_mutations_index \\
+        --workers $workers \\
     """
 
 }
@@ -4,33 +4,45 @@ process GENOTYPE_VARIANTS {
 
     conda "${moduleDir}/environment.yml"
 
-    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+    // the genotype_variants image does not ship pysam, the pysam engine runs in params.pysam_container
+    container "${ params.genotyping_engine == 'pysam' && params.pysam_container ? params.pysam_container :
+        workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
         'ghcr.io/msk-access/genotype_variants:0.3.9':
         'ghcr.io/msk-access/genotype_variants:0.3.9' }"
 
     input:
     tuple path(patient_json), val(genotyping_input)
     val fasta_ref
+    val engine
+    val gbcms_path
 
-    publishDir "${params.outdir}/intermediary/genotyped_mafs", mode: 'copy', pattern: '*.maf'
+    publishDir "${params.outdir}/intermediary/genotyped_mafs", mode: 'copy', pattern: '*.maf', enabled: params.genotyping_shards <= 1 && !params.genotype_cache_dir
 
     output:
-        tuple path(patient_json), path("*.maf"), emit: genotyped_mafs
+        tuple path(patient_json), path("*.maf", arity: '0..*'), emit: genotyped_mafs
         stdout
 
     when:
     task.ext.when == null || task.ext.when
 
     script:
-
+    if (engine == "pysam")
+    """
+    python3 ../../../bin/pileup_genotyper.py \\
+        --genotyping_input ${genotyping_input} \\
+        --workers ${task.cpus}
+    """
+    else
     """
-    
-    genotype_variants small_variants multiple-samples \\
-    -i ${genotyping_input} \\
-    -r ${fasta_ref} \\
-    --filter-duplicate 1 \\
-    -g /work/access/production/resources/tools/GetBaseCountsMultiSample/current/GetBaseCountsMultiSample \\
-    -t ${task.cpus} \\
+    # the table is empty when every sample was found in the genotype cache
+    if [ \$(wc -l < ${genotyping_input}) -gt 1 ]; then
+        genotype_variants small_variants multiple-samples \\
+        -i ${genotyping_input} \\
+        -r ${fasta_ref} \\
+        --filter-duplicate 1 \\
+        -g ${gbcms_path} \\
+        -t ${task.cpus}
+    fi
 
     """
 
@@ -0,0 +1,47 @@
+process GENOTYPE_VARIANTS_COHORT {
+    tag "$genotyping_input"
+    label 'process_single'
+
+    conda "${moduleDir}/../GENOTYPE_VARIANTS/environment.yml"
+
+    // the genotype_variants image does not ship pysam, the pysam engine runs in params.pysam_container
+    container "${ params.genotyping_engine == 'pysam' && params.pysam_container ? params.pysam_container :
+        workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'ghcr.io/msk-access/genotype_variants:0.3.9':
+        'ghcr.io/msk-access/genotype_variants:0.3.9' }"
+
+    input:
+    tuple path(genotyping_input), path(mafs)
+    val fasta_ref
+    val engine
+    val gbcms_path
+
+    publishDir "${params.outdir}/intermediary/genotyped_mafs/cohort", mode: 'copy', pattern: '*.maf'
+
+    output:
+        path("*.maf"), emit: genotyped_mafs
+        stdout
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+    if (engine == "pysam")
+    """
+    python3 ../../../bin/pileup_genotyper.py \\
+        --genotyping_input ${genotyping_input} \\
+        --workers ${task.cpus}
+    """
+    else
+    """
+    
+    genotype_variants small_variants multiple-samples \\
+    -i ${genotyping_input} \\
+    -r ${fasta_ref} \\
+    --filter-duplicate 1 \\
+    -g ${gbcms_path} \\
+    -t ${task.cpus} \\
+
+    """
+
+}
@@ -14,18 +14,25 @@ process GENOTYPE_VARIANTS_INPUT {
     val clinical_access_simplex_bam_template
     val clinical_access_unfilter_bam_template
     val clinical_impact_standard_bam_template
+    val shards
+    val genotype_cache_dir
+    val genotyping_engine
+    val fasta_ref
 
     publishDir "${params.outdir}/intermediary/genotyping_input", mode: 'copy', pattern: '*genotyping_input.tsv'
 
     output:
         tuple path(patient_json), path ("*genotyping_input.tsv"), emit: genotyping_input
+        tuple path(patient_json), path ("*_genotype_cache_plan.tsv"), emit: cache_plan, optional: true
+        path("*_perf.json"), emit: perf, optional: true
 
     when:
     task.ext.when == null || task.ext.when
 
     script:
+    def cache_args = genotype_cache_dir ? "--genotype_cache_dir ${genotype_cache_dir} --genotyping_engine ${genotyping_engine} --fasta_ref ${fasta_ref}" : ""
     """
-    python3 ../../../bin/genotype_variants_input.py \\
+    python3 ../../../bin/access-analysis genotype_variants_input \\
         --patient_json $patient_json \\
         --all_calls_maf $all_calls_maf \\
         --research_access_duplex_bam_template $research_access_duplex_bam_template \\
@@ -35,6 +42,8 @@ process GENOTYPE_VARIANTS_INPUT {
         --clinical_access_simplex_bam_template $clinical_access_simplex_bam_template \\
         --clinical_access_unfilter_bam_template $clinical_access_unfilter_bam_template \\
         --clinical_impact_standard_bam_template $clinical_impact_standard_bam_template \\
+        --shards $shards \\
+        $cache_args \\
 
     """
 
@@ -0,0 +1,48 @@
+process GENOTYPE_VARIANTS_INPUT_COHORT {
+    label 'process_single'
+
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/multiqc:1.25.1--pyhdfd78af_0' :
+        'biocontainers/multiqc:1.25.1--pyhdfd78af_0' }"
+
+    input:
+    path cohort_manifest
+    path patient_jsons, stageAs: "patient_jsons/*"
+    path all_calls_mafs, stageAs: "all_calls_mafs/*"
+    val research_access_duplex_bam_template
+    val research_access_simplex_bam_template
+    val research_access_unfilter_bam_template
+    val clinical_access_duplex_bam_template
+    val clinical_access_simplex_bam_template
+    val clinical_access_unfilter_bam_template
+    val clinical_impact_standard_bam_template
+    val rows_per_task
+
+    publishDir "${params.outdir}/intermediary/genotyping_input", mode: 'copy', pattern: '{cohort_genotyping_input.tsv,cohort_sample_patients.tsv}'
+
+    output:
+        path "cohort_genotyping_input.tsv", emit: genotyping_input
+        path "genotyping_tasks/*_genotyping_input.tsv", emit: task_inputs
+        path "cohort_target_sites/*_target_sites.maf", emit: target_sites, optional: true
+        path "cohort_sample_patients.tsv", emit: sample_patients
+        path "*_perf.json", emit: perf, optional: true
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+    """
+    python3 ../../../bin/access-analysis genotype_variants_input \\
+        --cohort_manifest $cohort_manifest \\
+        --research_access_duplex_bam_template $research_access_duplex_bam_template \\
+        --research_access_simplex_bam_template $research_access_simplex_bam_template \\
+        --research_access_unfilter_bam_template $research_access_unfilter_bam_template \\
+        --clinical_access_duplex_bam_template $clinical_access_duplex_bam_template \\
+        --clinical_access_simplex_bam_template $clinical_access_simplex_bam_template \\
+        --clinical_access_unfilter_bam_template $clinical_access_unfilter_bam_template \\
+        --clinical_impact_standard_bam_template $clinical_impact_standard_bam_template \\
+        --rows_per_task $rows_per_task \\
+
+    """
+
+}
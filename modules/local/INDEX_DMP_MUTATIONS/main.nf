@@ -0,0 +1,25 @@
+process INDEX_DMP_MUTATIONS {
+    label 'process_single'
+
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/multiqc:1.25.1--pyhdfd78af_0' :
+        'biocontainers/multiqc:1.25.1--pyhdfd78af_0' }"
+
+    input:
+    path dmp_mutations_file
+
+    output:
+        path "dmp_mutations.index", emit: mutations_index
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+
+    """
+    python3 ../../../bin/index_mutations.py \\
+        --dmp_mutations_file $dmp_mutations_file \\
+        --output_index dmp_mutations.index \\
+    """
+
+}
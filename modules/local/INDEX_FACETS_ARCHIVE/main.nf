@@ -0,0 +1,26 @@
+process INDEX_FACETS_ARCHIVE {
+    label 'process_single'
+
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'ghcr.io/msk-access/genotype_variants:0.3.9':
+        'ghcr.io/msk-access/genotype_variants:0.3.9' }"
+
+    input:
+    val facets_dir
+    val archive_index
+
+    output:
+        val archive_index, emit: archive_index
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+
+    """
+    python3 ../../../bin/facets_archive.py \\
+        --facets_dir $facets_dir \\
+        --archive_index $archive_index \\
+    """
+
+}
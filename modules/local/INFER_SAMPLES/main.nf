@@ -10,20 +10,28 @@ process INFER_SAMPLES {
     val research_access_bam_dir_template
     val clinical_access_sample_regex_pattern
     val clinical_impact_sample_regex_pattern        
+    val key_index_cache_dir
+    val workers
+    val registry
+    path previous_registry, stageAs: "previous_registry/*"
 
-    publishDir "${params.outdir}/intermediary/patient_JSONs", mode: 'copy'
+    // the registry is published by PIPELINE_COMPLETION once the run succeeded
+    publishDir "${params.outdir}/intermediary/patient_JSONs", mode: 'copy', pattern: '*.json'
 
     output:
-    path "*.json", emit: all_samples_json
+    path "*_all_samples.json", emit: all_samples_json, optional: true
+    path "*_perf.json", emit: perf, optional: true
+    path "sample_registry.sqlite", emit: registry, optional: true
 
 
     when:
     task.ext.when == null || task.ext.when
 
     script:
-
+    def registry_args = registry ? "--registry ${registry}" : ""
+    def previous_registry_args = previous_registry ? "--previous_registry ${previous_registry}" : ""
     """
-    python3 ../../../bin/infer_samples.py \\
+    python3 ../../../bin/access-analysis infer_samples \\
         --id_mapping_file $id_mapping_file \\
         --include_samples_file $include_samples_file \\
         --exclude_samples_file $exclude_samples_file \\
@@ -32,6 +40,10 @@ process INFER_SAMPLES {
         --research_access_bam_dir_template $research_access_bam_dir_template \\
         --clinical_access_sample_regex_pattern '$clinical_access_sample_regex_pattern' \\
         --clinical_impact_sample_regex_pattern '$clinical_impact_sample_regex_pattern' \\
+        --key_index_cache_dir $key_index_cache_dir \\
+        --workers $workers \\
+        $registry_args \\
+        $previous_registry_args
     """
 
 }
\ No newline at end of file
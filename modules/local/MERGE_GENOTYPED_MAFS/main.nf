@@ -0,0 +1,32 @@
+process MERGE_GENOTYPED_MAFS {
+    tag "$patient_json"
+    label 'process_single'
+
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/multiqc:1.25.1--pyhdfd78af_0' :
+        'biocontainers/multiqc:1.25.1--pyhdfd78af_0' }"
+
+    input:
+    tuple path(patient_json), path(shard_mafs, stageAs: "shard_?/*"), path(cache_plan)
+    val genotype_cache_dir
+
+    publishDir "${params.outdir}/intermediary/genotyped_mafs", mode: 'copy', pattern: '*.maf'
+
+    output:
+        tuple path(patient_json), path("*.maf"), emit: genotyped_mafs
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+    def shard_dirs = shard_mafs ? "--shard_dirs shard_*" : ""
+    def cache_args = cache_plan ? "--cache_plan ${cache_plan} --genotype_cache_dir ${genotype_cache_dir}" : ""
+    """
+    python3 ../../../bin/merge_genotyped_mafs.py \\
+        $shard_dirs \\
+        --output_dir . \\
+        $cache_args \\
+
+    """
+
+}
@@ -0,0 +1,28 @@
+process PERF_SUMMARY {
+    label 'process_single'
+
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/multiqc:1.25.1--pyhdfd78af_0' :
+        'biocontainers/multiqc:1.25.1--pyhdfd78af_0' }"
+
+    input:
+    path perf_reports
+
+    publishDir "${params.outdir}/perf", mode: 'copy'
+
+    output:
+        path "*_perf.json", emit: perf_reports, includeInputs: true
+        path "pipeline_perf_mqc.json", emit: mqc
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+
+    """
+    python3 ../../../bin/perf.py \\
+        --perf_dir . \\
+        --output pipeline_perf_mqc.json \\
+    """
+
+}
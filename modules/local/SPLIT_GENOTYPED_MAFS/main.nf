@@ -0,0 +1,30 @@
+process SPLIT_GENOTYPED_MAFS {
+    label 'process_single'
+
+    container "${ workflow.containerEngine == 'singularity' && !task.ext.singularity_pull_docker_container ?
+        'https://depot.galaxyproject.org/singularity/multiqc:1.25.1--pyhdfd78af_0' :
+        'biocontainers/multiqc:1.25.1--pyhdfd78af_0' }"
+
+    input:
+    path sample_patients
+    path genotyped_mafs, stageAs: "genotyped/*"
+    path all_calls_mafs
+
+    publishDir "${params.outdir}/intermediary/genotyped_mafs", mode: 'copy', pattern: 'split/*'
+
+    output:
+        path "split/*", type: 'dir', emit: genotyped_mafs
+
+    when:
+    task.ext.when == null || task.ext.when
+
+    script:
+    """
+    python3 ../../../bin/split_genotyped_mafs.py \\
+        --sample_patients $sample_patients \\
+        --genotyped_mafs genotyped \\
+        --output_dir split \\
+
+    """
+
+}
@@ -115,10 +115,12 @@ workflow PIPELINE_COMPLETION {
     monochrome_logs // boolean: Disable ANSI colour codes in log output
     hook_url        //  string: hook URL for notifications
     multiqc_report  //  string: Path to MultiQC report
+    sample_registry // channel: sample_registry.sqlite written by INFER_SAMPLES
 
     main:
     summary_params = paramsSummaryMap(workflow, parameters_schema: "nextflow_schema.json")
     def multiqc_reports = multiqc_report.toList()
+    def sample_registries = sample_registry.toList()
     
     //
     // Completion email and summary
@@ -136,6 +138,8 @@ workflow PIPELINE_COMPLETION {
             )
         }
 
+        publishSampleRegistry(sample_registries, outdir)
+
         completionSummary(monochrome_logs)
         if (hook_url) {
             imNotification(summary_params, hook_url)
@@ -157,6 +161,8 @@ workflow PIPELINE_COMPLETION {
 //
 def validateInputParameters() {
     genomeExistsError()
+    pysamContainerError()
+    previousRegistryCohortModeError()
 }
 
 //
@@ -264,3 +270,38 @@ def methodsDescriptionText(mqc_methods_yaml) {
     return description_html.toString()
 }
 
+//
+// Exit pipeline if the pysam genotyping engine runs in a container without pysam
+//
+def pysamContainerError() {
+    if (params.genotyping_engine == 'pysam' && workflow.containerEngine && !params.pysam_container) {
+        error("genotyping_engine = 'pysam' needs pysam, which the genotype_variants container does not have. Set pysam_container to an image with pysam 0.22, or run with conda.")
+    }
+}
+
+//
+// Exit pipeline if a refresh from a previous registry runs a cohort mode, which would only see the changed patients
+//
+def previousRegistryCohortModeError() {
+    def cohort_modes = ['genotyping_cohort_mode', 'find_facets_fit_cohort_mode', 'filter_calls_cohort_mode'].findAll { mode -> params[mode] }
+    if (params.previous_registry && cohort_modes) {
+        error("previous_registry only analyses the patients that changed, and ${cohort_modes.join(', ')} would publish their results over the ones of the whole cohort. Run without previous_registry or without the cohort modes.")
+    }
+}
+
+//
+// Publish the sample registry next to the patient JSONs. It becomes the previous registry of the next run, so it is only
+// published if every task succeeded, otherwise the patients that failed would not be analysed again.
+//
+def publishSampleRegistry(sample_registries, outdir) {
+    if (!params.sample_registry && !params.previous_registry) {
+        return
+    }
+    if (!workflow.success || workflow.stats.ignoredCount) {
+        log.warn "The sample registry was not published because the run did not complete, or some tasks failed and were ignored."
+        return
+    }
+    def registry_dir = file("${outdir}/intermediary/patient_JSONs")
+    registry_dir.mkdirs()
+    sample_registries.getVal().each { registry -> registry.copyTo(registry_dir.resolve('sample_registry.sqlite')) }
+}